@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import os
+
+# ==============================================================================
+# ASYNC CONNECTION POOL
+# ==============================================================================
+
+
+class AsyncPool:
+    """psycopg 3 connection pool for the async views.
+
+    The underlying ``psycopg_pool.AsyncConnectionPool`` has to be opened from
+    the event loop that uses it, so it is created on the first ``connection()``
+    call of each worker process. Connections are in autocommit mode: the async
+    views only read, and this saves a BEGIN/COMMIT pair per request.
+    """
+
+    def __init__(self, params, min_size=0, max_size=10, max_lifetime=1800,
+                 max_idle=300, acquire_timeout=5.0):
+        self.params = params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.acquire_timeout = acquire_timeout
+        self._pool = None
+        self._pid = None
+        self._opening = None
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        pool = await self._get_pool()
+        async with pool.connection(timeout=self.acquire_timeout) as conn:
+            yield conn
+
+    async def close(self):
+        if self._pool is not None and self._pid == os.getpid():
+            await self._pool.close()
+        self._pool = None
+
+    def stats(self):
+        if self._pool is None or self._pid != os.getpid():
+            return {'size': 0, 'max_size': self.max_size}
+        stats = self._pool.get_stats()
+        stats['max_size'] = self.max_size
+        return stats
+
+    async def _get_pool(self):
+        if self._pool is not None and self._pid == os.getpid():
+            return self._pool
+        if self._opening is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pool = None
+            self._opening = asyncio.Lock()
+        async with self._opening:
+            if self._pool is None:
+                from psycopg_pool import AsyncConnectionPool
+
+                pool = AsyncConnectionPool(
+                    kwargs={
+                        'dbname': self.params['database'],
+                        'user': self.params['user'],
+                        'password': self.params['password'],
+                        'host': self.params['host'],
+                        'port': self.params['port'],
+                        'autocommit': True,
+                    },
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                    max_lifetime=self.max_lifetime,
+                    max_idle=self.max_idle,
+                    timeout=self.acquire_timeout,
+                    open=False,
+                )
+                await pool.open()
+                self._pool = pool
+        return self._pool
@@ -13,4 +13,6 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'massitfab.settings')
 
+# api/async/ goes through the stock handler too: its views, the metrics and
+# Server-Timing middleware are async and never hop to a thread themselves
 application = get_asgi_application()
@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from django.http import HttpResponse
+
+# ==============================================================================
+# RESPONSE CACHE
+# ==============================================================================
+
+
+class ResponseCache:
+    """In-process LRU cache of encoded GET responses.
+
+    Entries expire after ``ttl`` seconds and the least recently used one is
+    evicted once ``max_entries`` is reached. Each entry carries tags such as
+    ``product:12``, ``seller:3`` or ``feed``; ``purge()`` drops every entry
+    holding one of the given tags. The cache is per worker process, so other
+    workers only see a purge once their own copy expires.
+    """
+
+    def __init__(self, max_entries=1000, ttl=30, enabled=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'purged': 0,
+        }
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            if entry['expires'] <= time.monotonic():
+                self._remove(key)
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry
+
+    def set(self, key, content, content_type, tags=(), ttl=None):
+        entry = {
+            'content': content,
+            'content_type': content_type,
+            'tags': frozenset(tags),
+            'expires': time.monotonic() + (self.ttl if ttl is None else ttl),
+        }
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            for tag in entry['tags']:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+
+    def purge(self, *tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    self._counters['purged'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for tag in entry['tags']:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+def cache_key(request):
+    # Path plus query params sorted by name and value, so ?b=2&a=1 == ?a=1&b=2
+    params = sorted(
+        (name, value)
+        for name in request.GET
+        for value in request.GET.getlist(name)
+    )
+    query = '&'.join('%s=%s' % pair for pair in params)
+    return request.path + ('?' + query if query else '')
+
+
+def tag(response, *tags):
+    # Called by a view on the response it returns; untagged responses are not cached
+    response.cache_tags = tags
+    return response
+
+
+def cached_response(cache):
+    """Serve anonymous GETs of the wrapped view from ``cache``.
+
+    Only successful responses the view tagged with ``tag()`` are stored.
+    Requests carrying an Authorization header always reach the view. Works
+    for both sync and async views.
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if _bypass(cache, request):
+                    return await view(request, *args, **kwargs)
+                key = cache_key(request)
+                response = _lookup(cache, key)
+                if response is None:
+                    response = _store(cache, key, await view(request, *args, **kwargs))
+                return response
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if _bypass(cache, request):
+                return view(request, *args, **kwargs)
+            key = cache_key(request)
+            response = _lookup(cache, key)
+            if response is None:
+                response = _store(cache, key, view(request, *args, **kwargs))
+            return response
+        return wrapper
+    return decorator
+
+
+def _bypass(cache, request):
+    return (not cache.enabled or request.method != 'GET'
+            or 'HTTP_AUTHORIZATION' in request.META)
+
+
+def _lookup(cache, key):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    response = HttpResponse(entry['content'], content_type=entry['content_type'])
+    response['X-Cache'] = 'HIT'
+    return response
+
+
+def _store(cache, key, response):
+    tags = getattr(response, 'cache_tags', None)
+    if response.status_code == 200 and tags and not response.streaming:
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        cache.set(key, response.content, response['Content-Type'], tags)
+    response['X-Cache'] = 'MISS'
+    return response
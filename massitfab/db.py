@@ -0,0 +1,354 @@
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2 as ps
+from psycopg2 import extensions
+from asgiref.local import Local
+from django.core import signals
+
+from massitfab import timing
+
+# ==============================================================================
+# CONNECTION POOL
+# ==============================================================================
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledCursor(extensions.cursor):
+    # Counts and times the statements sent from the current thread / async context
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record(query, (time.perf_counter() - started) * 1000)
+
+
+class PooledConnection(extensions.connection):
+    # psycopg2 connection carrying the bookkeeping the pool needs
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = PooledCursor
+        self.pool = None
+        self.leased = False
+        self.born_at = time.monotonic()
+        self.last_used = self.born_at
+        # Names of the server-side prepared statements this session holds
+        self.prepared = set()
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of psycopg2 connections.
+
+    Connections are opened lazily up to ``max_size``. Idle connections are
+    pinged before reuse once they have been idle for ``check_after`` seconds,
+    and are closed when older than ``max_lifetime`` or idle for longer than
+    ``max_idle`` (never dropping below ``min_size``).
+    """
+
+    def __init__(self, params, min_size=0, max_size=10, max_lifetime=1800,
+                 max_idle=300, check_after=30, acquire_timeout=5.0):
+        self.params = params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.acquire_timeout = acquire_timeout
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._waiting = 0
+        self._pid = os.getpid()
+        self._counters = {
+            'connections_opened': 0,
+            'connections_closed': 0,
+            'acquired': 0,
+            'timeouts': 0,
+            'failed_checks': 0,
+            'wait_seconds': 0.0,
+        }
+
+    def getconn(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            conn = None
+            with self._cond:
+                self._check_fork()
+                while True:
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        # Reserve the slot now, connect outside of the lock
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout(
+                            'Could not acquire a database connection within %ss' % timeout)
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if conn is None:
+                conn = self._connect()
+            elif not self._usable(conn):
+                self._discard(conn)
+                continue
+
+            conn.last_used = time.monotonic()
+            with self._cond:
+                self._counters['acquired'] += 1
+                self._counters['wait_seconds'] += conn.last_used - started
+            return conn
+
+    def putconn(self, conn, close=False):
+        if conn.pool is not self:
+            conn.close()
+            return
+        conn.leased = False
+        if not close and not conn.closed and not self._expired(conn):
+            try:
+                # Never hand out a connection with a transaction left open
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except ps.Error:
+                close = True
+        else:
+            close = True
+
+        if close:
+            self._discard(conn)
+            return
+        conn.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(conn)
+            self._prune()
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'waiting': self._waiting,
+                'max_size': self.max_size,
+            })
+        return stats
+
+    def _connect(self):
+        try:
+            conn = ps.connect(connection_factory=PooledConnection, **self.params)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        conn.pool = self
+        with self._cond:
+            self._counters['connections_opened'] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except ps.Error:
+            pass
+        # Its slot is freed below, once: a second putconn() only closes it
+        conn.pool = None
+        with self._cond:
+            self._size -= 1
+            self._counters['connections_closed'] += 1
+            self._cond.notify()
+
+    def _expired(self, conn):
+        return time.monotonic() - conn.born_at > self.max_lifetime
+
+    def _usable(self, conn):
+        if conn.closed or self._expired(conn):
+            return False
+        if time.monotonic() - conn.last_used < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except ps.Error:
+            with self._cond:
+                self._counters['failed_checks'] += 1
+            return False
+
+    def _prune(self):
+        # Called with the lock held: close connections idle for too long
+        now = time.monotonic()
+        while len(self._idle) > self.min_size and now - self._idle[0].last_used > self.max_idle:
+            conn = self._idle.popleft()
+            self._size -= 1
+            self._counters['connections_closed'] += 1
+            try:
+                conn.close()
+            except ps.Error:
+                pass
+
+    def _check_fork(self):
+        # Connections must not be shared with a forked worker
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = deque()
+            self._size = 0
+            self._waiting = 0
+
+# ==============================================================================
+# PREPARED STATEMENTS
+# ==============================================================================
+
+
+def execute_prepared(cur, name, sql, params=()):
+    """Run ``sql`` as the server-side prepared statement ``name``.
+
+    ``sql`` uses the usual %s placeholders. The statement is prepared the first
+    time a pooled connection runs it and executed by name from then on, so
+    Postgres parses and plans it once per session. Prepared statements survive
+    a rollback, so the bookkeeping on the connection stays accurate.
+
+    The PREPARE and EXECUTE bypass PooledCursor's counting and timing; the
+    caller records the call once, under ``sql`` (see ``record()``).
+    """
+    conn = cur.connection
+    prepared = getattr(conn, 'prepared', None)
+    if prepared is None:
+        # Not one of ours (e.g. a plain psycopg2 connection): run it as text
+        _send(cur, sql, params)
+        return False
+    preparing = name not in prepared
+    if preparing:
+        _send(cur, 'PREPARE %s AS %s' % (name, _numbered(sql)))
+        prepared.add(name)
+    if params:
+        _send(cur, 'EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(params))), params)
+    else:
+        _send(cur, 'EXECUTE %s' % name)
+    # True when this call had to prepare it first
+    return preparing
+
+
+def _send(cur, sql, params=None):
+    # cursor.execute without PooledCursor's bookkeeping
+    if isinstance(cur, PooledCursor):
+        return extensions.cursor.execute(cur, sql, params)
+    return cur.execute(sql, params)
+
+
+def _numbered(sql):
+    # %s placeholders to $1, $2, ... and %% back to %, as PREPARE expects
+    parts = sql.split('%%')
+    count = 0
+    for i, part in enumerate(parts):
+        pieces = part.split('%s')
+        for j in range(1, len(pieces)):
+            count += 1
+            pieces[j] = '$%d' % count + pieces[j]
+        parts[i] = ''.join(pieces)
+    return '%'.join(parts)
+
+# ==============================================================================
+# PER-REQUEST LEASE
+# ==============================================================================
+
+# Same scoping Django uses for its own connections: one per thread, or per
+# async context when running under ASGI.
+_lease = Local()
+_counter = Local()
+
+
+def lease(pool):
+    conn = getattr(_lease, 'conn', None)
+    if conn is not None:
+        if not conn.closed:
+            return conn
+        # Dropped by the server or closed by the caller: give its slot back
+        _lease.conn = None
+        conn.pool.putconn(conn)
+    conn = pool.getconn()
+    if getattr(_lease, 'active', False):
+        # Keep it for the rest of the request; released on request_finished
+        conn.leased = True
+        _lease.conn = conn
+    return conn
+
+
+def release(conn):
+    if conn.pool is None:
+        return
+    if conn.closed:
+        # putconn() discards it and frees its slot; a leased one leaves the lease
+        if getattr(_lease, 'conn', None) is conn:
+            _lease.conn = None
+        conn.pool.putconn(conn)
+        return
+    if conn.leased:
+        # Whatever the caller did not commit is discarded, exactly as closing
+        # the connection used to do, so the next user starts clean.
+        try:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except ps.Error:
+            pass
+        return
+    conn.pool.putconn(conn)
+
+
+def current():
+    return getattr(_lease, 'conn', None)
+
+
+def record(sql, ms):
+    # One statement sent: counted for statements() and timed for Server-Timing and the slow-query log
+    _counter.statements = getattr(_counter, 'statements', 0) + 1
+    timing.record(sql, ms)
+
+
+def statements():
+    # Statements this thread (or async context) has sent through pooled cursors
+    return getattr(_counter, 'statements', 0)
+
+
+def _begin_request(**kwargs):
+    _lease.active = True
+    _lease.conn = None
+
+
+def _end_request(**kwargs):
+    conn = getattr(_lease, 'conn', None)
+    _lease.active = False
+    _lease.conn = None
+    if conn is not None and conn.pool is not None:
+        conn.pool.putconn(conn)
+
+
+signals.request_started.connect(_begin_request)
+signals.request_finished.connect(_end_request)
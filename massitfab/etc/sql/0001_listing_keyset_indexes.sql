@@ -0,0 +1,8 @@
+-- no-transaction
+-- Keyset pagination over (created_at DESC, id DESC) for the feed, search and
+-- seller listings
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_feed_keyset_idx
+    ON product (created_at DESC, id DESC) WHERE is_removed = false;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_seller_keyset_idx
+    ON product (fab_user_id, created_at DESC, id DESC) WHERE is_removed = false;
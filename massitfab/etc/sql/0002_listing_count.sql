@@ -0,0 +1,21 @@
+-- Maintained totals for paginated listings, so they no longer need COUNT(*).
+-- scope is 'feed' (owner_id 0), 'seller' (owner_id = fab_user.id) or
+-- 'wishlist' (owner_id = fab_user.id).
+CREATE TABLE IF NOT EXISTS listing_count (
+    scope text NOT NULL,
+    owner_id bigint NOT NULL DEFAULT 0,
+    total bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (scope, owner_id)
+);
+
+INSERT INTO listing_count (scope, owner_id, total)
+    SELECT 'feed', 0, COUNT(*) FROM product WHERE is_removed = false
+ON CONFLICT (scope, owner_id) DO UPDATE SET total = EXCLUDED.total;
+
+INSERT INTO listing_count (scope, owner_id, total)
+    SELECT 'seller', fab_user_id, COUNT(*) FROM product WHERE is_removed = false GROUP BY fab_user_id
+ON CONFLICT (scope, owner_id) DO UPDATE SET total = EXCLUDED.total;
+
+INSERT INTO listing_count (scope, owner_id, total)
+    SELECT 'wishlist', fab_user_id, COUNT(*) FROM wishlist GROUP BY fab_user_id
+ON CONFLICT (scope, owner_id) DO UPDATE SET total = EXCLUDED.total;
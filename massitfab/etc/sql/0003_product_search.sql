@@ -0,0 +1,24 @@
+-- Full-text document over title, hashtags and description, kept up to date by
+-- a trigger. Existing rows are filled in by `manage.py backfillsearch`.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+CREATE OR REPLACE FUNCTION product_search_document(title text, hashtags text, description text)
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+           setweight(to_tsvector('simple', coalesce(hashtags, '')), 'B') ||
+           setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION product_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := product_search_document(NEW.title, NEW.hashtags::text, NEW.description);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS product_search_vector_trg ON product;
+CREATE TRIGGER product_search_vector_trg
+    BEFORE INSERT OR UPDATE OF title, hashtags, description ON product
+    FOR EACH ROW EXECUTE FUNCTION product_search_vector_update();
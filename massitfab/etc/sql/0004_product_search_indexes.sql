@@ -0,0 +1,8 @@
+-- no-transaction
+-- Ranked full-text matches, plus trigram matching on titles for substring and
+-- typo tolerant fallback searches
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_search_vector_idx
+    ON product USING gin (search_vector) WHERE is_removed = false;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_title_trgm_idx
+    ON product USING gin (title gin_trgm_ops) WHERE is_removed = false;
@@ -0,0 +1,8 @@
+-- Card projection: the banner listings show is stored on the product row and
+-- kept in sync by create_product/update_product, so list queries no longer
+-- join and aggregate gallery. NULL means the product has no gallery yet.
+ALTER TABLE product ADD COLUMN IF NOT EXISTS banner text;
+
+UPDATE product p SET banner = g.banner
+FROM (SELECT product_id, MIN(resource) AS banner FROM gallery GROUP BY product_id) g
+WHERE p.id = g.product_id AND p.banner IS DISTINCT FROM g.banner;
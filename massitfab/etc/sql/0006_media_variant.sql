@@ -0,0 +1,10 @@
+-- Output of the image pipeline, keyed by the stored upload path
+-- (gallery.resource or fab_user.profile_picture)
+CREATE TABLE IF NOT EXISTS media_variant (
+    resource text PRIMARY KEY,
+    variants jsonb NOT NULL,
+    placeholder text,
+    width integer,
+    height integer,
+    processed_at timestamp NOT NULL DEFAULT now()
+);
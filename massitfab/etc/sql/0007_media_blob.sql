@@ -0,0 +1,9 @@
+-- Content-addressed uploads: one row per distinct blob, counting the gallery
+-- rows and profile pictures that reference it
+CREATE TABLE IF NOT EXISTS media_blob (
+    digest char(64) PRIMARY KEY,
+    resource text NOT NULL UNIQUE,
+    size bigint NOT NULL,
+    refcount integer NOT NULL DEFAULT 0,
+    created_at timestamp NOT NULL DEFAULT now()
+);
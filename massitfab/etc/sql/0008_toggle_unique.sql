@@ -0,0 +1,25 @@
+-- One wishlist row per user and product, and at most one cart row per user
+-- and product still in the cart, so the toggles can rely on ON CONFLICT.
+-- Runs in one transaction with writes blocked, so no duplicate can slip in
+-- between the clean-up and the index build.
+LOCK TABLE wishlist, customer IN SHARE ROW EXCLUSIVE MODE;
+
+DELETE FROM wishlist w
+    USING wishlist d
+    WHERE w.fab_user_id = d.fab_user_id AND w.product_id = d.product_id AND w.id > d.id;
+
+DELETE FROM customer c
+    USING customer d
+    WHERE c.fab_user_id = d.fab_user_id AND c.product_id = d.product_id
+        AND c.in_cart = true AND d.in_cart = true AND c.id > d.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS wishlist_user_product_key
+    ON wishlist (fab_user_id, product_id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS customer_cart_user_product_key
+    ON customer (fab_user_id, product_id) WHERE in_cart = true;
+
+-- The removed duplicates were counted in the wishlist totals
+INSERT INTO listing_count (scope, owner_id, total)
+    SELECT 'wishlist', fab_user_id, COUNT(*) FROM wishlist GROUP BY fab_user_id
+ON CONFLICT (scope, owner_id) DO UPDATE SET total = EXCLUDED.total;
@@ -0,0 +1,12 @@
+-- Completed checkouts by idempotency key, so a retried request replays the
+-- first result instead of buying again. Keys are scoped to the buyer.
+CREATE TABLE IF NOT EXISTS checkout_request (
+    fab_user_id bigint NOT NULL,
+    idempotency_key text NOT NULL,
+    status smallint,
+    response jsonb,
+    created_at timestamp NOT NULL DEFAULT now(),
+    PRIMARY KEY (fab_user_id, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS checkout_request_created_idx ON checkout_request (created_at);
@@ -0,0 +1,13 @@
+-- Rating summary per product, maintained by create_review and delete_review
+-- so detail pages and cards never aggregate review. score_1..score_5 is the
+-- histogram. Fill it with manage.py reviewsummary after applying this file.
+CREATE TABLE IF NOT EXISTS review_summary (
+    product_id bigint PRIMARY KEY REFERENCES product (id) ON DELETE CASCADE,
+    review_count integer NOT NULL DEFAULT 0,
+    score_sum bigint NOT NULL DEFAULT 0,
+    score_1 integer NOT NULL DEFAULT 0,
+    score_2 integer NOT NULL DEFAULT 0,
+    score_3 integer NOT NULL DEFAULT 0,
+    score_4 integer NOT NULL DEFAULT 0,
+    score_5 integer NOT NULL DEFAULT 0
+);
@@ -0,0 +1,191 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+# ==============================================================================
+# BACKGROUND LOG WRITER
+# ==============================================================================
+
+
+class LogWriter:
+    """Queues rows for the ``logs`` table and writes them from a background thread.
+
+    Records are flushed as one multi-row INSERT once ``batch_size`` rows are
+    waiting or ``flush_interval`` seconds have passed. When the queue is full
+    the ``policy`` decides what happens: ``drop_newest`` discards the incoming
+    record, ``drop_oldest`` makes room by discarding the oldest queued one and
+    ``block`` waits up to ``block_timeout`` seconds before dropping. A batch
+    the database rejects is retried one row at a time, so only the bad rows
+    are lost.
+    """
+
+    POLICIES = ('drop_newest', 'drop_oldest', 'block')
+
+    def __init__(self, pool, max_queue=10000, batch_size=200, flush_interval=1.0,
+                 policy='drop_newest', block_timeout=0.05):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown log queue policy: %s' % policy)
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._counters = {
+            'queued': 0,
+            'written': 0,
+            'dropped': 0,
+            'failed': 0,
+            'batches': 0,
+        }
+
+    def write(self, action, note, request, details):
+        self._ensure_started()
+        record = (action, note, _as_text(request), _as_text(details))
+        try:
+            if self.policy == 'block':
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self._count('dropped')
+            if self.policy == 'drop_oldest':
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self._queue.put_nowait(record)
+                    self._count('queued')
+                    return True
+                except (queue.Empty, queue.Full):
+                    pass
+            return False
+        self._count('queued')
+        return True
+
+    def flush(self, timeout=5.0):
+        # Block until everything queued so far has been written
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stop(self, timeout=5.0):
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+    def _count(self, name, value=1):
+        # Request threads and the writer thread both count
+        with self._lock:
+            self._counters[name] += value
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # Fresh worker process: the parent's thread did not survive the fork
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='massitfab-logwriter', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch:
+                self._write_batch(batch)
+            elif self._stopping.is_set():
+                return
+
+    def _collect(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if self._stopping.is_set():
+                # Draining: take what is there without waiting
+                remaining = 0
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch):
+        conn = None
+        left = len(batch)
+        try:
+            conn = self.pool.getconn()
+            cur = conn.cursor()
+            try:
+                execute_values(
+                    cur,
+                    "INSERT INTO logs (action, note, request, details) VALUES %s",
+                    batch,
+                    page_size=self.batch_size
+                )
+                conn.commit()
+                self._count('written', len(batch))
+                self._count('batches')
+                left = 0
+                return
+            except Exception as error:
+                # One bad row (invalid JSON, a NUL byte) fails the whole
+                # statement: retry row by row so only that row is lost
+                conn.rollback()
+                print('Logging batch failed, retrying row by row: ' + str(error))
+            for record in batch:
+                try:
+                    cur.execute(
+                        "INSERT INTO logs (action, note, request, details) VALUES (%s, %s, %s, %s)", record)
+                    conn.commit()
+                    self._count('written')
+                except Exception as error:
+                    conn.rollback()
+                    self._count('failed')
+                    print('Logging failed for %s: %s' % (record[0], error))
+                left -= 1
+        except Exception as error:
+            print('Logging failed: ' + str(error))
+        finally:
+            if left:
+                self._count('failed', left)
+            if conn is not None:
+                self.pool.putconn(conn)
+            for _ in batch:
+                self._queue.task_done()
+
+
+def _as_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+
+def install(writer):
+    # Drain whatever is still queued when the worker shuts down
+    atexit.register(writer.stop)
+    return writer
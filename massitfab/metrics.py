@@ -0,0 +1,279 @@
+import atexit
+import bisect
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import HttpResponse
+
+# ==============================================================================
+# METRICS
+# ==============================================================================
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Hit ratios derived from the merged counters, not averaged across workers
+RATIOS = ('massitfab_response_cache', 'massitfab_token_cache', 'massitfab_user_card_cache')
+
+
+class Metrics:
+    """Counters and histograms kept in process, exposed in Prometheus format.
+
+    Recording only touches in-memory dicts. With a ``directory``, a background
+    thread writes this worker's snapshot to ``metrics-<pid>.json`` every
+    ``flush_interval`` seconds, and ``render()`` merges the snapshots of all
+    workers: counters and histograms are summed, including those of workers
+    that have exited; gauges are summed over live workers only. Clear the
+    directory when the whole service restarts.
+    """
+
+    def __init__(self, directory='', flush_interval=5.0, buckets=BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._help = {}
+        self._pid = None
+        self._thread = None
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        self._ensure_started()
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        self._ensure_started()
+        key = (name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += value
+
+    def collect(self, prefix, stats, gauges=()):
+        """Export a ``stats()`` dict at scrape time.
+
+        Keys listed in ``gauges`` become gauges, every other number becomes a
+        counter named ``<prefix>_<key>_total``. Ratios are left out; they are
+        derived again after merging.
+        """
+        self._collectors.append((prefix, stats, frozenset(gauges)))
+
+    def snapshot(self):
+        counters = []
+        gauges = []
+        for prefix, stats, gauge_keys in self._collectors:
+            try:
+                values = stats()
+            except Exception:
+                continue
+            for key, value in values.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool) or key.endswith('ratio'):
+                    continue
+                if key in gauge_keys:
+                    gauges.append(['%s_%s' % (prefix, key), [], value])
+                else:
+                    counters.append(['%s_%s_total' % (prefix, key), [], value])
+        with self._lock:
+            counters += [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), list(counts), total]
+                          for (name, labels), (counts, total) in self._histograms.items()]
+        return {
+            'pid': os.getpid(),
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': histograms,
+        }
+
+    def render(self):
+        counters, gauges, histograms = {}, {}, {}
+        for snapshot in self._snapshots():
+            live = snapshot['live']
+            for name, labels, value in snapshot['counters']:
+                key = (name, _labels(labels))
+                counters[key] = counters.get(key, 0) + value
+            if live:
+                for name, labels, value in snapshot['gauges']:
+                    key = (name, _labels(labels))
+                    gauges[key] = gauges.get(key, 0) + value
+            for name, labels, counts, total in snapshot['histograms']:
+                key = (name, _labels(labels))
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+
+        for prefix in RATIOS:
+            hits = counters.get(('%s_hits_total' % prefix, ()), 0)
+            misses = counters.get(('%s_misses_total' % prefix, ()), 0)
+            gauges[('%s_hit_ratio' % prefix, ())] = hits / (hits + misses) if hits + misses else 0.0
+
+        lines = []
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines += self._header(name, kind)
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append('%s%s %s' % (name, _format(labels), _number(value)))
+        for name in sorted({name for name, _ in histograms}):
+            lines += self._header(name, 'histogram')
+            for (metric, labels), (counts, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %s' % (name, _format(labels + (('le', le),)), cumulative))
+                lines.append('%s_sum%s %s' % (name, _format(labels), _number(total)))
+                lines.append('%s_count%s %s' % (name, _format(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Write then rename, so a scrape never reads half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as output:
+            json.dump(self.snapshot(), output)
+        os.replace(tmp, os.path.join(self.directory, 'metrics-%d.json' % os.getpid()))
+
+    def _header(self, name, kind):
+        kind, text = self._help.get(name, (kind, None))
+        lines = ['# HELP %s %s' % (name, text)] if text else []
+        lines.append('# TYPE %s %s' % (name, kind))
+        return lines
+
+    def _snapshots(self):
+        own = self.snapshot()
+        own['live'] = True
+        yield own
+        if not self.directory:
+            return
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            try:
+                with open(path) as source:
+                    snapshot = json.load(source)
+            except (OSError, ValueError):
+                continue
+            if snapshot['pid'] == own['pid']:
+                continue
+            snapshot['live'] = _alive(snapshot['pid'])
+            yield snapshot
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Fresh worker process: start from zero and flush from our own thread
+            self._pid = os.getpid()
+            self._counters = {}
+            self._histograms = {}
+            if self.directory:
+                self._thread = threading.Thread(target=self._run, name='massitfab-metrics', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as error:
+                print('Metrics flush failed: ' + str(error))
+
+
+def install(metrics):
+    metrics.describe('massitfab_http_requests_total', 'counter', 'Requests by route, method and status')
+    metrics.describe('massitfab_http_request_duration_seconds', 'histogram', 'Request latency by route')
+    metrics.describe('massitfab_upload_bytes_total', 'counter', 'Multipart request bytes by route')
+    # Keep what this worker counted since the last flush
+    atexit.register(metrics.flush)
+    return metrics
+
+
+class MetricsMiddleware:
+    # Requests, latency and upload bytes per route; sync and async without a thread hop
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        from massitfab.settings import METRICS
+
+        self.metrics = METRICS
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - started)
+        return response
+
+    def _record(self, request, response, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        # View names, never raw paths, so ids in URLs cannot blow up the label set
+        route = match.view_name if match is not None else 'unmatched'
+        self.metrics.inc('massitfab_http_requests_total',
+                         (('route', route), ('method', request.method), ('status', str(response.status_code))))
+        self.metrics.observe('massitfab_http_request_duration_seconds', (('route', route),), elapsed)
+        if request.content_type == 'multipart/form-data':
+            size = int(request.META.get('CONTENT_LENGTH') or 0)
+            self.metrics.inc('massitfab_upload_bytes_total', (('route', route),), size)
+
+
+def exposition(request):
+    from massitfab.settings import METRICS, METRICS_TOKEN
+
+    if METRICS_TOKEN and request.headers.get('Authorization') != 'Bearer ' + METRICS_TOKEN:
+        return HttpResponse(status=401)
+    return HttpResponse(METRICS.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _labels(pairs):
+    return tuple(tuple(pair) for pair in pairs)
+
+
+def _format(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                             for name, value in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
@@ -0,0 +1,10 @@
+from rest_framework.renderers import JSONRenderer
+
+from massitfab import timing
+
+
+class TimedJSONRenderer(JSONRenderer):
+    # Reported as the serialize part of the Server-Timing header
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timing.serializing():
+            return super().render(data, accepted_media_type, renderer_context)
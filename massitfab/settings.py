@@ -4,6 +4,7 @@ import environ
 import psycopg2 as ps
 import hashlib
 import jwt
+from massitfab import db, adb, logwriter, cache, metrics, statements, timing, tokens, usercards
 
 # ==============================================================================
 # TYPE SAFETY START POINT
@@ -43,6 +44,79 @@ params = {
     'port': env('DATABASE_PORT'),
 }
 
+# Every request leases a single pooled connection that the view, log_error and
+# the auth backend share; it goes back to the pool on request_finished.
+DATABASE_POOL = {
+    'min_size': env.int('DATABASE_POOL_MIN', default=0),
+    'max_size': env.int('DATABASE_POOL_MAX', default=10),
+    'max_lifetime': env.int('DATABASE_POOL_MAX_LIFETIME', default=1800),
+    'max_idle': env.int('DATABASE_POOL_MAX_IDLE', default=300),
+    'check_after': env.int('DATABASE_POOL_CHECK_AFTER', default=30),
+    'acquire_timeout': env.float('DATABASE_POOL_TIMEOUT', default=5.0),
+}
+
+# Separate psycopg 3 pool for the async read views served under ASGI
+ASYNC_DATABASE_POOL = {
+    'min_size': env.int('ASYNC_DATABASE_POOL_MIN', default=1),
+    'max_size': env.int('ASYNC_DATABASE_POOL_MAX', default=20),
+    'max_lifetime': env.int('DATABASE_POOL_MAX_LIFETIME', default=1800),
+    'max_idle': env.int('DATABASE_POOL_MAX_IDLE', default=300),
+    'acquire_timeout': env.float('DATABASE_POOL_TIMEOUT', default=5.0),
+}
+
+# log_error only queues the row; a background thread writes them in batches
+LOG_WRITER = {
+    'max_queue': env.int('LOG_QUEUE_SIZE', default=10000),
+    'batch_size': env.int('LOG_BATCH_SIZE', default=200),
+    'flush_interval': env.float('LOG_FLUSH_INTERVAL', default=1.0),
+    'policy': env('LOG_QUEUE_POLICY', default='drop_newest'),
+}
+
+# Seconds get_categories serves its cached tree before rebuilding it
+CATEGORY_CACHE_TTL = env.int('CATEGORY_CACHE_TTL', default=300)
+
+# search_products stops counting matches here and reports total_capped instead
+SEARCH_COUNT_CAP = env.int('SEARCH_COUNT_CAP', default=1000)
+
+# Anonymous GET responses cached per worker, purged by tag from the write views
+RESPONSE_CACHE = {
+    'max_entries': env.int('RESPONSE_CACHE_ENTRIES', default=1000),
+    'ttl': env.int('RESPONSE_CACHE_TTL', default=30),
+    'enabled': env.bool('RESPONSE_CACHE_ENABLED', default=True),
+}
+
+# Worker processes generating image variants after upload
+IMAGE_WORKERS = env.int('IMAGE_WORKERS', default=2)
+
+# Verified access tokens kept per worker until they expire
+TOKEN_CACHE = {
+    'max_entries': env.int('TOKEN_CACHE_ENTRIES', default=10000),
+    'max_ttl': env.int('TOKEN_CACHE_TTL', default=300),
+    'enabled': env.bool('TOKEN_CACHE_ENABLED', default=True),
+}
+
+# Public user cards (username, avatar) shown next to reviews, per worker
+USER_CARD_CACHE = {
+    'max_entries': env.int('USER_CARD_CACHE_ENTRIES', default=5000),
+    'ttl': env.int('USER_CARD_CACHE_TTL', default=300),
+    'enabled': env.bool('USER_CARD_CACHE_ENABLED', default=True),
+}
+
+# Statements slower than this go to the slow-query log, sampled
+SLOW_QUERY_LOG = {
+    'threshold_ms': env.float('SLOW_QUERY_MS', default=200.0),
+    'sample_rate': env.float('SLOW_QUERY_SAMPLE_RATE', default=1.0),
+    'max_statements': env.int('SLOW_QUERY_STATEMENTS', default=200),
+}
+
+# Prometheus metrics; with a directory every worker process shares its counts through it
+METRICS_REGISTRY = {
+    'directory': env('METRICS_DIR', default=''),
+    'flush_interval': env.float('METRICS_FLUSH_INTERVAL', default=5.0),
+}
+# Bearer token required by /metrics when set
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
 # ==============================================================================
 # SECURITY SETTINGS
 # ==============================================================================
@@ -78,6 +152,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'massitfab.metrics.MetricsMiddleware',
+    'massitfab.timing.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -146,7 +222,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'massitfab.renderers.TimedJSONRenderer',
     ],
 }
 
@@ -175,13 +251,54 @@ CORS_ALLOW_CREDENTIALS = True
 # MASSITFAB ESSENTIALS
 # ==============================================================================
 
+POOL = db.ConnectionPool(params, **DATABASE_POOL)
+APOOL = adb.AsyncPool(params, **ASYNC_DATABASE_POOL)
+LOGS = logwriter.install(logwriter.LogWriter(POOL, **LOG_WRITER))
+RESPONSES = cache.ResponseCache(**RESPONSE_CACHE)
+TOKENS = tokens.TokenCache(**TOKEN_CACHE)
+USER_CARDS = usercards.UserCardCache(**USER_CARD_CACHE)
+STATEMENTS = statements.StatementRegistry()
+SLOW_QUERIES = timing.install(timing.SlowQueryLog(LOGS, **SLOW_QUERY_LOG))
+METRICS = metrics.install(metrics.Metrics(**METRICS_REGISTRY))
+METRICS.collect('massitfab_db_pool', POOL.stats, gauges=('size', 'idle', 'in_use', 'waiting', 'max_size'))
+METRICS.collect('massitfab_async_db_pool', APOOL.stats,
+                gauges=('size', 'max_size', 'pool_min', 'pool_max', 'pool_size', 'pool_available', 'requests_waiting'))
+METRICS.collect('massitfab_response_cache', RESPONSES.stats, gauges=('entries',))
+METRICS.collect('massitfab_token_cache', TOKENS.stats, gauges=('entries',))
+METRICS.collect('massitfab_user_card_cache', USER_CARDS.stats, gauges=('entries',))
+METRICS.collect('massitfab_log_writer', LOGS.stats, gauges=('pending',))
+
 def connectDB():
-    con = ps.connect(**params)
+    con = db.lease(POOL)
     return con
 
 def disconnectDB(con):
     if(con):
-        con.close()
+        db.release(con)
+
+def poolStats():
+    return POOL.stats()
+
+def apoolStats():
+    return APOOL.stats()
+
+def logStats():
+    return LOGS.stats()
+
+def cacheStats():
+    return RESPONSES.stats()
+
+def tokenStats():
+    return TOKENS.stats()
+
+def userCardStats():
+    return USER_CARDS.stats()
+
+def statementStats():
+    return STATEMENTS.stats()
+
+def slowQueryStats():
+    return SLOW_QUERIES.stats()
 
 def Merge(dict1, dict2):
     res = {**dict1, **dict2}
@@ -200,21 +317,31 @@ def verifyPassword(hashed_password, stored_password):
 
 def verifyToken(auth_header):
     if auth_header:
-        auth_token = auth_header.split(' ')[1]
-        try:
-            # Extract the id from the auth
-            payload = jwt.decode(auth_token, SECRET_KEY, algorithms=['HS256'])
-            resp = {
-                "user_id": payload['user_id'],
-                "status": 200
-            }
-            return resp
-        except jwt.exceptions.DecodeError:
-            resp = {
-                "error": "Invalid token",
-                "status": 401
-            }
-            return resp
+        auth_token = auth_header.split(' ')[-1]
+        # Signature already checked on an earlier request and not expired yet
+        payload = TOKENS.get(auth_token)
+        if payload is None:
+            try:
+                # Extract the id from the auth
+                payload = jwt.decode(auth_token, SECRET_KEY, algorithms=['HS256'])
+            except jwt.exceptions.ExpiredSignatureError:
+                resp = {
+                    "error": "Token expired",
+                    "status": 401
+                }
+                return resp
+            except jwt.exceptions.InvalidTokenError:
+                resp = {
+                    "error": "Invalid token",
+                    "status": 401
+                }
+                return resp
+            TOKENS.set(auth_token, payload, payload.get('exp'))
+        resp = {
+            "user_id": payload['user_id'],
+            "status": 200
+        }
+        return resp
     else:
         resp = {
                 "error": "Authorization header missing",
@@ -223,18 +350,5 @@ def verifyToken(auth_header):
         return resp
     
 def log_error(function_name, payload_req, error_message):
-    conn = None
-    try:
-        conn = connectDB()
-        cur = conn.cursor()
-        cur.execute(
-            """INSERT INTO logs (action, note, request, details) 
-                VALUES (%s, %s, %s, %s)""", 
-            (function_name, 'error', payload_req, error_message)
-        )
-        conn.commit()
-    except Exception as error:
-        print('Logging failed: ' + str(error))
-    finally:
-        if conn is not None:
-            disconnectDB(conn)
\ No newline at end of file
+    # Never waits on the logs table; the row is written by the background writer
+    LOGS.write(function_name, 'error', payload_req, error_message)
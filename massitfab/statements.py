@@ -0,0 +1,91 @@
+import hashlib
+import threading
+import time
+
+from massitfab import db
+
+# ==============================================================================
+# PREPARED STATEMENT REGISTRY
+# ==============================================================================
+
+
+class StatementRegistry:
+    """Named SQL statements executed as server-side prepared statements.
+
+    Modules register their hot statements once at import time and execute
+    them by name. A pooled connection prepares a statement the first time it
+    runs it (see ``db.execute_prepared``), so Postgres parses and plans each
+    one once per session instead of on every call. Calls, prepares and
+    execution time are counted per statement.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sql = {}
+        self._stats = {}
+
+    def register(self, name, sql):
+        # Returns the name, so modules can keep it in a constant
+        with self._lock:
+            if self._sql.get(name, sql) != sql:
+                raise ValueError('Statement %r is already registered with different SQL' % name)
+            self._sql[name] = sql
+            self._stats.setdefault(name, {
+                'calls': 0,
+                'prepares': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+            })
+        return name
+
+    def named(self, prefix, sql):
+        # Name for SQL assembled at runtime from a fixed set of fragments
+        name = '%s_%s' % (prefix, hashlib.sha1(sql.encode()).hexdigest()[:8])
+        if name not in self._sql:
+            self.register(name, sql)
+        return name
+
+    def sql(self, name):
+        return self._sql[name]
+
+    def execute(self, cur, name, params=()):
+        sql = self._sql[name]
+        started = time.perf_counter()
+        try:
+            prepared = db.execute_prepared(cur, name, sql, params)
+        finally:
+            # Once per call and under the statement's own SQL, not PREPARE / EXECUTE
+            db.record(sql, (time.perf_counter() - started) * 1000)
+        self._record(name, started, prepared)
+
+    async def aexecute(self, cur, name, params=()):
+        # psycopg 3 async cursor: the driver prepares it per connection itself
+        sql = self._sql[name]
+        started = time.perf_counter()
+        try:
+            await cur.execute(sql, params, prepare=True)
+        finally:
+            db.record(sql, (time.perf_counter() - started) * 1000)
+        self._record(name, started, False)
+
+    def run(self, cur, prefix, sql, params=()):
+        self.execute(cur, self.named(prefix, sql), params)
+
+    async def arun(self, cur, prefix, sql, params=()):
+        await self.aexecute(cur, self.named(prefix, sql), params)
+
+    def stats(self):
+        with self._lock:
+            stats = {name: dict(values) for name, values in self._stats.items()}
+        for values in stats.values():
+            values['mean_ms'] = values['total_ms'] / values['calls'] if values['calls'] else 0.0
+        return stats
+
+    def _record(self, name, started, prepared):
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            stats = self._stats[name]
+            stats['calls'] += 1
+            stats['prepares'] += prepared
+            stats['total_ms'] += elapsed
+            stats['max_ms'] = max(stats['max_ms'], elapsed)
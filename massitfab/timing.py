@@ -0,0 +1,198 @@
+import contextlib
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.local import Local
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+# ==============================================================================
+# REQUEST TIMING
+# ==============================================================================
+
+# Every statement sent through a pooled cursor (or a registered statement on the
+# async pool) is counted and timed against the request it runs in. The
+# middleware turns the totals into a Server-Timing header, and statements over
+# the threshold go to the slow-query log.
+
+_request = Local()
+_slow = None
+
+
+class _Timer:
+    __slots__ = ('request', 'started', 'statements', 'db_ms', 'serialize_ms')
+
+    def __init__(self, request):
+        self.request = request
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_ms = 0.0
+        self.serialize_ms = 0.0
+
+    def endpoint(self):
+        # Resolved by the time the view runs; the path is the fallback before that
+        match = getattr(self.request, 'resolver_match', None)
+        return match.view_name if match is not None else self.request.path
+
+
+def install(slow_log):
+    global _slow
+    _slow = slow_log
+    return slow_log
+
+
+def current():
+    return getattr(_request, 'timer', None)
+
+
+def record(sql, elapsed_ms):
+    # The timer is shared by reference, so sync_to_async threads update the same one
+    timer = current()
+    if timer is None:
+        return
+    timer.statements += 1
+    timer.db_ms += elapsed_ms
+    if _slow is not None and elapsed_ms >= _slow.threshold_ms:
+        _slow.record(sql, elapsed_ms, timer.endpoint())
+
+
+@contextlib.contextmanager
+def serializing():
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = current()
+        if timer is not None:
+            timer.serialize_ms += (time.perf_counter() - started) * 1000
+
+
+class ServerTimingMiddleware:
+    """Adds a Server-Timing header with the db / serialize / app split.
+
+    Goes first in MIDDLEWARE so ``total`` covers the whole stack. Works in
+    both modes without a thread hop, so it does not undo the async views.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = self._begin(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.timer = None
+        return self._finish(timer, response)
+
+    async def __acall__(self, request):
+        timer = self._begin(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request.timer = None
+        return self._finish(timer, response)
+
+    def _begin(self, request):
+        timer = _Timer(request)
+        _request.timer = timer
+        return timer
+
+    def _finish(self, timer, response):
+        total = (time.perf_counter() - timer.started) * 1000
+        app = max(0.0, total - timer.db_ms - timer.serialize_ms)
+        response['Server-Timing'] = (
+            'db;dur=%.1f;desc="%d queries", serialize;dur=%.1f, app;dur=%.1f, total;dur=%.1f' % (
+                timer.db_ms, timer.statements, timer.serialize_ms, app, total))
+        return response
+
+
+# ==============================================================================
+# SLOW-QUERY LOG
+# ==============================================================================
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w$])-?\d+(?:\.\d+)?\b')
+_PARAM = re.compile(r'%s|\$\d+')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_ROWS = re.compile(r'\(\?\.\.\.\)(?:\s*,\s*\(\?(?:\.\.\.)?\))+')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize(sql):
+    # Literals and placeholders become ?, so every call of a statement groups together
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    elif not isinstance(sql, str):
+        sql = str(sql)
+    sql = _STRING.sub('?', sql)
+    sql = _PARAM.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _LIST.sub('(?...)', sql)
+    sql = _ROWS.sub('(?...), ...', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class SlowQueryLog:
+    """Statements slower than ``threshold_ms``, per normalized SQL.
+
+    Every slow statement is counted; ``sample_rate`` of them are also written
+    to the logs table through the background log writer, with the endpoint
+    that ran them. At most ``max_statements`` distinct statements are tracked,
+    the least recently seen one is dropped first.
+    """
+
+    def __init__(self, writer, threshold_ms=200.0, sample_rate=1.0, max_statements=200):
+        self.writer = writer
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._statements = OrderedDict()
+        self._counters = {'slow': 0, 'logged': 0}
+
+    def record(self, sql, elapsed_ms, endpoint):
+        statement = normalize(sql)
+        with self._lock:
+            self._counters['slow'] += 1
+            stats = self._statements.pop(statement, None)
+            if stats is None:
+                stats = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'endpoints': set()}
+                if len(self._statements) >= self.max_statements:
+                    self._statements.popitem(last=False)
+            stats['calls'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['endpoints'].add(endpoint)
+            self._statements[statement] = stats
+            sampled = random.random() < self.sample_rate
+            if sampled:
+                self._counters['logged'] += 1
+        if sampled:
+            self.writer.write('slow_query', 'slow', json.dumps({
+                'endpoint': endpoint,
+                'ms': round(elapsed_ms, 1),
+            }), statement)
+
+    def stats(self):
+        with self._lock:
+            statements = [
+                dict(values, sql=sql, endpoints=sorted(values['endpoints']))
+                for sql, values in self._statements.items()
+            ]
+            counters = dict(self._counters)
+        statements.sort(key=lambda values: values['total_ms'], reverse=True)
+        counters['threshold_ms'] = self.threshold_ms
+        counters['sample_rate'] = self.sample_rate
+        counters['statements'] = statements
+        return counters
@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+
+# ==============================================================================
+# VERIFIED TOKEN CACHE
+# ==============================================================================
+
+
+class TokenCache:
+    """Bounded LRU of tokens whose signature has already been checked.
+
+    A client sends the same access token on every request until it expires,
+    so the decoded claims are kept until the token's ``exp`` (but never longer
+    than ``max_ttl`` seconds) and looked up by the raw token. Only tokens that
+    verified are stored; bad ones are decoded, and rejected, every time.
+    """
+
+    def __init__(self, max_entries=10000, max_ttl=300, enabled=True):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            value, expires = entry
+            if expires <= now:
+                del self._entries[key]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return value
+
+    def set(self, key, value, exp=None):
+        # exp is the token's own expiry claim (seconds since the epoch)
+        if not self.enabled:
+            return
+        expires = time.time() + self.max_ttl
+        if exp is not None:
+            expires = min(expires, exp)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
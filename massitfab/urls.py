@@ -3,6 +3,8 @@ from django.urls import path, include
 from django.conf.urls.static import static
 from django.conf import settings
 
+from massitfab.metrics import exposition
+
 # from rest_framework_simplejwt.views import (
 #     TokenObtainPairView,
 #     TokenRefreshView,
@@ -11,6 +13,7 @@ from django.conf import settings
 urlpatterns = [
     path('auth/', include('massitfab_auth.urls', namespace='mfAuth')),
     path('api/', include('massitfab_api.urls', namespace='mfApi')),
+    path('metrics', exposition, name='metrics'),
     path('', include('maesitfab_app.urls', namespace='mfApp')),
 
     # path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
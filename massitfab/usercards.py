@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+# ==============================================================================
+# USER CARD CACHE
+# ==============================================================================
+
+
+class UserCardCache:
+    """Bounded LRU of public user cards (username, avatar) keyed by user id.
+
+    ``lookup()`` answers a whole page of ids at once and reports the ones to
+    read from the database; ``fill()`` stores what was read. ``invalidate()``
+    drops a user's card after a profile change. A read that started before
+    the change may not store its (stale) cards afterwards: ``fill()`` ignores
+    cards read under an older generation. The cache is per worker process, so
+    other workers see the change once their copy expires after ``ttl``.
+    """
+
+    def __init__(self, max_entries=5000, ttl=300, enabled=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def lookup(self, ids):
+        # Returns ({id: card}, [ids to read], generation to pass to fill())
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generation
+            for user_id in dict.fromkeys(ids):
+                entry = self._entries.get(user_id) if self.enabled else None
+                if entry is not None and entry[1] <= now:
+                    del self._entries[user_id]
+                    self._counters['expirations'] += 1
+                    entry = None
+                if entry is None:
+                    self._counters['misses'] += 1
+                    missing.append(user_id)
+                    continue
+                self._entries.move_to_end(user_id)
+                self._counters['hits'] += 1
+                found[user_id] = entry[0]
+        return found, missing, generation
+
+    def fill(self, cards, generation):
+        if not self.enabled:
+            return
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if generation != self._generation:
+                return
+            for user_id, card in cards.items():
+                self._entries[user_id] = (card, expires)
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+            self._counters['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,242 @@
+# Third party libraries
+import functools
+import json
+import math
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
+from rest_framework import status
+from rest_framework.utils.encoders import JSONEncoder
+
+# Local Imports
+from massitfab.settings import log_error, RESPONSES, APOOL, STATEMENTS
+from massitfab import timing
+from massitfab.cache import cached_response, tag
+from .pagination import InvalidCursor, wants_cursor, decode_cursor, seek_clause, cursor_page, offset_page, parse_page_size
+from . import counts, membership, reads, search
+from .views import CATEGORIES
+
+# ==============================================================================
+# ASYNC READ VIEWS
+# ==============================================================================
+
+# Async twins of the hot read endpoints. Under ASGI they run on the event loop
+# and wait on Postgres through APOOL (psycopg 3) without holding a thread, so a
+# slow query no longer pins a worker thread. They return exactly what the sync
+# views return, and share the same response cache and category tree.
+
+
+def _get_only(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return HttpResponseNotAllowed(['GET'])
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def _respond(data, status=status.HTTP_200_OK):
+    # Same encoding DRF's JSONRenderer produces
+    with timing.serializing():
+        return JsonResponse(data, status=status, encoder=JSONEncoder,
+                            json_dumps_params={'ensure_ascii': False, 'separators': (',', ':')})
+
+
+def _failed(function_name, payload, error, message='Уучлаарай, үйлдлийг гүйцэтгэхэд алдаа гарлаа.'):
+    log_error(function_name, json.dumps(payload), str(error))
+    return _respond({'message': message}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@_get_only
+@cached_response(RESPONSES)
+async def get_products(request):
+    inline = membership.wants_inline(request.GET)
+    if inline:
+        user_id, auth = membership.authorize(request)
+        if user_id is None:
+            return _respond({'message': auth.get('error')}, status=status.HTTP_401_UNAUTHORIZED)
+    try:
+        page = int(request.GET.get('page', 1))
+        page_size = parse_page_size(request.GET)
+        offset = (page - 1) * page_size
+
+        async with APOOL.connection() as conn:
+            async with conn.cursor() as cur:
+                query = reads.LISTING_SQL
+                if wants_cursor(request.GET):
+                    seek, seek_params = seek_clause(decode_cursor(request.GET.get('cursor')))
+                    await STATEMENTS.arun(cur, 'feed', query + seek + """
+                    ORDER BY created_at DESC, p.id DESC
+                    LIMIT %s""", seek_params + [page_size + 1])
+                    rows, pagination = cursor_page(await cur.fetchall(), page_size, reads.row_key)
+                else:
+                    await STATEMENTS.arun(cur, 'feed', query + """
+                    ORDER BY created_at DESC
+                    LIMIT %s OFFSET %s""", [page_size + 1, offset])
+                    rows, pagination = offset_page(await cur.fetchall(), page, page_size)
+
+                    if counts.wants_total(request.GET):
+                        total_count = await counts.aread(cur, counts.FEED)
+                        pagination['num_pages'] = math.ceil(total_count / page_size)
+                        pagination['total_count'] = total_count
+
+                if inline:
+                    inlined = await membership.alookup(cur, user_id, [row[0] for row in rows])
+
+        resp = {
+            'data': {
+                "products": [reads.feed_product(row) for row in rows],
+                'pagination': pagination
+            },
+            'message': 'Амжилттай!',
+        }
+        if inline:
+            resp['data']['membership'] = inlined
+        return tag(_respond(resp), 'feed')
+    except InvalidCursor as error:
+        return _respond({'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as error:
+        return _failed('aget_products', {'query': request.GET.dict()}, error)
+
+
+@_get_only
+@cached_response(RESPONSES)
+async def get_product_details(request, id):
+    try:
+        async with APOOL.connection() as conn:
+            async with conn.cursor() as cur:
+                await STATEMENTS.aexecute(cur, reads.PRODUCT_DETAIL, [id])
+                result = await cur.fetchone()
+                if result is None or result[11] != False:
+                    log_error('aget_product', json.dumps({'product_id': id}),
+                              'This product is removed or does not exist')
+                    return _respond({'message': 'Product does not exist'},
+                                    status=status.HTTP_404_NOT_FOUND)
+
+        resp = {
+            "data": reads.product_details(id, result),
+            "message": "Амжилттай!",
+        }
+        return tag(_respond(resp), 'product:%s' % id)
+    except Exception as error:
+        return _failed('aget_product', {'product_id': id}, error)
+
+
+@_get_only
+async def search_products(request):
+    keyword = str(request.GET.get('keyword', ''))
+    inline = membership.wants_inline(request.GET)
+    if inline:
+        user_id, auth = membership.authorize(request)
+        if user_id is None:
+            return _respond({'message': auth.get('error')}, status=status.HTTP_401_UNAUTHORIZED)
+    try:
+        page = int(request.GET.get('page', 1))
+        limit = parse_page_size(request.GET, 'limit')
+
+        mode = request.GET.get('match')
+        pinned = mode in search.MODES
+        if not pinned:
+            mode = search.initial_mode(keyword)
+        keyset = wants_cursor(request.GET)
+        after = decode_cursor(request.GET.get('cursor')) if keyset else None
+
+        async with APOOL.connection() as conn:
+            async with conn.cursor() as cur:
+                query = reads.LISTING_SQL
+                while True:
+                    match, match_params = search.match_clause(mode, keyword)
+                    if keyset:
+                        seek, seek_params = seek_clause(after)
+                        await STATEMENTS.arun(cur, 'search',
+                            query + match + seek + """
+                        ORDER BY created_at DESC, p.id DESC
+                        LIMIT %s""",
+                            match_params + seek_params + [limit + 1]
+                        )
+                        rows, pagination = cursor_page(await cur.fetchall(), limit, reads.row_key)
+                    else:
+                        rank, rank_params = search.rank_clause(mode, keyword)
+                        await STATEMENTS.arun(cur, 'search',
+                            query + match + """
+                        ORDER BY """ + rank + """created_at DESC
+                        LIMIT %s OFFSET %s""",
+                            match_params + rank_params + [limit + 1, (page-1)*limit]
+                        )
+                        rows, pagination = offset_page(await cur.fetchall(), page, limit)
+
+                    first_page = after is None if keyset else page == 1
+                    if rows or pinned or mode != search.FULLTEXT or not first_page:
+                        break
+                    mode = search.FUZZY
+
+                if not keyset and counts.wants_total(request.GET):
+                    total_count, capped = await counts.acapped_count(
+                        cur,
+                        "SELECT 1 FROM product WHERE is_removed = false" + match,
+                        match_params,
+                        settings.SEARCH_COUNT_CAP
+                    )
+                    pagination['num_pages'] = math.ceil(total_count / limit)
+                    pagination['total_count'] = total_count
+                    pagination['total_capped'] = capped
+
+                if inline:
+                    inlined = await membership.alookup(cur, user_id, [row[0] for row in rows])
+
+        resp = {
+            'data': {
+                'products': [reads.search_product(row) for row in rows],
+                'match': mode,
+                'pagination': pagination
+            },
+            'message': 'Амжилттай!'
+        }
+        if inline:
+            resp['data']['membership'] = inlined
+        return _respond(resp)
+    except InvalidCursor as error:
+        return _respond({'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as error:
+        return _failed('asearch_product', {'keyword': keyword, 'query': request.GET.dict()}, error)
+
+
+@_get_only
+@cached_response(RESPONSES)
+async def get_reviews(request, product_id):
+    try:
+        limit = int(request.GET.get('limit', 20))
+        cursor = int(request.GET.get('cursor', 0))
+
+        async with APOOL.connection() as conn:
+            async with conn.cursor() as cur:
+                await STATEMENTS.aexecute(cur, reads.REVIEWS, [product_id, cursor, limit])
+                rows = await cur.fetchall()
+                cards = await reads.areviewers(cur, rows)
+
+        resp = {
+            "data": reads.reviews_page(rows, cards),
+            "message": "Амжилттай!"
+        }
+        return tag(_respond(resp), 'reviews:%s' % product_id, *reads.reviewer_tags(rows))
+    except Exception as error:
+        return _failed('aget_reviews', {'product_id': product_id}, error, 'Дотоод алдаа!')
+
+
+@_get_only
+async def get_categories(request):
+    try:
+        # Serve the pre-encoded tree without touching the database
+        cached = CATEGORIES.cached()
+        if cached is None:
+            async with APOOL.connection() as conn:
+                cached = await CATEGORIES.arebuild(conn)
+        body, etag = cached
+
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        return response
+    except Exception as error:
+        return _failed('aget_categories', {}, error, 'Дотоод алдаа!')
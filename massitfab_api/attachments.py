@@ -0,0 +1,48 @@
+from psycopg2.extras import execute_values
+
+# ==============================================================================
+# PRODUCT ROUTES AND GALLERY
+# ==============================================================================
+
+# Each write below is one round trip however many rows it touches, so a
+# product with 30 images or links costs the same number of statements inside
+# the transaction as one with a single image.
+
+
+def add_routes(cur, product_id, sources):
+    if sources:
+        execute_values(
+            cur,
+            "INSERT INTO route (source, product_id) VALUES %s",
+            [(source, product_id) for source in sources],
+            page_size=len(sources)
+        )
+
+
+def remove_routes(cur, product_id, sources):
+    if sources:
+        cur.execute(
+            "DELETE FROM route WHERE product_id = %s AND source = ANY(%s)",
+            [product_id, list(sources)]
+        )
+
+
+def add_gallery(cur, product_id, resources):
+    if resources:
+        execute_values(
+            cur,
+            "INSERT INTO gallery (resource, product_id) VALUES %s",
+            [(resource, product_id) for resource in resources],
+            page_size=len(resources)
+        )
+
+
+def remove_gallery(cur, product_id, resources):
+    # Returns one resource per deleted row, i.e. per blob reference to release
+    if not resources:
+        return []
+    cur.execute(
+        "DELETE FROM gallery WHERE product_id = %s AND resource = ANY(%s) RETURNING resource",
+        [product_id, list(resources)]
+    )
+    return [row[0] for row in cur.fetchall()]
@@ -0,0 +1,14 @@
+# ==============================================================================
+# PRODUCT CARDS
+# ==============================================================================
+
+# Listings read product.banner instead of MIN(resource) over gallery. Any view
+# that changes a product's gallery refreshes it in the same transaction.
+
+
+def refresh_banner(cur, product_id):
+    cur.execute(
+        """UPDATE product SET banner = (SELECT MIN(resource) FROM gallery WHERE product_id = %s)
+            WHERE id = %s""",
+        [product_id, product_id]
+    )
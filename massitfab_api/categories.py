@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+import time
+
+# ==============================================================================
+# CATEGORY TREE CACHE
+# ==============================================================================
+
+# Categories with their subcategories folded into a {id: name} object, built
+# by Postgres in a single statement
+CATEGORY_TREE_SQL = """
+    SELECT c.*, (
+        SELECT COALESCE(json_object_agg(s.id, s.name ORDER BY s.id), '{}'::json)
+        FROM subcategory s WHERE s.category_id = c.id
+    ) AS subcategories
+    FROM category c
+    ORDER BY c.id
+"""
+
+
+class CategoryTree:
+    """Holds the encoded ``get_categories`` response in memory.
+
+    The body is built once by ``rebuild()`` and served as bytes from
+    ``cached()`` until ``invalidate()`` is called or ``ttl`` seconds have
+    passed. The ETag is the hash of the body alone, so a TTL rebuild that
+    produces the same JSON keeps it, and every worker process agrees on it.
+    ``version`` counts the rebuilds that changed the body.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.version = 0
+        self._etag = None
+        self._lock = threading.Lock()
+        self._entry = None
+
+    def cached(self):
+        entry = self._entry
+        if entry is not None and time.monotonic() < entry[2]:
+            return entry[0], entry[1]
+        return None
+
+    def rebuild(self, conn):
+        with self._lock:
+            # Another thread may have rebuilt it while we waited
+            cached = self.cached()
+            if cached is not None:
+                return cached
+            cur = conn.cursor()
+            cur.execute(CATEGORY_TREE_SQL)
+            return self._store(cur.fetchall())
+
+    async def arebuild(self, conn):
+        # rebuild() over a psycopg 3 async connection; the query runs unlocked
+        cached = self.cached()
+        if cached is not None:
+            return cached
+        async with conn.cursor() as cur:
+            await cur.execute(CATEGORY_TREE_SQL)
+            rows = await cur.fetchall()
+        with self._lock:
+            cached = self.cached()
+            if cached is not None:
+                return cached
+            return self._store(rows)
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = None
+
+    def _store(self, rows):
+        # Called with the lock held
+        body = self._encode(rows)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self._etag != etag:
+            self._etag = etag
+            self.version += 1
+        self._entry = (body, etag, time.monotonic() + self.ttl)
+        return body, etag
+
+    def _encode(self, rows):
+        categories = [
+            {
+                "id": row[0],
+                "category": row[1],
+                "subcategories": row[-1],
+            }
+            for row in rows
+        ]
+        resp = {
+            "data": {
+                "categories": categories,
+            },
+            "message": "Амжилттай!"
+        }
+        # Same encoding DRF's JSONRenderer produces
+        return json.dumps(resp, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
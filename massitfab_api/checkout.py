@@ -0,0 +1,82 @@
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from massitfab.settings import STATEMENTS
+
+# ==============================================================================
+# CHECKOUT
+# ==============================================================================
+
+# The cart -> bought transition and the debit happen in one statement. The
+# UPDATE of the cart rows locks them and re-checks in_cart, so a concurrent
+# checkout or cart toggle of the same buyer either waits or finds nothing left
+# to buy. The debit is computed from exactly the rows that moved, and it is
+# guarded by balance >= amount on the locked buyer row. When the guard fails
+# the caller rolls the whole transaction back. Only the buyer's own rows are
+# ever locked.
+
+MAX_KEY_LENGTH = 255
+
+# Parameters: user, user
+CHECKOUT_SQL = """
+    WITH bought AS (
+        UPDATE customer c SET in_cart = false, is_bought = true
+        FROM product p
+        WHERE c.fab_user_id = %s AND c.in_cart = true AND p.id = c.product_id
+        RETURNING p.st_price
+    ), total AS (
+        SELECT COALESCE(SUM(st_price), 0) AS amount, COUNT(*) AS items FROM bought
+    ), debited AS (
+        UPDATE fab_user u SET balance = u.balance - t.amount
+        FROM total t
+        WHERE u.id = %s AND u.balance >= t.amount
+        RETURNING u.balance
+    )
+    SELECT (SELECT balance FROM debited), t.amount, t.items FROM total t"""
+CHECKOUT = STATEMENTS.register('checkout', CHECKOUT_SQL)
+
+# A second request with the same key waits here until the first one commits
+# or rolls back
+CLAIM = STATEMENTS.register('checkout_claim', """
+    INSERT INTO checkout_request (fab_user_id, idempotency_key) VALUES (%s, %s)
+    ON CONFLICT (fab_user_id, idempotency_key) DO NOTHING
+    RETURNING 1""")
+REPLAY = STATEMENTS.register('checkout_replay', """
+    SELECT status, response FROM checkout_request WHERE fab_user_id = %s AND idempotency_key = %s""")
+RECORD = STATEMENTS.register('checkout_record', """
+    UPDATE checkout_request SET status = %s, response = %s
+    WHERE fab_user_id = %s AND idempotency_key = %s""")
+
+
+class InsufficientBalance(Exception):
+    pass
+
+
+def run(cur, user_id, key=None):
+    """Check out the buyer's cart inside the caller's transaction.
+
+    Returns (status, data, replayed). Raises InsufficientBalance when the cart
+    costs more than the balance; the caller must then roll back. Only
+    completed checkouts are recorded under ``key``, so a retry after a failed
+    one tries again.
+    """
+    if key is not None:
+        STATEMENTS.execute(cur, CLAIM, [user_id, key])
+        if cur.fetchone() is None:
+            STATEMENTS.execute(cur, REPLAY, [user_id, key])
+            status, data = cur.fetchone()
+            return status, data, True
+
+    STATEMENTS.execute(cur, CHECKOUT, [user_id, user_id])
+    balance, amount, items = cur.fetchone()
+    if balance is None:
+        raise InsufficientBalance(amount)
+
+    data = {
+        'balance': balance,
+        'bought_items': items,
+    }
+    if key is not None:
+        STATEMENTS.execute(cur, RECORD, [202, json.dumps(data, cls=JSONEncoder), user_id, key])
+    return 202, data, False
@@ -0,0 +1,72 @@
+from massitfab.settings import STATEMENTS
+
+# ==============================================================================
+# LISTING TOTALS
+# ==============================================================================
+
+# Totals live in listing_count and are bumped by the write views inside their
+# own transaction, so reading one is a primary key lookup instead of COUNT(*).
+# Every product write bumps the one feed row, so views bump right before their
+# commit to hold its row lock as briefly as possible.
+FEED = 'feed'
+SELLER = 'seller'
+WISHLIST = 'wishlist'
+
+
+def bump(cur, scope, owner_id, delta):
+    cur.execute(
+        """INSERT INTO listing_count (scope, owner_id, total) VALUES (%s, %s, %s)
+            ON CONFLICT (scope, owner_id) DO UPDATE SET total = listing_count.total + EXCLUDED.total""",
+        [scope, owner_id, delta]
+    )
+
+
+READ = STATEMENTS.register(
+    'listing_total', "SELECT total FROM listing_count WHERE scope = %s AND owner_id = %s")
+CAPPED_COUNT_SQL = "SELECT COUNT(*) FROM (%s LIMIT %%s) matches"
+
+
+def read(cur, scope, owner_id=0):
+    STATEMENTS.execute(cur, READ, [scope, owner_id])
+    row = cur.fetchone()
+    return max(row[0], 0) if row else 0
+
+
+async def aread(cur, scope, owner_id=0):
+    # read() on a psycopg 3 async cursor
+    await STATEMENTS.aexecute(cur, READ, [scope, owner_id])
+    row = await cur.fetchone()
+    return max(row[0], 0) if row else 0
+
+
+def capped_count(cur, query, params, cap):
+    # Counts at most cap matches; returns (count, whether the cap was hit)
+    STATEMENTS.run(cur, 'capped_count', CAPPED_COUNT_SQL % query, list(params) + [cap + 1])
+    total = cur.fetchone()[0]
+    return min(total, cap), total > cap
+
+
+async def acapped_count(cur, query, params, cap):
+    await STATEMENTS.arun(cur, 'capped_count', CAPPED_COUNT_SQL % query, list(params) + [cap + 1])
+    total = (await cur.fetchone())[0]
+    return min(total, cap), total > cap
+
+
+def rebuild(cur):
+    # Recompute every total from the source tables; writers wait meanwhile
+    cur.execute("LOCK TABLE listing_count IN EXCLUSIVE MODE")
+    cur.execute("DELETE FROM listing_count")
+    cur.execute(
+        """INSERT INTO listing_count (scope, owner_id, total)
+            SELECT %s, 0, COUNT(*) FROM product WHERE is_removed = false
+            UNION ALL
+            SELECT %s, fab_user_id, COUNT(*) FROM product WHERE is_removed = false GROUP BY fab_user_id
+            UNION ALL
+            SELECT %s, fab_user_id, COUNT(*) FROM wishlist GROUP BY fab_user_id""",
+        [FEED, SELLER, WISHLIST]
+    )
+
+
+def wants_total(query_params):
+    # ?total=false lets clients skip totals entirely
+    return str(query_params.get('total', 'true')).lower() not in ('0', 'false', 'no')
@@ -0,0 +1,185 @@
+import atexit
+import base64
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# ==============================================================================
+# IMAGE PIPELINE
+# ==============================================================================
+
+# Every uploaded image gets these widths (never upscaled), re-encoded as WebP
+# without metadata, plus a tiny inline placeholder for blur-up loading.
+VARIANTS = {
+    'thumb': 160,
+    'card': 480,
+    'full': 1280,
+}
+FORMAT = 'WEBP'
+EXTENSION = '.webp'
+QUALITY = 80
+PLACEHOLDER_WIDTH = 16
+
+
+def process_image(resource, out_dir):
+    """Write the variants of ``resource`` into ``out_dir``.
+
+    Runs inside a worker process. Returns what gets recorded in
+    media_variant: the variant paths, the placeholder data URI and the
+    original dimensions.
+    """
+    from PIL import Image, ImageOps
+
+    stem = variant_stem(resource)
+    os.makedirs(out_dir, exist_ok=True)
+    with Image.open(resource) as original:
+        # Apply the EXIF rotation before the metadata is dropped
+        image = ImageOps.exif_transpose(original)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        width, height = image.size
+
+        variants = {}
+        for name, target in VARIANTS.items():
+            resized = image.copy()
+            if resized.width > target:
+                resized.thumbnail((target, height), Image.LANCZOS)
+            path = os.path.join(out_dir, '%s-%s%s' % (stem, name, EXTENSION)).replace('\\', '/')
+            # Saved without exif/icc/xmp, so none of the upload's metadata survives
+            resized.save(path, FORMAT, quality=QUALITY, method=4)
+            variants[name] = path
+
+        tiny = image.copy()
+        tiny.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH), Image.BILINEAR)
+        buffer = io.BytesIO()
+        tiny.save(buffer, FORMAT, quality=30)
+        placeholder = 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+    return {
+        'variants': variants,
+        'placeholder': placeholder,
+        'width': width,
+        'height': height,
+    }
+
+
+def variant_stem(resource):
+    # Every variant shares out_dir, so the name is keyed on the whole resource
+    # path: public/img/a.png and public/img/a.jpg must not both become a-card.webp
+    path = resource.replace('\\', '/')
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return '%s-%s' % (stem, hashlib.sha1(path.encode()).hexdigest()[:12])
+
+
+def variant(variants, name, fallback):
+    # URL of one variant, or the original upload until processing has finished
+    if variants and variants.get(name):
+        return variants[name]
+    return fallback
+
+
+class ImagePipeline:
+    """Processes uploads in a process pool once the request has committed.
+
+    ``submit()`` returns immediately. Results are written to media_variant
+    from the pool's callback thread using a pooled connection of their own,
+    then ``on_saved`` runs so cached responses can drop the variant-less
+    payload. Workers are started from a clean forkserver process rather than
+    forked from the web worker and its threads, and a pool broken by a dead
+    worker is replaced on the next submit.
+    """
+
+    def __init__(self, pool, out_dir, workers=2):
+        self.pool = pool
+        self.out_dir = out_dir
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, *resources, on_saved=None):
+        futures = []
+        for resource in resources:
+            if not resource:
+                continue
+            executor = self._get_executor()
+            try:
+                future = executor.submit(process_image, resource, self.out_dir)
+            except BrokenProcessPool:
+                # Broke since the last submit; one retry on a fresh pool
+                self._discard(executor)
+                executor = self._get_executor()
+                future = executor.submit(process_image, resource, self.out_dir)
+            future.add_done_callback(
+                lambda done, resource=resource, executor=executor:
+                    self._record(resource, done, executor, on_saved))
+            futures.append(future)
+        return futures
+
+    def process_now(self, resource):
+        # Synchronous path for management commands
+        result = process_image(resource, self.out_dir)
+        self._save(resource, result)
+        return result
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+            return self._executor
+
+    def _discard(self, executor):
+        # A pool whose worker died stays broken; drop it so the next submit starts another
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def _record(self, resource, future, executor, on_saved=None):
+        # Imported here: worker processes import this module and must not set up
+        # the settings' connection pool and background threads
+        from massitfab.settings import log_error
+
+        try:
+            self._save(resource, future.result())
+            if on_saved is not None:
+                on_saved()
+        except Exception as error:
+            if isinstance(error, BrokenProcessPool):
+                self._discard(executor)
+            log_error('image_pipeline', json.dumps({'resource': resource}), str(error))
+
+    def _save(self, resource, result):
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            cur = conn.cursor()
+            cur.execute(
+                """INSERT INTO media_variant (resource, variants, placeholder, width, height)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (resource) DO UPDATE SET variants = EXCLUDED.variants,
+                        placeholder = EXCLUDED.placeholder, width = EXCLUDED.width,
+                        height = EXCLUDED.height, processed_at = now()""",
+                [resource, json.dumps(result['variants']), result['placeholder'],
+                 result['width'], result['height']]
+            )
+            conn.commit()
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn)
+
+
+def install(pipeline):
+    # Let queued uploads finish when the worker shuts down
+    atexit.register(pipeline.shutdown)
+    return pipeline
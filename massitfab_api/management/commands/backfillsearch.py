@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from massitfab.settings import connectDB, disconnectDB
+
+
+class Command(BaseCommand):
+    help = ('Fill product.search_vector for rows written before the search trigger '
+            'existed. Run after migratesql; safe to interrupt and re-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute every row, not only the missing ones')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            started = time.monotonic()
+            last_id = 0
+            done = 0
+            while True:
+                # Walk the primary key in batches, one short transaction each
+                cur.execute(
+                    """WITH batch AS (
+                            SELECT id FROM product WHERE id > %s ORDER BY id LIMIT %s
+                        ), updated AS (
+                            UPDATE product p
+                            SET search_vector = product_search_document(p.title, p.hashtags::text, p.description)
+                            FROM batch b
+                            WHERE p.id = b.id AND (%s OR p.search_vector IS NULL)
+                            RETURNING p.id
+                        )
+                        SELECT (SELECT MAX(id) FROM batch), (SELECT COUNT(*) FROM updated)""",
+                    [last_id, batch_size, options['all']]
+                )
+                max_id, updated = cur.fetchone()
+                conn.commit()
+                if max_id is None:
+                    break
+                last_id = max_id
+                done += updated
+                self.stdout.write('  up to id %s: %s rows updated' % (last_id, done))
+            self.stdout.write(self.style.SUCCESS(
+                'Backfilled %s products in %.1fs' % (done, time.monotonic() - started)))
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
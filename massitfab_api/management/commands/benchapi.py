@@ -0,0 +1,527 @@
+import asyncio
+import base64
+import json
+import random
+import statistics
+import subprocess
+import threading
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+from django.test.client import MULTIPART_CONTENT, BOUNDARY, encode_multipart
+from psycopg2.extras import execute_values
+
+from massitfab import db
+from massitfab.settings import connectDB, disconnectDB, hashPassword, APOOL, RESPONSES
+from massitfab_api import counts, ratings
+
+# Rows created by the benchmark are recognised by this e-mail domain
+BENCH_DOMAIN = '@bench.local'
+BENCH_PASSWORD = 'benchpass'
+
+# 1x1 transparent PNG used for uploads
+PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+WORDS = ('red', 'blue', 'vintage', 'modern', 'poster', 'font', 'icon', 'pack', 'logo', 'mockup',
+         'brush', 'texture', 'theme', 'template', 'sticker', 'photo', 'preset', 'retro', 'neon', 'paper')
+
+# Routes served by the async views under /api/async/, driven on one event loop
+ASYNC_ROUTES = ('aget_products', 'aget_product_details', 'asearch_products', 'aget_reviews', 'aget_categories')
+
+# Relative weight of each route per mix; every route in both urls.py files appears in "all"
+MIXES = {
+    'browse': {
+        'get_products': 30, 'get_product_details': 30, 'get_reviews': 10,
+        'get_categories': 10, 'get_profile': 10, 'search_products': 20,
+    },
+    'search': {
+        'search_products': 80, 'get_product_details': 20,
+    },
+    'shopper': {
+        'get_product_details': 20, 'toggle_wishlist': 15, 'get_wishlist': 10, 'get_allWishlist': 5,
+        'toggle_cart': 15, 'get_cart_details': 10, 'checkout_cart': 5, 'get_membership': 10,
+        'create_review': 10, 'delete_review': 5, 'login': 5,
+    },
+    'async': {
+        'aget_products': 30, 'aget_product_details': 30, 'aget_reviews': 10,
+        'aget_categories': 10, 'asearch_products': 20,
+    },
+    'seller': {
+        'create_product': 30, 'update_product': 30, 'delete_product': 10,
+        'update_profile': 10, 'get_profile': 20,
+    },
+    'all': {
+        'get_products': 20, 'get_product_details': 20, 'search_products': 15, 'get_reviews': 6,
+        'get_categories': 4, 'get_profile': 4,
+        'toggle_wishlist': 4, 'get_wishlist': 3, 'get_allWishlist': 2,
+        'toggle_cart': 4, 'get_cart_details': 3, 'checkout_cart': 1, 'get_membership': 3,
+        'create_review': 2, 'delete_review': 1,
+        'login': 2, 'register': 0.5,
+        'create_product': 1, 'update_product': 1, 'delete_product': 0.5, 'update_profile': 0.5,
+        'aget_products': 4, 'aget_product_details': 4, 'asearch_products': 3, 'aget_reviews': 2,
+        'aget_categories': 1,
+    },
+}
+
+
+class Command(BaseCommand):
+    help = ('End-to-end API benchmark: optionally seeds a scaled dataset, drives a weighted mix of '
+            'every API and auth route through the full Django stack from concurrent clients and '
+            'reports latency percentiles, throughput and DB statements per request as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help='Load the benchmark dataset first')
+        parser.add_argument('--scale', type=int, default=1000, help='Products to seed')
+        parser.add_argument('--reset', action='store_true',
+                            help='Delete every row the benchmark created and exit')
+        parser.add_argument('--mix', default='all', choices=sorted(MIXES))
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests in total')
+        parser.add_argument('--no-cache', action='store_true', help='Disable the response cache')
+        parser.add_argument('--random-seed', type=int, default=42)
+        parser.add_argument('--output', help='Write the JSON results to this file')
+        parser.add_argument('--baseline', help='Earlier JSON results to compare against')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['random_seed'])
+        if options['reset']:
+            self._with_cursor(self._reset)
+            self.stderr.write('Benchmark rows removed')
+            return
+        if options['seed']:
+            self._with_cursor(lambda conn, cur: self._seed(conn, cur, options['scale'], rng))
+
+        dataset = self._with_cursor(self._dataset)
+        if not dataset['users'] or not dataset['products']:
+            raise CommandError('No benchmark data; run with --seed first')
+
+        enabled = RESPONSES.enabled
+        if options['no_cache']:
+            RESPONSES.enabled = False
+        try:
+            samples, elapsed = self._drive(dataset, options, rng)
+        finally:
+            RESPONSES.enabled = enabled
+
+        results = {
+            'version': _revision(),
+            'config': {
+                'mix': options['mix'],
+                'clients': options['clients'],
+                'requests': options['requests'],
+                'cache': not options['no_cache'],
+                'random_seed': options['random_seed'],
+            },
+            'dataset': {
+                'users': len(dataset['users']),
+                'products': len(dataset['products']),
+            },
+            'totals': _summary([sample for route in samples.values() for sample in route], elapsed),
+            'routes': {name: _summary(route, elapsed) for name, route in sorted(samples.items())},
+        }
+        encoded = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(encoded + '\n')
+        else:
+            self.stdout.write(encoded)
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                self._compare(json.load(baseline), results)
+
+    # --------------------------------------------------------------------------
+    # Dataset
+    # --------------------------------------------------------------------------
+
+    def _with_cursor(self, work):
+        conn = None
+        try:
+            conn = connectDB()
+            return work(conn, conn.cursor())
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
+
+    def _seed(self, conn, cur, scale, rng):
+        self.stderr.write('Seeding %s products' % scale)
+        cur.execute("SELECT id FROM subcategory")
+        subcategories = [row[0] for row in cur.fetchall()]
+        if not subcategories:
+            cur.execute("INSERT INTO category (name) VALUES ('Bench') RETURNING id")
+            category_id = cur.fetchone()[0]
+            cur.execute("INSERT INTO subcategory (name, category_id) VALUES ('Bench', %s) RETURNING id",
+                        [category_id])
+            subcategories = [cur.fetchone()[0]]
+
+        password = hashPassword(BENCH_PASSWORD)
+        users = execute_values(
+            cur,
+            "INSERT INTO fab_user (username, email, password) VALUES %s RETURNING id",
+            [('bench' + _letters(i), 'bench%s%s' % (i, BENCH_DOMAIN), password)
+             for i in range(max(10, scale // 10))],
+            page_size=1000,
+            fetch=True
+        )
+        users = [row[0] for row in users]
+
+        products = []
+        for i in range(scale):
+            # A few sellers own most of the listings
+            seller = users[min(int(rng.paretovariate(1.2)) - 1, len(users) - 1)]
+            title = ' '.join(rng.sample(WORDS, 3))
+            products.append((title, 'Bench product %s' % i, seller,
+                             rng.choice(subcategories), rng.randint(1, 20)))
+        products = execute_values(
+            cur,
+            """INSERT INTO product (title, description, fab_user_id, subcategory_id, st_price)
+                VALUES %s RETURNING id""",
+            products,
+            page_size=1000,
+            fetch=True
+        )
+        products = [row[0] for row in products]
+
+        execute_values(
+            cur,
+            "INSERT INTO gallery (resource, product_id) VALUES %s",
+            [('public/img/sandy.png', product_id) for product_id in products for _ in range(rng.randint(1, 3))],
+            page_size=1000
+        )
+        execute_values(
+            cur,
+            "INSERT INTO route (source, product_id) VALUES %s",
+            [('https://example.com/%s/%s' % (product_id, n), product_id)
+             for product_id in products for n in range(rng.randint(1, 2))],
+            page_size=1000
+        )
+        execute_values(
+            cur,
+            "INSERT INTO review (score, comment, fab_user_id, product_id) VALUES %s",
+            [(rng.randint(1, 5), 'Bench review', rng.choice(users), product_id)
+             for product_id in products for _ in range(int(rng.expovariate(0.5)))],
+            page_size=1000
+        )
+        cur.execute(
+            """UPDATE product p SET banner = g.resource
+                FROM (SELECT product_id, MIN(resource) AS resource FROM gallery GROUP BY product_id) g
+                WHERE g.product_id = p.id AND p.id = ANY(%s)""",
+            [products]
+        )
+        counts.rebuild(cur)
+        ratings.rebuild(cur)
+        conn.commit()
+
+    def _reset(self, conn, cur):
+        cur.execute("SELECT id FROM fab_user WHERE email LIKE %s", ['%' + BENCH_DOMAIN])
+        users = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT id FROM product WHERE fab_user_id = ANY(%s)", [users])
+        products = [row[0] for row in cur.fetchall()]
+        for table, column, ids in (
+                ('review', 'product_id', products), ('review', 'fab_user_id', users),
+                ('wishlist', 'product_id', products), ('wishlist', 'fab_user_id', users),
+                ('customer', 'product_id', products), ('customer', 'fab_user_id', users),
+                ('gallery', 'product_id', products), ('route', 'product_id', products),
+                ('product', 'id', products), ('fab_user', 'id', users)):
+            cur.execute("DELETE FROM %s WHERE %s = ANY(%%s)" % (table, column), [ids])
+        counts.rebuild(cur)
+        ratings.rebuild(cur)
+        conn.commit()
+
+    def _dataset(self, conn, cur):
+        cur.execute("SELECT id, username, email FROM fab_user WHERE email LIKE %s ORDER BY id",
+                    ['%' + BENCH_DOMAIN])
+        users = cur.fetchall()
+        cur.execute(
+            """SELECT id, fab_user_id, split_part(title, ' ', 1) FROM product
+                WHERE is_removed = false AND fab_user_id = ANY(%s) ORDER BY id""",
+            [[user[0] for user in users]]
+        )
+        products = cur.fetchall()
+        cur.execute("SELECT id FROM subcategory ORDER BY id LIMIT 1")
+        subcategory = cur.fetchone()
+        conn.rollback()
+        return {'users': users, 'products': products, 'subcategory': subcategory[0] if subcategory else None}
+
+    # --------------------------------------------------------------------------
+    # Load
+    # --------------------------------------------------------------------------
+
+    def _drive(self, dataset, options, rng):
+        weights = MIXES[options['mix']]
+        routes, route_weights = zip(*sorted(weights.items()))
+        clients = max(1, options['clients'])
+        per_client = [options['requests'] // clients + (i < options['requests'] % clients)
+                      for i in range(clients)]
+        seeds = [rng.random() for _ in range(clients)]
+        users = dataset['users']
+
+        samples = {route: [] for route in routes}
+        lock = threading.Lock()
+        failures = []
+        loop = _EventLoop() if set(routes) & set(ASYNC_ROUTES) else None
+
+        def run(index):
+            try:
+                user = _VirtualUser(Client(), users[index % len(users)], dataset, random.Random(seeds[index]),
+                                    loop)
+                user.login()
+                for route in user.rng.choices(routes, route_weights, k=per_client[index]):
+                    started = time.perf_counter()
+                    before = db.statements()
+                    response = getattr(user, route)()
+                    # Async routes count their statements on the event loop
+                    statements = getattr(response, 'statements', None)
+                    if statements is None:
+                        statements = db.statements() - before
+                    sample = ((time.perf_counter() - started) * 1000, statements, response.status_code >= 400)
+                    with lock:
+                        samples[route].append(sample)
+            except Exception as error:
+                failures.append(error)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+        started = time.perf_counter()
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if loop is not None:
+                loop.close()
+        elapsed = time.perf_counter() - started
+        if failures:
+            raise CommandError('A benchmark client failed: %r' % failures[0])
+        return {route: values for route, values in samples.items() if values}, elapsed
+
+    def _compare(self, baseline, results):
+        self.stderr.write('%-22s %12s %12s %12s' % ('route', 'p95 ms', 'queries/req', 'req/s'))
+        rows = [('totals', baseline.get('totals'), results['totals'])]
+        rows += [(name, baseline.get('routes', {}).get(name), current)
+                 for name, current in results['routes'].items()]
+        for name, before, after in rows:
+            if not before:
+                continue
+            self.stderr.write('%-22s %+11.1f%% %+12.2f %+11.1f%%' % (
+                name,
+                _change(before['p95_ms'], after['p95_ms']),
+                after['queries_per_request'] - before['queries_per_request'],
+                _change(before['throughput_rps'], after['throughput_rps'])))
+
+
+class _VirtualUser:
+    # One client session; each public method issues one request of a route
+
+    def __init__(self, client, user, dataset, rng, loop=None):
+        self.client = client
+        self.loop = loop
+        self.async_client = AsyncClient() if loop is not None else None
+        self.user_id, self.username, self.email = user
+        self.products = dataset['products']
+        self.subcategory = dataset['subcategory']
+        self.rng = rng
+        self.headers = {}
+        self.own_products = [product[0] for product in self.products if product[1] == self.user_id]
+        self.reviews = []
+
+    def _product(self):
+        return self.rng.choice(self.products)
+
+    def _multipart(self, method, path, data):
+        return getattr(self.client, method)(
+            path, data=encode_multipart(BOUNDARY, data), content_type=MULTIPART_CONTENT, **self.headers)
+
+    def login(self):
+        response = self.client.post('/auth/login', {'email': self.email, 'password': BENCH_PASSWORD},
+                                    content_type='application/json')
+        if response.status_code == 200:
+            self.headers = {'HTTP_AUTHORIZATION': 'Bearer ' + response.json()['access']}
+        return response
+
+    def register(self):
+        name = 'benchnew' + _letters(self.rng.randrange(26 ** 8))
+        return self.client.post(
+            '/auth/register',
+            {'username': name, 'email': name + BENCH_DOMAIN, 'password': BENCH_PASSWORD},
+            content_type='application/json')
+
+    def get_products(self):
+        if self.rng.random() < 0.5:
+            return self.client.get('/api/content/get', {'page': self.rng.randint(1, 5)})
+        return self.client.get('/api/content/get', {'cursor': ''})
+
+    def get_product_details(self):
+        return self.client.get('/api/content/get/%s' % self._product()[0])
+
+    def search_products(self):
+        return self.client.get('/api/content/search', {'keyword': self._product()[2]})
+
+    def get_reviews(self):
+        return self.client.get('/api/review/get/%s' % self._product()[0])
+
+    def get_categories(self):
+        return self.client.get('/api/category/get')
+
+    def get_profile(self):
+        return self.client.get('/api/u/get/%s' % self.username)
+
+    def toggle_wishlist(self):
+        return self.client.post('/api/u/wishlist/toggle', {'product_id': self._product()[0]},
+                                content_type='application/json', **self.headers)
+
+    def get_wishlist(self):
+        return self.client.get('/api/u/wishlist/get', **self.headers)
+
+    def get_allWishlist(self):
+        response = self.client.get('/api/u/wishlist/getAll', **self.headers)
+        if response.streaming:
+            # Read the whole body so the cursor and connection are released
+            b''.join(response.streaming_content)
+            response.close()
+        return response
+
+    def get_membership(self):
+        ids = ','.join(str(product[0]) for product in self.rng.sample(self.products, min(9, len(self.products))))
+        return self.client.get('/api/u/membership', {'ids': ids}, **self.headers)
+
+    def toggle_cart(self):
+        return self.client.post('/api/cart/toggle/%s' % self._product()[0], **self.headers)
+
+    def get_cart_details(self):
+        return self.client.get('/api/cart/get', **self.headers)
+
+    def checkout_cart(self):
+        return self.client.post('/api/cart/checkout', **self.headers)
+
+    def create_review(self):
+        response = self.client.post(
+            '/api/review/create/%s' % self._product()[0],
+            {'score': str(self.rng.randint(1, 5)), 'comment': 'Bench review'},
+            content_type='application/json', **self.headers)
+        if response.status_code < 400:
+            review_id = response.json().get('data', {}).get('id')
+            if review_id:
+                self.reviews.append(review_id)
+        return response
+
+    def delete_review(self):
+        if not self.reviews:
+            return self.create_review()
+        return self.client.delete('/api/review/delete/%s' % self.reviews.pop(), **self.headers)
+
+    def create_product(self):
+        return self._multipart('post', '/api/content/create', {
+            'title': ' '.join(self.rng.sample(WORDS, 3)),
+            'description': 'Bench product',
+            'subcategory_id': str(self.subcategory),
+            'st_price': str(self.rng.randint(1, 20)),
+            'source': 'https://example.com/a&https://example.com/b',
+            'resource': [SimpleUploadedFile('bench.png', PNG, 'image/png')],
+        })
+
+    def update_product(self):
+        if not self.own_products:
+            return self.create_product()
+        return self._multipart('put', '/api/content/update/%s' % self.rng.choice(self.own_products), {
+            'description': 'Bench product, updated',
+            'source': 'https://example.com/c',
+            'source_deleted': 'https://example.com/c',
+            # The serializer requires at least one upload
+            'resource': [SimpleUploadedFile('bench.png', PNG, 'image/png')],
+        })
+
+    def delete_product(self):
+        if len(self.own_products) < 2:
+            return self.create_product()
+        return self.client.delete('/api/content/delete/%s' % self.own_products.pop(), **self.headers)
+
+    def update_profile(self):
+        return self._multipart('put', '/api/u/update', {'summary': 'Bench seller %s' % self.rng.random()})
+
+    def _async_get(self, path, data=None):
+        return self.loop.run(self.async_client.get(path, data))
+
+    def aget_products(self):
+        if self.rng.random() < 0.5:
+            return self._async_get('/api/async/content/get', {'page': self.rng.randint(1, 5)})
+        return self._async_get('/api/async/content/get', {'cursor': ''})
+
+    def aget_product_details(self):
+        return self._async_get('/api/async/content/get/%s' % self._product()[0])
+
+    def asearch_products(self):
+        return self._async_get('/api/async/content/search', {'keyword': self._product()[2]})
+
+    def aget_reviews(self):
+        return self._async_get('/api/async/review/get/%s' % self._product()[0])
+
+    def aget_categories(self):
+        return self._async_get('/api/async/category/get')
+
+
+class _EventLoop:
+    # The one loop the async routes run on: the async pool belongs to the loop that opened it
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='benchapi-loop', daemon=True)
+        self.thread.start()
+
+    def run(self, request):
+        # Await an AsyncClient request on the loop; the response carries the statements it sent
+        return asyncio.run_coroutine_threadsafe(self._counted(request), self.loop).result()
+
+    async def _counted(self, request):
+        before = db.statements()
+        response = await request
+        response.statements = db.statements() - before
+        return response
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(APOOL.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def _letters(number):
+    # get_profile only routes lowercase letters, so usernames are spelled in base 26
+    letters = ''
+    while True:
+        number, digit = divmod(number, 26)
+        letters = chr(ord('a') + digit) + letters
+        if not number:
+            return letters
+
+
+def _summary(samples, elapsed):
+    latencies = sorted(sample[0] for sample in samples) or [0.0]
+
+    def percentile(share):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * share))]
+
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample[2]),
+        'throughput_rps': len(samples) / elapsed if elapsed else 0.0,
+        'mean_ms': statistics.fmean(latencies),
+        'p50_ms': statistics.median(latencies),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'queries_per_request': statistics.fmean(sample[1] for sample in samples) if samples else 0.0,
+    }
+
+
+def _change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+
+def _revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
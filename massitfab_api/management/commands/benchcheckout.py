@@ -0,0 +1,205 @@
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from psycopg2.extras import execute_values
+
+from massitfab.settings import connectDB, disconnectDB
+from massitfab_api import checkout, toggles
+
+# Rows created by the benchmark are recognised by this e-mail domain
+DOMAIN = '@checkout.bench.local'
+PRICE = 10
+
+
+class Command(BaseCommand):
+    help = ('Stress the checkout engine: many buyers check out concurrently, repeatedly, with '
+            'retried idempotency keys and cart toggles racing them. Verifies no balance goes '
+            'negative, every debit matches what was bought and every retry replays the first '
+            'result, then reports checkouts/sec. Everything it creates is removed afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=50)
+        parser.add_argument('--items', type=int, default=5, help='Cart items per buyer')
+        parser.add_argument('--attempts', type=int, default=4,
+                            help='Concurrent checkouts per buyer, each with its own key')
+        parser.add_argument('--retries', type=int, default=2, help='Replays of each key')
+        parser.add_argument('--toggles', type=int, default=2, help='Cart toggles racing the checkouts per buyer')
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keep', action='store_true', help='Leave the benchmark rows in place')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        fixture = self._with_cursor(lambda conn, cur: self._setup(conn, cur, options, rng))
+        try:
+            tasks = []
+            for buyer, balance in fixture['buyers'].items():
+                for _ in range(options['attempts']):
+                    key = uuid.UUID(int=rng.getrandbits(128)).hex
+                    tasks += [('checkout', buyer, key)] * (1 + options['retries'])
+                for _ in range(options['toggles']):
+                    tasks.append(('toggle', buyer, rng.choice(fixture['products'])))
+            rng.shuffle(tasks)
+
+            results = []
+            lock = threading.Lock()
+
+            def call(task):
+                started = time.perf_counter()
+                outcome = self._with_cursor(lambda conn, cur: self._run(conn, cur, task))
+                with lock:
+                    results.append((task, outcome, (time.perf_counter() - started) * 1000))
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['clients']) as executor:
+                list(executor.map(call, tasks))
+            elapsed = time.perf_counter() - started
+
+            violations = self._with_cursor(lambda conn, cur: self._verify(conn, cur, fixture, results))
+        finally:
+            if not options['keep']:
+                self._with_cursor(self._cleanup)
+
+        checkouts = [result for result in results if result[0][0] == 'checkout']
+        latencies = sorted(result[2] for result in checkouts) or [0.0]
+        outcomes = {}
+        for _, outcome, _ in checkouts:
+            outcomes[outcome[0]] = outcomes.get(outcome[0], 0) + 1
+        report = {
+            'buyers': len(fixture['buyers']),
+            'checkouts': len(checkouts),
+            'checkouts_per_second': len(checkouts) / elapsed if elapsed else 0.0,
+            'p50_ms': statistics.median(latencies),
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+            'outcomes': outcomes,
+            'violations': violations,
+        }
+        self.stdout.write(json.dumps(report, indent=2, default=str))
+        if violations:
+            raise CommandError('%s consistency violations' % len(violations))
+
+    def _with_cursor(self, work):
+        conn = None
+        try:
+            conn = connectDB()
+            return work(conn, conn.cursor())
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
+
+    def _setup(self, conn, cur, options, rng):
+        cur.execute("SELECT id FROM subcategory ORDER BY id LIMIT 1")
+        subcategory = cur.fetchone()
+        if subcategory is None:
+            raise CommandError('No subcategory to list the benchmark products under')
+
+        cur.execute(
+            "INSERT INTO fab_user (username, email, password) VALUES ('ckseller', %s, '') RETURNING id",
+            ['seller' + DOMAIN]
+        )
+        seller = cur.fetchone()[0]
+        products = [row[0] for row in execute_values(
+            cur,
+            "INSERT INTO product (title, description, fab_user_id, subcategory_id, st_price) VALUES %s RETURNING id",
+            [('Checkout bench %s' % n, '', seller, subcategory[0], PRICE) for n in range(options['items'])],
+            fetch=True
+        )]
+
+        # Some buyers can afford the whole cart exactly once, the rest fall short by one item
+        cart_total = PRICE * options['items']
+        balances = [cart_total if rng.random() < 0.7 else cart_total - PRICE for _ in range(options['buyers'])]
+        buyers = execute_values(
+            cur,
+            "INSERT INTO fab_user (username, email, password, balance) VALUES %s RETURNING id, balance",
+            [('ckbuyer' + _letters(n), 'buyer%s%s' % (n, DOMAIN), '', balance) for n, balance in enumerate(balances)],
+            fetch=True
+        )
+        execute_values(
+            cur,
+            "INSERT INTO customer (fab_user_id, product_id) VALUES %s",
+            [(buyer, product) for buyer, _ in buyers for product in products]
+        )
+        conn.commit()
+        return {'seller': seller, 'products': products, 'buyers': dict(buyers)}
+
+    def _run(self, conn, cur, task):
+        kind, buyer, argument = task
+        try:
+            if kind == 'toggle':
+                toggles.cart(cur, buyer, argument)
+                conn.commit()
+                return ('toggle', None)
+            try:
+                status, data, replayed = checkout.run(cur, buyer, argument)
+            except checkout.InsufficientBalance:
+                conn.rollback()
+                return (406, None)
+            conn.commit()
+            return (status, json.loads(json.dumps(data, default=float)), replayed)
+        except Exception as error:
+            conn.rollback()
+            return ('error', str(error))
+
+    def _verify(self, conn, cur, fixture, results):
+        violations = []
+        buyers = list(fixture['buyers'])
+        cur.execute(
+            """SELECT u.id, u.balance, COALESCE(SUM(p.st_price) FILTER (WHERE c.is_bought), 0),
+                    COUNT(*) FILTER (WHERE c.is_bought AND c.in_cart)
+                FROM fab_user u
+                LEFT JOIN customer c ON c.fab_user_id = u.id
+                LEFT JOIN product p ON p.id = c.product_id
+                WHERE u.id = ANY(%s)
+                GROUP BY u.id, u.balance""",
+            [buyers]
+        )
+        for buyer, balance, spent, both in cur.fetchall():
+            initial = fixture['buyers'][buyer]
+            if balance < 0:
+                violations.append({'buyer': buyer, 'problem': 'negative balance', 'balance': balance})
+            if balance + spent != initial:
+                violations.append({'buyer': buyer, 'problem': 'debit does not match purchases',
+                                   'initial': initial, 'balance': balance, 'spent': spent})
+            if both:
+                violations.append({'buyer': buyer, 'problem': 'rows both in cart and bought', 'rows': both})
+        conn.rollback()
+
+        # Every response for one key must be the same
+        by_key = {}
+        for task, outcome, _ in results:
+            if task[0] != 'checkout':
+                continue
+            if outcome[0] == 'error':
+                violations.append({'buyer': task[1], 'problem': 'error', 'error': outcome[1]})
+            elif outcome[0] == 202:
+                by_key.setdefault(task[2], []).append(outcome[1])
+        for key, responses in by_key.items():
+            if any(response != responses[0] for response in responses):
+                violations.append({'key': key, 'problem': 'replays differ', 'responses': responses})
+        return violations
+
+    def _cleanup(self, conn, cur):
+        cur.execute("SELECT id FROM fab_user WHERE email LIKE %s", ['%' + DOMAIN])
+        users = [row[0] for row in cur.fetchall()]
+        cur.execute("DELETE FROM checkout_request WHERE fab_user_id = ANY(%s)", [users])
+        cur.execute("DELETE FROM customer WHERE fab_user_id = ANY(%s)", [users])
+        cur.execute("DELETE FROM product WHERE fab_user_id = ANY(%s)", [users])
+        cur.execute("DELETE FROM fab_user WHERE id = ANY(%s)", [users])
+        conn.commit()
+
+
+def _letters(number):
+    # get_profile only routes letters, so usernames spell the number in base 26
+    letters = ''
+    while True:
+        number, digit = divmod(number, 26)
+        letters = chr(ord('a') + digit) + letters
+        if not number:
+            return letters
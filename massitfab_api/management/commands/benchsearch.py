@@ -0,0 +1,106 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from massitfab.settings import connectDB, disconnectDB
+from massitfab_api import search
+
+# The queries search_products ran before the full-text path: ILIKE count + page
+LEGACY_COUNT = "SELECT COUNT(*) FROM product WHERE title ILIKE %s AND is_removed = false"
+LEGACY_PAGE = """SELECT p.id, title, description, MIN(resource) as banner, subcategory_id, st_price, created_at
+    FROM product p INNER JOIN gallery g ON p.id = g.product_id
+    WHERE is_removed = false AND title ILIKE %s
+    GROUP BY p.id ORDER BY created_at DESC LIMIT %s OFFSET 0"""
+
+SEARCH_PAGE = """SELECT p.id, title, description, banner, subcategory_id, st_price, created_at
+    FROM product p
+    WHERE is_removed = false AND banner IS NOT NULL{match}
+    ORDER BY {rank}created_at DESC LIMIT %s OFFSET 0"""
+SEARCH_COUNT = "SELECT COUNT(*) FROM (SELECT 1 FROM product WHERE is_removed = false{match} LIMIT %s) matches"
+
+
+class Command(BaseCommand):
+    help = ('Compare the legacy ILIKE search with the full-text and fuzzy search paths '
+            'on the current database (seed it with synthetic data for realistic sizes)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('keywords', nargs='*',
+                            help='Keywords to search for; sampled from product titles if omitted')
+        parser.add_argument('--samples', type=int, default=20, help='Keywords to sample')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per keyword and query')
+        parser.add_argument('--limit', type=int, default=9)
+        parser.add_argument('--cap', type=int, default=1000)
+        parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+
+    def handle(self, *args, **options):
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            keywords = options['keywords'] or self._sample_keywords(cur, options['samples'])
+            cur.execute("SELECT COUNT(*) FROM product")
+            product_rows = cur.fetchone()[0]
+
+            limit, cap = options['limit'], options['cap']
+            timings = {'ilike': [], search.FULLTEXT: [], search.FUZZY: []}
+            for keyword in keywords:
+                for _ in range(options['repeat']):
+                    timings['ilike'].append(self._time(cur, [
+                        (LEGACY_COUNT, ['%' + keyword + '%']),
+                        (LEGACY_PAGE, ['%' + keyword + '%', limit]),
+                    ]))
+                    for mode in (search.FULLTEXT, search.FUZZY):
+                        match, match_params = search.match_clause(mode, keyword)
+                        rank, rank_params = search.rank_clause(mode, keyword)
+                        timings[mode].append(self._time(cur, [
+                            (SEARCH_COUNT.format(match=match), match_params + [cap + 1]),
+                            (SEARCH_PAGE.format(match=match, rank=rank),
+                             match_params + rank_params + [limit]),
+                        ]))
+                conn.rollback()
+
+            results = {
+                'product_rows': product_rows,
+                'keywords': len(keywords),
+                'runs': {name: _summary(values) for name, values in timings.items()},
+            }
+            if options['json']:
+                self.stdout.write(json.dumps(results, indent=2))
+                return
+            self.stdout.write('%s products, %s keywords x %s runs (count + first page, ms)' % (
+                product_rows, len(keywords), options['repeat']))
+            for name, summary in results['runs'].items():
+                self.stdout.write('  %-9s p50 %8.2f  p95 %8.2f  max %8.2f' % (
+                    name, summary['p50_ms'], summary['p95_ms'], summary['max_ms']))
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
+
+    def _sample_keywords(self, cur, samples):
+        # Words taken from random titles, so every keyword has some matches
+        cur.execute(
+            """SELECT split_part(title, ' ', 1) FROM product TABLESAMPLE SYSTEM (1)
+                WHERE title <> '' LIMIT %s""",
+            [samples]
+        )
+        return [row[0] for row in cur.fetchall() if row[0]] or ['a']
+
+    def _time(self, cur, statements):
+        started = time.perf_counter()
+        for sql, params in statements:
+            cur.execute(sql, params)
+            cur.fetchall()
+        return (time.perf_counter() - started) * 1000
+
+
+def _summary(values):
+    values = sorted(values)
+    if not values:
+        return {'p50_ms': 0, 'p95_ms': 0, 'max_ms': 0}
+    return {
+        'p50_ms': statistics.median(values),
+        'p95_ms': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max_ms': values[-1],
+    }
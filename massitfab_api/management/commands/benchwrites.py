@@ -0,0 +1,142 @@
+import hashlib
+import json
+import shutil
+import statistics
+import tempfile
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from psycopg2 import extensions
+
+from massitfab.settings import connectDB, disconnectDB
+from massitfab_api import attachments, media
+
+
+class CountingCursor(extensions.cursor):
+    # Every execute() is one round trip to the server
+    def execute(self, query, vars=None):
+        self.connection.round_trips += 1
+        return super().execute(query, vars)
+
+
+class Command(BaseCommand):
+    help = ('Compare the per-row and bulk write paths of create_product/update_product '
+            'for products of different sizes. Every run is rolled back.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,5,10,30',
+                            help='Comma separated number of images and links per product')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per size and path')
+        parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        root = tempfile.mkdtemp(prefix='benchwrites-')
+        store = media.ContentStore(root)
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            cur.execute("SELECT (SELECT id FROM fab_user LIMIT 1), (SELECT id FROM subcategory LIMIT 1)")
+            owner = cur.fetchone()
+            if None in owner:
+                raise CommandError('Needs at least one fab_user and one subcategory row')
+            conn.rollback()
+
+            results = []
+            for size in sizes:
+                for name, write in (('per_row', self._per_row), ('bulk', self._bulk)):
+                    timings, round_trips = [], 0
+                    for run in range(options['repeat']):
+                        timing, round_trips = self._run(conn, owner, size, run, store, write)
+                        timings.append(timing)
+                    results.append(dict(size=size, path=name, round_trips=round_trips,
+                                        **_summary(timings)))
+
+            if options['json']:
+                self.stdout.write(json.dumps(results, indent=2))
+                return
+            self.stdout.write('create + update of a product with N images and N links (ms)')
+            for row in results:
+                self.stdout.write('  N=%-4s %-8s round trips %4s  p50 %8.2f  p95 %8.2f  max %8.2f' % (
+                    row['size'], row['path'], row['round_trips'],
+                    row['p50_ms'], row['p95_ms'], row['max_ms']))
+        finally:
+            if conn is not None:
+                conn.rollback()
+                disconnectDB(conn)
+            shutil.rmtree(root, ignore_errors=True)
+
+    def _run(self, conn, owner, size, run, store, write):
+        conn.round_trips = 0
+        cur = conn.cursor(cursor_factory=CountingCursor)
+        sources = ['https://example.com/bench/%s/%s' % (run, i) for i in range(size)]
+        uploads = [
+            SimpleUploadedFile('bench-%s.png' % i, ('%s-%s-%s' % (size, run, i)).encode())
+            for i in range(size)
+        ]
+        started = time.perf_counter()
+        try:
+            cur.execute(
+                """INSERT INTO product (title, description, fab_user_id, subcategory_id, st_price)
+                    VALUES ('bench', 'bench', %s, %s, 0) RETURNING id""",
+                owner
+            )
+            product_id = cur.fetchone()[0]
+            write(cur, store, product_id, sources, uploads)
+            return (time.perf_counter() - started) * 1000, conn.round_trips
+        finally:
+            conn.rollback()
+
+    def _per_row(self, cur, store, product_id, sources, uploads):
+        # What the views issued before: a statement per link, blob and gallery row
+        for source in sources:
+            cur.execute("INSERT INTO route (source, product_id) VALUES (%s, %s)", [source, product_id])
+        resources = []
+        for uploaded in uploads:
+            content = uploaded.read()
+            digest = hashlib.sha256(content).hexdigest()
+            resource = store._path(digest, '.png')
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [digest])
+            cur.execute(
+                "UPDATE media_blob SET refcount = refcount + 1 WHERE digest = %s RETURNING resource",
+                [digest]
+            )
+            cur.execute(
+                "INSERT INTO media_blob (digest, resource, size, refcount) VALUES (%s, %s, %s, 1)",
+                [digest, resource, len(content)]
+            )
+            cur.execute("INSERT INTO gallery (resource, product_id) VALUES (%s, %s)", [resource, product_id])
+            resources.append(resource)
+
+        for resource in resources:
+            cur.execute("DELETE FROM gallery WHERE resource = %s AND product_id = %s", [resource, product_id])
+            cur.execute(
+                "UPDATE media_blob SET refcount = refcount - 1 WHERE resource = %s RETURNING digest, refcount",
+                [resource]
+            )
+            digest, _ = cur.fetchone()
+            cur.execute("DELETE FROM media_blob WHERE digest = %s", [digest])
+        for source in sources:
+            cur.execute("DELETE FROM route WHERE source = %s AND product_id = %s", [source, product_id])
+
+    def _bulk(self, cur, store, product_id, sources, uploads):
+        attachments.add_routes(cur, product_id, sources)
+        saved = store.save_many(cur, uploads)
+        attachments.add_gallery(cur, product_id, [resource for resource, _ in saved])
+
+        removed = attachments.remove_gallery(cur, product_id, [resource for resource, _ in saved])
+        store.release_many(cur, removed)
+        attachments.remove_routes(cur, product_id, sources)
+
+
+def _summary(values):
+    values = sorted(values)
+    if not values:
+        return {'p50_ms': 0, 'p95_ms': 0, 'max_ms': 0}
+    return {
+        'p50_ms': statistics.median(values),
+        'p95_ms': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max_ms': values[-1],
+    }
@@ -0,0 +1,292 @@
+import bisect
+import csv
+import io
+import itertools
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+
+from massitfab.settings import connectDB, disconnectDB, hashPassword
+from massitfab_api import counts, ratings
+from massitfab_api.views import STORE
+
+# Rows the generator created are recognised by this e-mail domain
+DOMAIN = '@synthetic.local'
+PASSWORD = 'synthetic'
+
+# Rows per COPY buffer
+CHUNK = 50000
+
+# Row counts at --scale 1
+BASE = {
+    'users': 10000,
+    'categories': 12,
+    'products': 20000,
+    'reviews': 100000,
+    'wishlists': 200000,
+    'carts': 20000,
+    'purchases': 50000,
+    'logs': 50000,
+}
+
+WORDS = ('red', 'blue', 'green', 'vintage', 'modern', 'minimal', 'poster', 'font', 'icon', 'pack', 'logo',
+         'mockup', 'brush', 'texture', 'theme', 'template', 'sticker', 'photo', 'preset', 'retro', 'neon',
+         'paper', 'flyer', 'badge', 'pattern', 'card', 'menu', 'banner', 'cover', 'frame', 'ui', 'kit')
+COMMENTS = ('Гоё байна', 'Маш их таалагдлаа', 'Дажгүй', 'Үнэ цэнэтэй', 'Санал болгож байна', None)
+ACTIONS = ('get_products', 'get_product_details', 'search_products', 'create_product', 'update_product',
+           'toggle_cart', 'checkout_cart', 'create_review', 'Login')
+SIZES = ((1600, 1200), (1200, 1200), (1000, 1400), (800, 600))
+
+
+class Command(BaseCommand):
+    help = ('Bulk-load deterministic synthetic users, categories, products, galleries, links, '
+            'reviews, wishlists, carts, purchases and logs with realistic skew, using COPY. '
+            'Placeholder images are written through the media store so the upload and '
+            'image serving paths have real files to work on.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help='Multiplier of the default row counts (1 = %s products)' % BASE['products'])
+        parser.add_argument('--seed', type=int, default=1, help='Same seed, same data')
+        parser.add_argument('--media', type=int, default=100, help='Distinct placeholder images')
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent of product popularity; 0 spreads activity evenly')
+        parser.add_argument('--purge', action='store_true',
+                            help='Delete everything the generator created and exit')
+
+    def handle(self, *args, **options):
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            started = time.monotonic()
+            if options['purge']:
+                garbage = self._purge(cur)
+                conn.commit()
+                STORE.collect(conn, garbage)
+                self.stdout.write(self.style.SUCCESS('Removed synthetic data in %.1fs' % (
+                    time.monotonic() - started)))
+                return
+
+            cur.execute("SELECT 1 FROM fab_user WHERE email LIKE %s LIMIT 1", ['%' + DOMAIN])
+            if cur.fetchone() is not None:
+                raise CommandError('Synthetic data is already loaded; run with --purge first')
+
+            sizes = {name: max(1, int(count * options['scale'])) for name, count in BASE.items()}
+            loaded = self._generate(cur, sizes, options)
+            counts.rebuild(cur)
+            ratings.rebuild(cur)
+            conn.commit()
+            self.stdout.write(json.dumps(loaded, indent=2))
+            self.stdout.write(self.style.SUCCESS('Loaded synthetic data in %.1fs' % (
+                time.monotonic() - started)))
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
+
+    def _generate(self, cur, sizes, options):
+        rng = random.Random(options['seed'])
+        now = datetime(2024, 1, 1)
+        loaded = {}
+
+        resources = self._media(cur, rng, options['media'])
+        loaded['media'] = len(resources)
+
+        # Users, in id order; early ids are the long-standing, busier accounts
+        password = hashPassword(PASSWORD)
+        users = self._reserve(cur, 'fab_user', sizes['users'])
+        self._copy(cur, 'fab_user', ('id', 'username', 'email', 'password', 'summary', 'created_at'), (
+            (user_id, 'syn' + _letters(user_id), 'syn%s%s' % (user_id, DOMAIN), password,
+             rng.choice(WORDS) + ' ' + rng.choice(WORDS), _ago(rng, now, 730))
+            for user_id in users
+        ))
+        loaded['fab_user'] = len(users)
+
+        categories = self._reserve(cur, 'category', sizes['categories'])
+        self._copy(cur, 'category', ('id', 'name'), (
+            (category_id, 'Synthetic %s' % category_id) for category_id in categories
+        ))
+        subcategories = self._reserve(cur, 'subcategory', sizes['categories'] * 5)
+        self._copy(cur, 'subcategory', ('id', 'name', 'category_id'), (
+            (subcategory_id, 'Synthetic %s' % subcategory_id, categories[i % len(categories)])
+            for i, subcategory_id in enumerate(subcategories)
+        ))
+        loaded['category'] = len(categories)
+        loaded['subcategory'] = len(subcategories)
+
+        # Power sellers: ownership follows a Pareto curve over a tenth of the users
+        sellers = users[:max(1, len(users) // 10)]
+        products = self._reserve(cur, 'product', sizes['products'])
+        owners = {}
+        galleries = {}
+
+        def product_rows():
+            for product_id in products:
+                owner = sellers[min(int(rng.paretovariate(1.16)) - 1, len(sellers) - 1)]
+                owners[product_id] = owner
+                galleries[product_id] = rng.sample(resources, min(len(resources), rng.randint(1, 5)))
+                yield (product_id, ' '.join(rng.sample(WORDS, 3)), ' '.join(rng.choices(WORDS, k=20)), owner,
+                       _zipf_choice(rng, subcategories), rng.choice((0, 1, 5, 10, 15, 25, 50)),
+                       _ago(rng, now, 365), galleries[product_id][0])
+
+        self._copy(cur, 'product', ('id', 'title', 'description', 'fab_user_id', 'subcategory_id',
+                                    'st_price', 'created_at', 'banner'), product_rows())
+        loaded['product'] = len(products)
+
+        loaded['gallery'] = self._copy(cur, 'gallery', ('resource', 'product_id'), (
+            (resource, product_id) for product_id in products for resource in galleries[product_id]
+        ))
+        loaded['route'] = self._copy(cur, 'route', ('source', 'product_id'), (
+            ('https://files.synthetic.local/%s/%s.zip' % (product_id, n), product_id)
+            for product_id in products for n in range(rng.randint(1, 3))
+        ))
+
+        # Popular products: a Zipf ranking over a shuffled copy, so popularity is not tied to age
+        ranked = products[:]
+        rng.shuffle(ranked)
+        popular = _Zipf(ranked, options['skew'])
+        active = _Zipf(users, 1.0)
+
+        def pairs(total):
+            # Distinct (user, product) pairs; busy users and popular products dominate
+            seen = set()
+            for _ in range(total * 3):
+                if len(seen) == total:
+                    break
+                pair = (active.pick(rng), popular.pick(rng))
+                if pair not in seen and owners[pair[1]] != pair[0]:
+                    seen.add(pair)
+                    yield pair
+
+        loaded['review'] = self._copy(cur, 'review', ('score', 'comment', 'fab_user_id', 'product_id', 'created_at'), (
+            (rng.choices((5, 4, 3, 2, 1), (50, 25, 12, 6, 7))[0], rng.choice(COMMENTS), user_id, product_id,
+             _ago(rng, now, 365))
+            for user_id, product_id in pairs(sizes['reviews'])
+        ))
+        loaded['wishlist'] = self._copy(cur, 'wishlist', ('fab_user_id', 'product_id'), pairs(sizes['wishlists']))
+
+        # One cart row per pair: either still in the cart or bought
+        purchases = sizes['purchases']
+        loaded['customer'] = self._copy(cur, 'customer', ('fab_user_id', 'product_id', 'in_cart', 'is_bought'), (
+            (user_id, product_id, n >= purchases, n < purchases)
+            for n, (user_id, product_id) in enumerate(pairs(purchases + sizes['carts']))
+        ))
+
+        loaded['logs'] = self._copy(cur, 'logs', ('action', 'note', 'request', 'details'), (
+            (_zipf_choice(rng, ACTIONS), 'error', json.dumps({'product_id': popular.pick(rng)}),
+             'synthetic: ' + rng.choice(('timeout', 'not found', 'invalid token', 'duplicate key')))
+            for _ in range(sizes['logs'])
+        ))
+
+        # Storing counted one reference per placeholder; the gallery rows hold the real ones
+        cur.execute(
+            """UPDATE media_blob m
+                SET refcount = m.refcount - 1 + (SELECT COUNT(*) FROM gallery g WHERE g.resource = m.resource)
+                WHERE m.resource = ANY(%s)""",
+            [resources]
+        )
+        return loaded
+
+    def _media(self, cur, rng, count):
+        # Distinct images of realistic dimensions, stored like uploads
+        if count <= 0:
+            raise CommandError('--media must be at least 1')
+        try:
+            from PIL import Image, ImageDraw
+        except ImportError:
+            raise CommandError('Pillow is required to generate placeholder images')
+
+        uploads = []
+        for n in range(count):
+            image = Image.new('RGB', rng.choice(SIZES), tuple(rng.randrange(256) for _ in range(3)))
+            draw = ImageDraw.Draw(image)
+            for _ in range(12):
+                x, y = rng.randrange(image.width), rng.randrange(image.height)
+                draw.rectangle((x, y, x + rng.randrange(50, 400), y + rng.randrange(50, 400)),
+                               fill=tuple(rng.randrange(256) for _ in range(3)))
+            body = io.BytesIO()
+            image.save(body, 'JPEG', quality=85)
+            uploads.append(SimpleUploadedFile('synthetic%s.jpg' % n, body.getvalue(), 'image/jpeg'))
+        return [resource for resource, _ in STORE.save_many(cur, uploads)]
+
+    def _reserve(self, cur, table, count):
+        # Take a block of ids from the table's sequence so rows can reference each other before COPY
+        cur.execute("LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE" % table)
+        cur.execute(
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), nextval(pg_get_serial_sequence(%s, 'id')) + %s - 1)",
+            [table, table, count]
+        )
+        last = cur.fetchone()[0]
+        return list(range(last - count + 1, last + 1))
+
+    def _copy(self, cur, table, columns, rows):
+        # Stream rows as CSV through COPY, one buffer per CHUNK rows
+        statement = "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (table, ', '.join(columns))
+        total = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK))
+            if not chunk:
+                break
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(chunk)
+            buffer.seek(0)
+            cur.copy_expert(statement, buffer)
+            total += len(chunk)
+        self.stderr.write('  %-12s %10s rows' % (table, total))
+        return total
+
+    def _purge(self, cur):
+        cur.execute("SELECT id FROM fab_user WHERE email LIKE %s", ['%' + DOMAIN])
+        users = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT id FROM product WHERE fab_user_id = ANY(%s)", [users])
+        products = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT resource FROM gallery WHERE product_id = ANY(%s)", [products])
+        resources = [row[0] for row in cur.fetchall()]
+        for table, column, ids in (
+                ('review', 'product_id', products), ('review', 'fab_user_id', users),
+                ('wishlist', 'product_id', products), ('wishlist', 'fab_user_id', users),
+                ('customer', 'product_id', products), ('customer', 'fab_user_id', users),
+                ('gallery', 'product_id', products), ('route', 'product_id', products),
+                ('product', 'id', products), ('fab_user', 'id', users)):
+            cur.execute("DELETE FROM %s WHERE %s = ANY(%%s)" % (table, column), [ids])
+        cur.execute("DELETE FROM subcategory WHERE name LIKE 'Synthetic %'")
+        cur.execute("DELETE FROM category WHERE name LIKE 'Synthetic %'")
+        cur.execute("DELETE FROM logs WHERE details LIKE 'synthetic: %'")
+        counts.rebuild(cur)
+        ratings.rebuild(cur)
+        return STORE.release_many(cur, resources)
+
+
+class _Zipf:
+    # Weighted picks where the item at rank k has weight 1 / k**s
+
+    def __init__(self, items, s):
+        self.items = items
+        self.cumulative = list(itertools.accumulate(1 / (rank ** s) for rank in range(1, len(items) + 1)))
+
+    def pick(self, rng):
+        return self.items[bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])]
+
+
+def _zipf_choice(rng, items):
+    return items[min(int(rng.paretovariate(1.5)) - 1, len(items) - 1)]
+
+
+def _ago(rng, now, days):
+    # A time within the last `days`, biased towards recent
+    return now - timedelta(days=days * rng.random() ** 2, seconds=rng.randrange(86400))
+
+
+def _letters(number):
+    # get_profile only routes letters, so usernames spell the id in base 26
+    letters = ''
+    while True:
+        number, digit = divmod(number, 26)
+        letters = chr(ord('a') + digit) + letters
+        if not number:
+            return letters
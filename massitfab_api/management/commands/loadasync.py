@@ -0,0 +1,263 @@
+import asyncio
+import contextlib
+import io
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+
+from massitfab.settings import connectDB, disconnectDB, RESPONSES
+
+# Read endpoints served by both paths; the async ones live under api/async/
+ROUTES = ('products', 'details', 'search', 'reviews', 'categories')
+
+
+class Command(BaseCommand):
+    help = ('Drive the sync (WSGI, fixed thread pool) and async (ASGI, one event loop) read '
+            'endpoints in-process with the same number of concurrent clients and compare '
+            'throughput, latency, requests in flight and memory of a single worker')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=64, help='Concurrent clients')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per path')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='Threads of the simulated WSGI worker')
+        parser.add_argument('--routes', default=','.join(ROUTES),
+                            help='Comma separated subset of: %s' % ', '.join(ROUTES))
+        parser.add_argument('--cache', action='store_true',
+                            help='Keep the response cache on (off by default so every request queries)')
+        parser.add_argument('--memory', action='store_true',
+                            help='Trace Python allocations too (slows both paths down)')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+
+    def handle(self, *args, **options):
+        routes = [route.strip() for route in options['routes'].split(',') if route.strip()]
+        unknown = set(routes) - set(ROUTES)
+        if unknown:
+            raise CommandError('Unknown routes: %s' % ', '.join(sorted(unknown)))
+
+        rng = random.Random(options['seed'])
+        targets = self._targets(rng, routes, options['requests'])
+
+        enabled = RESPONSES.enabled
+        RESPONSES.enabled = options['cache']
+        try:
+            results = {
+                'concurrency': options['concurrency'],
+                'requests': len(targets),
+                'wsgi_threads': options['threads'],
+                'wsgi': self._run_wsgi(targets, options['concurrency'], options['threads'],
+                                       options['memory']),
+                'asgi': self._run_asgi(targets, options['concurrency'], options['memory']),
+            }
+        finally:
+            RESPONSES.enabled = enabled
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write('%s requests, %s clients, WSGI worker with %s threads' % (
+            results['requests'], results['concurrency'], results['wsgi_threads']))
+        for name in ('wsgi', 'asgi'):
+            run = results[name]
+            self.stdout.write(
+                '  %-4s %8.1f req/s  p50 %7.2f  p95 %7.2f  p99 %7.2f ms  in flight %4s  '
+                'threads %3s  peak alloc %6.1f MB  errors %s' % (
+                    name, run['throughput'], run['p50_ms'], run['p95_ms'], run['p99_ms'],
+                    run['peak_in_flight'], run['peak_threads'], run['peak_alloc_mb'], run['errors']))
+
+    def _targets(self, rng, routes, count):
+        # (path, query string) pairs over real ids from the database
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            cur.execute("SELECT id, split_part(title, ' ', 1) FROM product WHERE is_removed = false LIMIT 1000")
+            products = cur.fetchall()
+            conn.rollback()
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
+        if not products:
+            raise CommandError('No products to request; seed the database first')
+
+        targets = []
+        for _ in range(count):
+            route = rng.choice(routes)
+            product_id, word = rng.choice(products)
+            if route == 'products':
+                targets.append(('content/get', 'page=%s&page_size=9' % rng.randint(1, 5)))
+            elif route == 'details':
+                targets.append(('content/get/%s' % product_id, ''))
+            elif route == 'search':
+                targets.append(('content/search', 'keyword=%s' % (word or 'a')))
+            elif route == 'reviews':
+                targets.append(('review/get/%s' % product_id, ''))
+            else:
+                targets.append(('category/get', ''))
+        return targets
+
+    def _run_wsgi(self, targets, concurrency, threads, trace):
+        handler = WSGIHandler()
+        probe = _Probe()
+
+        def call(target):
+            path, query = target
+            environ = {
+                'REQUEST_METHOD': 'GET',
+                'PATH_INFO': '/api/' + path,
+                'QUERY_STRING': query,
+                'SERVER_NAME': 'loadtest',
+                'SERVER_PORT': '80',
+                'SERVER_PROTOCOL': 'HTTP/1.1',
+                'HTTP_HOST': 'loadtest',
+                'wsgi.input': io.BytesIO(),
+                'wsgi.errors': sys.stderr,
+                'wsgi.url_scheme': 'http',
+                'wsgi.multithread': True,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            statuses = []
+            with probe.request() as timing:
+                body = handler(environ, lambda status, headers, exc_info=None: statuses.append(status))
+                b''.join(body)
+                if hasattr(body, 'close'):
+                    body.close()
+                timing.status = int(statuses[0].split()[0])
+
+        # Clients beyond the thread count queue up, as they would in front of a WSGI worker
+        with probe.measure(trace):
+            with ThreadPoolExecutor(max_workers=min(threads, concurrency)) as executor:
+                list(executor.map(call, targets))
+        return probe.summary()
+
+    def _run_asgi(self, targets, concurrency, trace):
+        # The application massitfab/asgi.py serves
+        from massitfab.asgi import application as handler
+        probe = _Probe()
+
+        async def call(target, gate):
+            path, query = target
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': '1.1',
+                'method': 'GET',
+                'scheme': 'http',
+                'path': '/api/async/' + path,
+                'raw_path': ('/api/async/' + path).encode(),
+                'query_string': query.encode(),
+                'root_path': '',
+                'headers': [(b'host', b'loadtest')],
+                'client': ('127.0.0.1', 0),
+                'server': ('loadtest', 80),
+            }
+            messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+            done = asyncio.Event()
+            statuses = []
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                await done.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    statuses.append(message['status'])
+                elif not message.get('more_body'):
+                    done.set()
+
+            async with gate:
+                with probe.request() as timing:
+                    await handler(scope, receive, send)
+                    timing.status = statuses[0]
+
+        async def main():
+            gate = asyncio.Semaphore(concurrency)
+            await asyncio.gather(*(call(target, gate) for target in targets))
+
+        with probe.measure(trace):
+            asyncio.run(main())
+        return probe.summary()
+
+
+class _Timing:
+    status = 0
+
+
+class _Probe:
+    # Latencies, statuses, requests in flight, threads and Python allocations of one run
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.peak_threads = 0
+        self.elapsed = 0.0
+        self.peak_alloc = 0
+
+    @contextlib.contextmanager
+    def request(self):
+        timing = _Timing()
+        started = time.perf_counter()
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+        failed = True
+        try:
+            yield timing
+            failed = timing.status >= 400
+        except Exception:
+            # Counted as an error; one failure does not stop the run
+            pass
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.in_flight -= 1
+                self.latencies.append(elapsed)
+                self.errors += failed
+
+    @contextlib.contextmanager
+    def measure(self, trace=False):
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed = time.perf_counter() - started
+            if trace:
+                self.peak_alloc = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+    def summary(self):
+        values = sorted(self.latencies)
+        if not values:
+            values = [0.0]
+
+        def percentile(share):
+            return values[min(len(values) - 1, int(len(values) * share))]
+
+        return {
+            'throughput': len(self.latencies) / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': statistics.median(values),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'peak_in_flight': self.peak_in_flight,
+            'peak_threads': self.peak_threads,
+            'peak_alloc_mb': self.peak_alloc / (1024 * 1024),
+            'errors': self.errors,
+        }
@@ -0,0 +1,66 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from massitfab.settings import connectDB, disconnectDB
+
+SQL_DIR = Path(settings.BASE_DIR) / 'massitfab' / 'etc' / 'sql'
+
+# Files starting with this marker run statement by statement in autocommit,
+# which CREATE INDEX CONCURRENTLY needs
+NO_TRANSACTION = '-- no-transaction'
+
+
+class Command(BaseCommand):
+    help = 'Apply the SQL files in massitfab/etc/sql that have not been applied yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--list', action='store_true',
+                            help='Only show which files are applied or pending')
+
+    def handle(self, *args, **options):
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS schema_migration (
+                    name text PRIMARY KEY,
+                    applied_at timestamp NOT NULL DEFAULT now()
+                )"""
+            )
+            conn.commit()
+            cur.execute("SELECT name FROM schema_migration")
+            applied = {row[0] for row in cur.fetchall()}
+
+            for path in sorted(SQL_DIR.glob('*.sql')):
+                if path.name in applied:
+                    if options['list']:
+                        self.stdout.write('[x] ' + path.name)
+                    continue
+                if options['list']:
+                    self.stdout.write('[ ] ' + path.name)
+                    continue
+
+                self.stdout.write('Applying %s...' % path.name, ending='')
+                sql = path.read_text(encoding='utf-8')
+                if sql.startswith(NO_TRANSACTION):
+                    conn.autocommit = True
+                    for statement in sql.split(';\n'):
+                        if statement.strip() and not _only_comments(statement):
+                            cur.execute(statement)
+                    conn.autocommit = False
+                else:
+                    cur.execute(sql)
+                cur.execute("INSERT INTO schema_migration (name) VALUES (%s)", [path.name])
+                conn.commit()
+                self.stdout.write(self.style.SUCCESS(' OK'))
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
+
+
+def _only_comments(statement):
+    return all(not line.strip() or line.strip().startswith('--')
+               for line in statement.splitlines())
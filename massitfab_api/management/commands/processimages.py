@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from massitfab.settings import connectDB, disconnectDB, log_error
+from massitfab_api.views import IMAGES
+
+
+class Command(BaseCommand):
+    help = 'Generate image variants for gallery images and profile pictures that have none yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Reprocess every image')
+
+    def handle(self, *args, **options):
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            cur.execute(
+                """SELECT resource FROM (
+                        SELECT resource FROM gallery
+                        UNION
+                        SELECT profile_picture FROM fab_user WHERE profile_picture IS NOT NULL
+                    ) uploads
+                    WHERE %s OR NOT EXISTS (SELECT 1 FROM media_variant mv WHERE mv.resource = uploads.resource)""",
+                [options['all']]
+            )
+            resources = [row[0] for row in cur.fetchall()]
+            conn.rollback()
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
+
+        done = 0
+        for resource in resources:
+            try:
+                IMAGES.process_now(resource)
+                done += 1
+            except Exception as error:
+                log_error('processimages', json.dumps({'resource': resource}), str(error))
+                self.stderr.write('%s: %s' % (resource, error))
+        self.stdout.write(self.style.SUCCESS('Processed %s of %s images' % (done, len(resources))))
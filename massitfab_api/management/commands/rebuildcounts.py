@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from massitfab.settings import connectDB, disconnectDB
+from massitfab_api import counts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the maintained listing totals in listing_count'
+
+    def handle(self, *args, **options):
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            counts.rebuild(cur)
+            conn.commit()
+            cur.execute("SELECT scope, COUNT(*), SUM(total) FROM listing_count GROUP BY scope ORDER BY scope")
+            for scope, owners, total in cur.fetchall():
+                self.stdout.write('%s: %s rows, %s total' % (scope, owners, total))
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
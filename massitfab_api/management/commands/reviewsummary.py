@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from massitfab.settings import connectDB, disconnectDB
+from massitfab_api import ratings
+
+
+class Command(BaseCommand):
+    help = ('Backfill review_summary from review, or with --check recompute it and report '
+            'products whose stored summary drifted. Safe to interrupt and re-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--check', action='store_true',
+                            help='Only report drift, write nothing; fails if any is found')
+        parser.add_argument('--show', type=int, default=20, help='Drifted products to print with --check')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        conn = None
+        try:
+            conn = connectDB()
+            cur = conn.cursor()
+            started = time.monotonic()
+            last_id = 0
+            changed = 0
+            drifted = 0
+            while True:
+                # Walk product ids in batches, one short transaction each
+                cur.execute(
+                    "SELECT MAX(id) FROM (SELECT id FROM product WHERE id > %s ORDER BY id LIMIT %s) batch",
+                    [last_id, batch_size]
+                )
+                max_id = cur.fetchone()[0]
+                if max_id is None:
+                    conn.rollback()
+                    break
+                if options['check']:
+                    for product_id, stored, actual in ratings.drift(cur, last_id, max_id):
+                        if drifted < options['show']:
+                            self.stdout.write('  product %s: stored %s, actual %s' % (product_id, stored, actual))
+                        drifted += 1
+                    conn.rollback()
+                else:
+                    changed += ratings.refresh(cur, last_id, max_id)
+                    conn.commit()
+                    self.stdout.write('  up to id %s: %s summaries written' % (max_id, changed))
+                last_id = max_id
+
+            elapsed = time.monotonic() - started
+            if options['check']:
+                if drifted:
+                    raise CommandError('%s products drifted (%.1fs)' % (drifted, elapsed))
+                self.stdout.write(self.style.SUCCESS('No drift (%.1fs)' % elapsed))
+            else:
+                self.stdout.write(self.style.SUCCESS(
+                    'Backfilled %s summaries in %.1fs' % (changed, elapsed)))
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
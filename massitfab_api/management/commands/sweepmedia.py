@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from massitfab.settings import connectDB, disconnectDB
+from massitfab_api.views import STORE
+
+
+class Command(BaseCommand):
+    help = 'Remove stored upload files that no media_blob row references, e.g. after a rolled back upload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=3600,
+                            help='Seconds a staged temp file may live before it counts as abandoned')
+
+    def handle(self, *args, **options):
+        conn = None
+        try:
+            conn = connectDB()
+            removed = STORE.sweep(conn, grace=options['grace'])
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
+        for path in removed:
+            self.stdout.write('  %s' % path)
+        self.stdout.write(self.style.SUCCESS('Removed %s unreferenced files' % len(removed)))
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from psycopg2.extras import execute_values
+
+# ==============================================================================
+# CONTENT-ADDRESSED MEDIA STORE
+# ==============================================================================
+
+# The default avatar every profile starts with; never removed from disk
+PROTECTED = {'public/img/sandy.png'}
+
+
+class ContentStore:
+    """Stores each distinct upload once, under the SHA-256 of its bytes.
+
+    ``save()`` hashes the upload while streaming it to disk and returns the
+    path to record in gallery.resource / fab_user.profile_picture. The
+    media_blob table counts how many rows point at each blob; ``release()``
+    drops one reference and ``collect()`` removes blobs that reached zero once
+    the caller has committed. Both sides take a transaction-scoped advisory
+    lock on the digest, so a blob is never deleted under a concurrent upload
+    of the same bytes. Blobs are moved into place before the upload commits,
+    so a rolled back upload leaves a file without a row; ``sweep()`` removes
+    those.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def save(self, cur, uploaded):
+        # Returns (resource, created); created is False for a duplicate
+        return self.save_many(cur, [uploaded])[0]
+
+    def save_many(self, cur, uploads):
+        """Store several uploads with one lock and one upsert round trip.
+
+        Returns a (resource, created) pair per upload, in order. Only the first
+        upload of bytes that were not stored before comes back as created.
+        """
+        if not uploads:
+            return []
+        os.makedirs(self.root, exist_ok=True)
+        staged = []
+        try:
+            for uploaded in uploads:
+                staged.append(self._stage(uploaded))
+
+            blobs = {}
+            for digest, size, tmp, extension in staged:
+                if digest not in blobs:
+                    blobs[digest] = [self._path(digest, extension), size, 0, tmp]
+                blobs[digest][2] += 1
+
+            # unnest() keeps the sorted order, so concurrent uploads lock in the same order
+            cur.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(d)) FROM unnest(%s::text[]) AS d",
+                [sorted(blobs)]
+            )
+            rows = execute_values(
+                cur,
+                """INSERT INTO media_blob (digest, resource, size, refcount) VALUES %s
+                    ON CONFLICT (digest) DO UPDATE SET refcount = media_blob.refcount + EXCLUDED.refcount
+                    RETURNING digest, resource, xmax = 0""",
+                [(digest, path, size, refs) for digest, (path, size, refs, _) in blobs.items()],
+                page_size=len(blobs),
+                fetch=True
+            )
+
+            stored = {}
+            for digest, resource, created in rows:
+                if created and not os.path.isfile(resource):
+                    os.makedirs(os.path.dirname(resource), exist_ok=True)
+                    os.replace(blobs[digest][3], resource)
+                stored[digest] = [resource, created]
+
+            saved = []
+            for digest, _, _, _ in staged:
+                resource, created = stored[digest]
+                saved.append((resource, created))
+                stored[digest][1] = False
+            return saved
+        finally:
+            for _, _, tmp, _ in staged:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def release(self, cur, resource):
+        # Drop one reference; returns what collect() should look at after commit
+        return self.release_many(cur, [resource])
+
+    def release_many(self, cur, resources):
+        # One reference per entry, so a resource listed twice loses two
+        if not resources:
+            return []
+        cur.execute(
+            """UPDATE media_blob m SET refcount = m.refcount - d.refs
+                FROM (SELECT r, COUNT(*) AS refs FROM unnest(%s::text[]) AS r GROUP BY r) d
+                WHERE m.resource = d.r
+                RETURNING m.digest, m.resource, m.refcount""",
+            [list(resources)]
+        )
+        rows = cur.fetchall()
+        garbage = [(digest, resource) for digest, resource, refcount in rows if refcount <= 0]
+        if garbage:
+            cur.execute(
+                "DELETE FROM media_blob WHERE digest = ANY(%s)",
+                [[digest for digest, _ in garbage]]
+            )
+
+        counted = {resource for _, resource, _ in rows}
+        for resource in dict.fromkeys(resources):
+            # Stored before the content store existed: only this row used it
+            if resource not in counted and resource not in PROTECTED:
+                garbage.append((None, resource))
+        return garbage
+
+    def collect(self, conn, garbage):
+        # Remove unreferenced blobs and their variants; call after commit
+        cur = conn.cursor()
+        for digest, resource in garbage:
+            if digest is not None:
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [digest])
+                cur.execute("SELECT 1 FROM media_blob WHERE digest = %s", [digest])
+                if cur.fetchone() is not None:
+                    # Uploaded again in the meantime
+                    conn.commit()
+                    continue
+            cur.execute("DELETE FROM media_variant WHERE resource = %s RETURNING variants", [resource])
+            paths = [resource]
+            for (variants,) in cur.fetchall():
+                paths.extend(variants.values())
+            # Still holding the digest lock, so no upload can revive it meanwhile
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            conn.commit()
+
+    def sweep(self, conn, grace=3600):
+        """Remove blob files no media_blob row points at.
+
+        Those are left behind by uploads whose transaction rolled back. Staged
+        temp files older than ``grace`` seconds are removed too. Returns the
+        removed paths.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        cur = conn.cursor()
+        removed = []
+        for directory, _, names in os.walk(self.root):
+            if directory == self.root:
+                # Temp files of uploads still in flight are younger than grace
+                cutoff = time.time() - grace
+                for name in names:
+                    path = os.path.join(directory, name)
+                    if os.path.getmtime(path) < cutoff:
+                        removed.extend(self._remove(path))
+                continue
+
+            blobs = {name[:64]: os.path.join(directory, name).replace('\\', '/') for name in names}
+            if not blobs:
+                continue
+            cur.execute("SELECT digest FROM media_blob WHERE digest = ANY(%s)", [list(blobs)])
+            known = {row[0] for row in cur.fetchall()}
+            for digest, path in blobs.items():
+                if digest in known:
+                    continue
+                # Under the digest lock an upload either committed its row or
+                # has not moved its file in yet
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [digest])
+                cur.execute("SELECT 1 FROM media_blob WHERE digest = %s", [digest])
+                if cur.fetchone() is None:
+                    removed.extend(self._remove(path))
+                conn.commit()
+            conn.rollback()
+        return removed
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return [path]
+        except OSError:
+            return []
+
+    def _stage(self, uploaded):
+        # Hash the upload while streaming it into a temp file next to the blobs
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as tmp:
+            for chunk in uploaded.chunks():
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size, tmp.name, os.path.splitext(uploaded.name)[1].lower()
+
+    def _path(self, digest, extension):
+        # Fan out over two directory levels to keep directories small
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + extension).replace('\\', '/')
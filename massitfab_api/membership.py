@@ -0,0 +1,77 @@
+from massitfab.settings import STATEMENTS, verifyToken
+
+from .pagination import MAX_ID
+
+# ==============================================================================
+# WISHLIST AND CART MEMBERSHIP
+# ==============================================================================
+
+# Which products of a grid the user has in the wishlist and in the cart, in
+# one query over the (user, product) unique indexes. The answer comes back as
+# two bitmaps aligned with the requested ids: '0110' means the 2nd and 3rd
+# products are in.
+
+MAX_IDS = 100
+
+# Parameters: user, user, ids
+MEMBERSHIP_SQL = """
+    SELECT i.id,
+        EXISTS (SELECT 1 FROM wishlist w WHERE w.fab_user_id = %s AND w.product_id = i.id),
+        EXISTS (SELECT 1 FROM customer c WHERE c.fab_user_id = %s AND c.product_id = i.id AND c.in_cart = true)
+    FROM unnest(%s::bigint[]) WITH ORDINALITY AS i(id, n)
+    ORDER BY i.n"""
+MEMBERSHIP = STATEMENTS.register('membership', MEMBERSHIP_SQL)
+
+
+class InvalidIds(ValueError):
+    pass
+
+
+def parse_ids(value):
+    # "1,2,3" -> [1, 2, 3]
+    try:
+        ids = [int(part) for part in str(value or '').split(',') if part.strip()]
+    except ValueError:
+        raise InvalidIds('ids must be a comma separated list of product ids')
+    if not ids:
+        raise InvalidIds('ids is required')
+    if len(ids) > MAX_IDS:
+        raise InvalidIds('At most %s ids per request' % MAX_IDS)
+    if any(not 1 <= id <= MAX_ID for id in ids):
+        raise InvalidIds('ids must be positive bigint product ids')
+    return ids
+
+
+def wants_inline(query_params):
+    # ?membership=true on a listing adds the user's membership of the page
+    return str(query_params.get('membership', '')).lower() in ('1', 'true', 'yes')
+
+
+def authorize(request):
+    # The user id for an inline lookup, or the failed verifyToken() result
+    auth = verifyToken(request.headers.get('Authorization'))
+    if auth.get('status') != 200:
+        return None, auth
+    return auth.get('user_id'), auth
+
+
+def lookup(cur, user_id, ids):
+    if not ids:
+        return bitmaps([])
+    STATEMENTS.execute(cur, MEMBERSHIP, [user_id, user_id, ids])
+    return bitmaps(cur.fetchall())
+
+
+async def alookup(cur, user_id, ids):
+    if not ids:
+        return bitmaps([])
+    await STATEMENTS.aexecute(cur, MEMBERSHIP, [user_id, user_id, ids])
+    return bitmaps(await cur.fetchall())
+
+
+def bitmaps(rows):
+    return {
+        'ids': [row[0] for row in rows],
+        'wishlist': ''.join('1' if row[1] else '0' for row in rows),
+        'cart': ''.join('1' if row[2] else '0' for row in rows),
+    }
@@ -0,0 +1,80 @@
+import base64
+import json
+from datetime import datetime
+
+# ==============================================================================
+# KEYSET (SEEK) PAGINATION
+# ==============================================================================
+
+# Listings are ordered by (created_at DESC, id DESC). A cursor is the opaque
+# encoding of the last (created_at, id) pair a client has seen; the next page
+# seeks strictly past it instead of counting through an OFFSET.
+
+
+# Ids are bigint; anything outside this range cannot match and would fail the query
+MAX_ID = 2 ** 63 - 1
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def wants_cursor(query_params):
+    # ?cursor= (even empty, for the first page) switches a listing to keyset mode
+    return 'cursor' in query_params
+
+
+def encode_cursor(created_at, id):
+    raw = json.dumps([created_at.isoformat(), id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        created_at, id = json.loads(raw)
+        created_at, id = datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+    if not 1 <= id <= MAX_ID:
+        raise InvalidCursor('Invalid cursor')
+    return created_at, id
+
+
+def parse_page_size(query_params, name='page_size', default=9):
+    # A client-supplied page size; anything below one reads as one row
+    return max(int(query_params.get(name, default)), 1)
+
+
+def seek_clause(after, created_at='created_at', id='p.id'):
+    # SQL fragment and params restricting rows to those after the cursor
+    if after is None:
+        return '', []
+    return ' AND (%s, %s) < (%%s, %%s)' % (created_at, id), list(after)
+
+
+def cursor_page(rows, page_size, key):
+    # rows were fetched with LIMIT page_size + 1 so the extra one tells has_next
+    page_size = max(page_size, 1)
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+    next_cursor = encode_cursor(*key(rows[-1])) if has_next else None
+    pagination = {
+        'page_size': page_size,
+        'has_next': has_next,
+        'next_cursor': next_cursor,
+    }
+    return rows, pagination
+
+
+def offset_page(rows, page, page_size):
+    # Same LIMIT page_size + 1 trick for page/page_size listings
+    has_next = len(rows) > page_size
+    pagination = {
+        'page': page,
+        'page_size': page_size,
+        'has_next': has_next,
+    }
+    return rows[:page_size], pagination
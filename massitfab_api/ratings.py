@@ -0,0 +1,117 @@
+from massitfab.settings import STATEMENTS
+
+# ==============================================================================
+# REVIEW SUMMARY
+# ==============================================================================
+
+# Count, sum and 1-5 histogram of each product's scores live in
+# review_summary. create_review and delete_review bump them inside their own
+# transaction, so reads join one row instead of aggregating review. Scores
+# outside 1-5 count towards count and sum but no histogram bucket.
+
+COLUMNS = 'product_id, review_count, score_sum, score_1, score_2, score_3, score_4, score_5'
+
+# Parameters: product, score, delta (1 for a new review, -1 for a deleted one)
+RECORD_SQL = """
+    INSERT INTO review_summary (""" + COLUMNS + """)
+    SELECT v.product_id, v.delta, v.delta * v.score,
+        CASE WHEN v.score = 1 THEN v.delta ELSE 0 END, CASE WHEN v.score = 2 THEN v.delta ELSE 0 END,
+        CASE WHEN v.score = 3 THEN v.delta ELSE 0 END, CASE WHEN v.score = 4 THEN v.delta ELSE 0 END,
+        CASE WHEN v.score = 5 THEN v.delta ELSE 0 END
+    FROM (SELECT %s::bigint AS product_id, %s::int AS score, %s::int AS delta) v
+    ON CONFLICT (product_id) DO UPDATE SET
+        review_count = review_summary.review_count + EXCLUDED.review_count,
+        score_sum = review_summary.score_sum + EXCLUDED.score_sum,
+        score_1 = review_summary.score_1 + EXCLUDED.score_1,
+        score_2 = review_summary.score_2 + EXCLUDED.score_2,
+        score_3 = review_summary.score_3 + EXCLUDED.score_3,
+        score_4 = review_summary.score_4 + EXCLUDED.score_4,
+        score_5 = review_summary.score_5 + EXCLUDED.score_5"""
+RECORD = STATEMENTS.register('review_summary_record', RECORD_SQL)
+
+# What the summaries of products in (first, last] should be. Parameters: first, last
+ACTUAL_SQL = """
+    SELECT p.id AS product_id, COUNT(r.id) AS review_count, COALESCE(SUM(r.score), 0) AS score_sum,
+        COUNT(*) FILTER (WHERE r.score = 1) AS score_1, COUNT(*) FILTER (WHERE r.score = 2) AS score_2,
+        COUNT(*) FILTER (WHERE r.score = 3) AS score_3, COUNT(*) FILTER (WHERE r.score = 4) AS score_4,
+        COUNT(*) FILTER (WHERE r.score = 5) AS score_5
+    FROM product p LEFT JOIN review r ON r.product_id = p.id
+    WHERE p.id > %s AND p.id <= %s
+    GROUP BY p.id"""
+
+# Rewrites the summaries that differ; products without reviews get no row
+REFRESH_SQL = """
+    WITH actual AS (""" + ACTUAL_SQL + """
+    ), written AS (
+        INSERT INTO review_summary (""" + COLUMNS + """)
+        SELECT """ + COLUMNS + """ FROM actual a
+        WHERE a.review_count > 0 OR EXISTS (SELECT 1 FROM review_summary s WHERE s.product_id = a.product_id)
+        ON CONFLICT (product_id) DO UPDATE SET
+            review_count = EXCLUDED.review_count, score_sum = EXCLUDED.score_sum,
+            score_1 = EXCLUDED.score_1, score_2 = EXCLUDED.score_2, score_3 = EXCLUDED.score_3,
+            score_4 = EXCLUDED.score_4, score_5 = EXCLUDED.score_5
+        WHERE (review_summary.review_count, review_summary.score_sum, review_summary.score_1,
+                review_summary.score_2, review_summary.score_3, review_summary.score_4, review_summary.score_5)
+            IS DISTINCT FROM (EXCLUDED.review_count, EXCLUDED.score_sum, EXCLUDED.score_1,
+                EXCLUDED.score_2, EXCLUDED.score_3, EXCLUDED.score_4, EXCLUDED.score_5)
+        RETURNING product_id
+    )
+    SELECT COUNT(*) FROM written"""
+
+# Stored and actual totals of every drifted product; a missing row reads as zeros
+DRIFT_SQL = """
+    WITH actual AS (""" + ACTUAL_SQL + """
+    ), stored AS (
+        SELECT a.product_id,
+            ARRAY[COALESCE(s.review_count, 0), COALESCE(s.score_sum, 0), COALESCE(s.score_1, 0),
+                COALESCE(s.score_2, 0), COALESCE(s.score_3, 0), COALESCE(s.score_4, 0),
+                COALESCE(s.score_5, 0)]::bigint[] AS stored,
+            ARRAY[a.review_count, a.score_sum, a.score_1, a.score_2, a.score_3, a.score_4,
+                a.score_5]::bigint[] AS actual
+        FROM actual a LEFT JOIN review_summary s ON s.product_id = a.product_id
+    )
+    SELECT product_id, stored, actual FROM stored WHERE stored <> actual ORDER BY product_id"""
+
+
+def record(cur, product_id, score, delta):
+    STATEMENTS.execute(cur, RECORD, [product_id, score, delta])
+
+
+def refresh(cur, first_id, last_id):
+    # Recompute products in (first_id, last_id]; returns how many rows changed.
+    # Review writers wait until the caller's transaction ends.
+    cur.execute("LOCK TABLE review IN SHARE MODE")
+    cur.execute(REFRESH_SQL, [first_id, last_id])
+    return cur.fetchone()[0]
+
+
+def drift(cur, first_id, last_id):
+    # [(product_id, stored, actual)] for products in (first_id, last_id]
+    cur.execute(DRIFT_SQL, [first_id, last_id])
+    return cur.fetchall()
+
+
+def rebuild(cur):
+    # Recompute every summary in one go, for bulk loaders that just wrote review
+    cur.execute("LOCK TABLE review IN SHARE MODE")
+    cur.execute("DELETE FROM review_summary")
+    cur.execute(
+        "INSERT INTO review_summary (" + COLUMNS + """)
+            SELECT product_id, COUNT(*), SUM(score),
+                COUNT(*) FILTER (WHERE score = 1), COUNT(*) FILTER (WHERE score = 2),
+                COUNT(*) FILTER (WHERE score = 3), COUNT(*) FILTER (WHERE score = 4),
+                COUNT(*) FILTER (WHERE score = 5)
+            FROM review GROUP BY product_id"""
+    )
+
+
+def summary(count, total, histogram=None):
+    # JSON for the summary columns of a listing or detail row; no row reads as no reviews
+    count = count or 0
+    rating = {
+        'count': count,
+        'average': round(float(total) / count, 2) if count else None,
+    }
+    if histogram is not None:
+        rating['histogram'] = [n or 0 for n in histogram]
+    return rating
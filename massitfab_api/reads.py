@@ -0,0 +1,165 @@
+from massitfab.settings import STATEMENTS, USER_CARDS
+
+from . import images, ratings
+
+# ==============================================================================
+# READ QUERIES
+# ==============================================================================
+
+# SQL and row serialization of the hot read endpoints. Both the sync views and
+# their async twins in async_views use these, so the two paths always return
+# the same JSON.
+
+LISTING_SQL = """
+    SELECT p.id, title, description, banner, mv.variants, mv.placeholder, rs.review_count, rs.score_sum,
+        subcategory_id, st_price, created_at
+    FROM product p LEFT JOIN media_variant mv ON mv.resource = p.banner
+    LEFT JOIN review_summary rs ON rs.product_id = p.id
+    WHERE is_removed = FALSE AND banner IS NOT NULL"""
+
+# The product with its gallery and links aggregated by Postgres, in one row
+PRODUCT_DETAIL_SQL = """
+    SELECT title, description, schedule, fab_user_id, start_date, end_date, subcategory_id, hashtags, st_price,
+        created_at, updated_at, is_removed,
+        ARRAY(SELECT g.resource FROM gallery g WHERE g.product_id = p.id ORDER BY g.id) AS gallery,
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'resource', g.resource, 'variants', mv.variants, 'placeholder', mv.placeholder) ORDER BY g.id)
+            FROM gallery g LEFT JOIN media_variant mv ON mv.resource = g.resource
+            WHERE g.product_id = p.id
+        ), '[]'::json) AS gallery_variants,
+        ARRAY(SELECT r.source FROM route r WHERE r.product_id = p.id ORDER BY r.id) AS link,
+        rs.review_count, rs.score_sum, ARRAY[rs.score_1, rs.score_2, rs.score_3, rs.score_4, rs.score_5]
+    FROM product p LEFT JOIN review_summary rs ON rs.product_id = p.id WHERE p.id = %s"""
+PRODUCT_DETAIL = STATEMENTS.register('product_detail', PRODUCT_DETAIL_SQL)
+
+REVIEWS_SQL = """
+    SELECT id, score, comment, fab_user_id, created_at FROM review
+    WHERE product_id = %s AND id > %s ORDER BY id LIMIT %s"""
+REVIEWS = STATEMENTS.register('reviews_page', REVIEWS_SQL)
+
+# Public cards of a page's reviewers, in one query for the ids the cache lacks
+USER_CARDS_SQL = """
+    SELECT u.id, u.username, u.profile_picture, mv.variants FROM fab_user u
+    LEFT JOIN media_variant mv ON mv.resource = u.profile_picture
+    WHERE u.id = ANY(%s)"""
+USER_CARDS_QUERY = STATEMENTS.register('user_cards', USER_CARDS_SQL)
+
+
+def row_key(row):
+    # (created_at, id) of a LISTING_SQL row, for keyset cursors
+    return row[-1], row[0]
+
+
+def feed_product(row):
+    return {
+        'id': row[0],
+        'title': row[1],
+        'description': row[2],
+        'banner': images.variant(row[4], 'card', row[3]),
+        'banner_variants': row[4],
+        'banner_placeholder': row[5],
+        'rating': ratings.summary(row[6], row[7]),
+        'subcategory_id': row[-3],
+        'st_price': float(row[-2]),
+        'created_at': row[-1].strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+    }
+
+
+def search_product(row):
+    return {
+        'id': row[0],
+        'title': row[1],
+        'description': row[2],
+        'banner': images.variant(row[4], 'card', row[3]),
+        'banner_variants': row[4],
+        'banner_placeholder': row[5],
+        'rating': ratings.summary(row[6], row[7]),
+        'subcategory_id': row[-3],
+        'price': row[-2],
+        'created_at': row[-1].strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def fetch_product(cur, id):
+    # One round trip, as a statement the connection has prepared
+    STATEMENTS.execute(cur, PRODUCT_DETAIL, [id])
+    return cur.fetchone()
+
+
+def product_details(id, result):
+    return {
+        "id": id,
+        "title": result[0],
+        "description": result[1],
+        "schedule": result[2],
+        "owner": result[3],
+        "start_date": result[4],
+        "end_date": result[5],
+        "categories": result[6],
+        "hashtags": result[7],
+        "price": result[8],
+        "published": result[9],
+        "edited": result[10],
+        "gallery": result[12],
+        "gallery_variants": result[13],
+        "link": result[14],
+        "rating": ratings.summary(result[15], result[16], result[17])
+    }
+
+
+def user_card(row):
+    return {
+        'id': row[0],
+        'username': row[1],
+        'profile_picture': images.variant(row[3], 'thumb', row[2]),
+        'profile_picture_variants': row[3],
+    }
+
+
+def reviewers(cur, rows):
+    # {user_id: card} for the authors of a reviews page
+    cards, missing, generation = USER_CARDS.lookup(row[3] for row in rows)
+    if missing:
+        STATEMENTS.execute(cur, USER_CARDS_QUERY, [missing])
+        read = {row[0]: user_card(row) for row in cur.fetchall()}
+        USER_CARDS.fill(read, generation)
+        cards.update(read)
+    return cards
+
+
+async def areviewers(cur, rows):
+    # reviewers() on a psycopg 3 async cursor
+    cards, missing, generation = USER_CARDS.lookup(row[3] for row in rows)
+    if missing:
+        await STATEMENTS.aexecute(cur, USER_CARDS_QUERY, [missing])
+        read = {row[0]: user_card(row) for row in await cur.fetchall()}
+        USER_CARDS.fill(read, generation)
+        cards.update(read)
+    return cards
+
+
+def reviewer_tags(rows):
+    # Cache tags of a reviews page, so a profile change purges the pages showing it
+    return ['reviewer:%s' % user_id for user_id in dict.fromkeys(row[3] for row in rows)]
+
+
+def review(row, cards):
+    return {
+        'id': row[0],
+        'score': row[1],
+        'comment': row[2],
+        'user_id': row[3],
+        'user': cards.get(row[3]),
+        'created_at': row[4].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    }
+
+
+def reviews_page(rows, cards):
+    return {
+        'reviews': [review(row, cards) for row in rows],
+        "pagination": {
+            "has_next": bool(rows),
+            "cursor": rows[-1][0] if rows else None
+        },
+    }
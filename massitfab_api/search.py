@@ -0,0 +1,42 @@
+import re
+
+# ==============================================================================
+# PRODUCT SEARCH
+# ==============================================================================
+
+# fulltext: ranked match of every word (as a prefix) against search_vector
+# fuzzy: trigram similarity / substring match on the title, used when the
+#        full-text search finds nothing, e.g. for typos or word fragments
+FULLTEXT = 'fulltext'
+FUZZY = 'fuzzy'
+MODES = (FULLTEXT, FUZZY)
+
+
+def prefix_tsquery(keyword):
+    # "red sho" -> "red:* & sho:*" so results follow the user while typing
+    words = re.findall(r'\w+', keyword)
+    return ' & '.join(word + ':*' for word in words)
+
+
+def initial_mode(keyword):
+    if not keyword.strip():
+        return None
+    return FULLTEXT if prefix_tsquery(keyword) else FUZZY
+
+
+def match_clause(mode, keyword):
+    # WHERE fragment (to AND onto the listing filter) and its params
+    if mode == FULLTEXT:
+        return " AND search_vector @@ to_tsquery('simple', %s)", [prefix_tsquery(keyword)]
+    if mode == FUZZY:
+        return " AND (title %% %s OR title ILIKE %s)", [keyword, '%' + keyword + '%']
+    return '', []
+
+
+def rank_clause(mode, keyword):
+    # ORDER BY prefix putting the best matches first
+    if mode == FULLTEXT:
+        return "ts_rank(search_vector, to_tsquery('simple', %s)) DESC, ", [prefix_tsquery(keyword)]
+    if mode == FUZZY:
+        return "similarity(title, %s) DESC, ", [keyword]
+    return '', []
@@ -80,5 +80,5 @@ class AddToWishlistSerializer(serializers.Serializer):
     product_id = serializers.CharField()
 
 class CreateReviewSerializer(serializers.Serializer):
-    score = serializers.CharField()
+    score = serializers.IntegerField(min_value=1, max_value=5)
     comment = serializers.CharField(required=False, allow_blank=True)
\ No newline at end of file
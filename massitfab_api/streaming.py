@@ -0,0 +1,159 @@
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+from massitfab.settings import connectDB, disconnectDB, log_error
+
+# ==============================================================================
+# STREAMED LISTS
+# ==============================================================================
+
+# Unbounded lists are read through a server-side (named) cursor CHUNK rows at
+# a time and encoded as they arrive. Only one chunk is ever held in memory,
+# and the first bytes leave before the last row is read.
+
+CHUNK = 500
+
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+
+
+def content_type(request):
+    # ?stream=ndjson or an Accept header asking for NDJSON; JSON otherwise
+    if request.GET.get('stream') == 'ndjson' or NDJSON in request.headers.get('Accept', ''):
+        return NDJSON
+    return JSON
+
+
+class Rows:
+    """Batches of rows from a named cursor on the request's connection.
+
+    connectDB() hands back the connection leased to the current request, so
+    the view must not use it for anything else while the rows stream. The
+    query is declared right away, so the view can still answer 500 if it
+    fails. The cursor is closed and its transaction rolled back once the rows
+    are exhausted or the response is closed early; the lease itself goes
+    back to the pool when the request finishes.
+    """
+
+    def __init__(self, sql, params=(), chunk_size=CHUNK):
+        self.chunk_size = chunk_size
+        self.conn = connectDB()
+        try:
+            # A named cursor lives in the transaction, which release() rolls back
+            self.cur = self.conn.cursor(name='stream_%s' % uuid.uuid4().hex)
+            self.cur.itersize = chunk_size
+            self.cur.execute(sql, params)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        try:
+            while True:
+                rows = self.cur.fetchmany(self.chunk_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            self.close()
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        try:
+            if getattr(self, 'cur', None) is not None and not self.cur.closed:
+                self.cur.close()
+        except Exception:
+            pass
+        disconnectDB(conn)
+
+
+def response(request, rows, serialize, key, count_key, function_name, payload):
+    """Stream ``rows`` through ``serialize`` in the format ``request`` asked for.
+
+    As JSON the body is exactly what DRF would render for
+    ``{'data': {key: [...], count_key: n}, 'message': 'Амжилттай!'}``; as
+    NDJSON it is one item per line. Under ASGI the body is an async iterator,
+    since Django reads a sync one into memory in full before sending it.
+    """
+    mode = content_type(request)
+    if mode == NDJSON:
+        body = _ndjson(rows, serialize)
+    else:
+        body = _json(rows, serialize, key, count_key)
+    body = _Body(body, rows, function_name, payload)
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        body = _AsyncBody(body)
+    streamed = StreamingHttpResponse(body, content_type=mode)
+    # Let proxies pass chunks on as they come
+    streamed['X-Accel-Buffering'] = 'no'
+    return streamed
+
+
+def _dumps(value):
+    # Same encoding as DRF's JSONRenderer
+    return json.dumps(value, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+def _json(rows, serialize, key, count_key):
+    yield '{"data":{%s:[' % _dumps(key)
+    count = 0
+    for batch in rows:
+        yield (',' if count else '') + ','.join(_dumps(serialize(row)) for row in batch)
+        count += len(batch)
+    yield '],%s:%d},"message":%s}' % (_dumps(count_key), count, _dumps('Амжилттай!'))
+
+
+def _ndjson(rows, serialize):
+    for batch in rows:
+        yield ''.join(_dumps(serialize(row)) + '\n' for row in batch)
+
+
+class _Body:
+    # Django calls close() when the response is closed, even if it was never iterated
+
+    def __init__(self, chunks, rows, function_name, payload):
+        self.chunks = chunks
+        self.rows = rows
+        self.function_name = function_name
+        self.payload = payload
+
+    def __iter__(self):
+        # Headers are gone by now; a failure can only cut the body short
+        try:
+            for chunk in self.chunks:
+                yield chunk.encode()
+        except Exception as error:
+            log_error(self.function_name, json.dumps(self.payload), str(error))
+            raise
+        finally:
+            self.rows.close()
+
+    def close(self):
+        self.rows.close()
+
+
+class _AsyncBody:
+    # The same chunks for the ASGI handler, each pulled on the request's sync
+    # thread, so still only one batch is in memory at a time
+
+    def __init__(self, body):
+        self.body = body
+
+    async def __aiter__(self):
+        chunks = iter(self.body)
+        pull = sync_to_async(next, thread_sensitive=True)
+        while True:
+            chunk = await pull(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        self.body.close()
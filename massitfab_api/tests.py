@@ -1,3 +1,725 @@
-from django.test import TestCase
+import base64
+import copy
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from massitfab import db
+from massitfab.cache import ResponseCache, cached_response, tag
+from massitfab.logwriter import LogWriter
+from massitfab.tokens import TokenCache
+from massitfab.usercards import UserCardCache
+
+from . import checkout, views
+from .categories import CategoryTree
+from .images import ImagePipeline, variant_stem
+from .media import ContentStore
+from .membership import MAX_IDS, InvalidIds, parse_ids
+from .pagination import MAX_ID, InvalidCursor, cursor_page, decode_cursor, encode_cursor, parse_page_size
+
+# These run without a database: views that need one get a fake connection.
+
+# ==============================================================================
+# CONNECTION POOL
+# ==============================================================================
+
+
+class _Conn:
+    def __init__(self, pool):
+        self.pool = pool
+        self.leased = False
+        self.closed = False
+        self.autocommit = False
+        self.born_at = self.last_used = time.monotonic()
+
+    def close(self):
+        self.closed = True
+
+    def get_transaction_status(self):
+        return 0
+
+    def rollback(self):
+        pass
+
+
+class PoolLeaseTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = db.ConnectionPool({}, max_size=1, acquire_timeout=0)
+        self.pool._connect = lambda: _Conn(self.pool)
+
+    def test_releasing_a_closed_connection_frees_its_slot(self):
+        for _ in range(3):
+            conn = self.pool.getconn()
+            conn.close()
+            db.release(conn)
+            db.release(conn)
+        self.assertEqual(self.pool.stats()['size'], 0)
+
+    def test_lease_replaces_a_closed_leased_connection(self):
+        db._begin_request()
+        try:
+            for _ in range(3):
+                conn = db.lease(self.pool)
+                conn.close()
+            self.assertFalse(db.lease(self.pool).closed)
+        finally:
+            db._end_request()
+        self.assertEqual(self.pool.stats()['size'], 1)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_closed_leased_connection_released_mid_request(self):
+        db._begin_request()
+        try:
+            conn = db.lease(self.pool)
+            conn.close()
+            db.release(conn)
+            self.assertIsNot(db.lease(self.pool), conn)
+        finally:
+            db._end_request()
+        self.assertEqual(self.pool.stats()['size'], 1)
+
+
+# ==============================================================================
+# BACKGROUND LOG WRITER
+# ==============================================================================
+
+
+class LogWriterTests(SimpleTestCase):
+    def test_a_rejected_batch_is_retried_row_by_row(self):
+        written = []
+
+        class Cursor:
+            def execute(self, sql, record):
+                if record[0] == 'bad':
+                    raise ValueError('invalid input syntax for type json')
+                written.append(record[0])
+
+        conn = mock.Mock()
+        conn.cursor.return_value = Cursor()
+        pool = mock.Mock()
+        pool.getconn.return_value = conn
+        writer = LogWriter(pool)
+        batch = [('a', None, '{}', None), ('bad', None, '{', None), ('b', None, '{}', None)]
+        for record in batch:
+            writer._queue.put(record)
+            writer._queue.get()
+
+        with mock.patch('massitfab.logwriter.execute_values', side_effect=ValueError('bad row')), \
+                mock.patch('builtins.print'):
+            writer._write_batch(batch)
+
+        self.assertEqual(written, ['a', 'b'])
+        self.assertEqual(writer.stats()['written'], 2)
+        self.assertEqual(writer.stats()['failed'], 1)
+        self.assertEqual(writer._queue.unfinished_tasks, 0)
+        pool.putconn.assert_called_once_with(conn)
+
+
+# ==============================================================================
+# CATEGORY TREE
+# ==============================================================================
+
+
+class CategoryTreeTests(SimpleTestCase):
+    def _rebuild(self, tree, rows):
+        conn = mock.Mock()
+        conn.cursor.return_value.fetchall.return_value = rows
+        tree.invalidate()
+        return tree.rebuild(conn)
+
+    def test_etag_survives_a_rebuild_with_the_same_body(self):
+        tree = CategoryTree()
+        rows = [(1, 'Art', {'2': 'Painting'})]
+        first = self._rebuild(tree, rows)
+        self.assertEqual(self._rebuild(tree, list(rows)), first)
+        self.assertEqual(tree.version, 1)
+
+    def test_etag_changes_with_the_body(self):
+        tree = CategoryTree()
+        first = self._rebuild(tree, [(1, 'Art', {})])
+        second = self._rebuild(tree, [(1, 'Music', {})])
+        self.assertNotEqual(first[1], second[1])
+        self.assertEqual(tree.version, 2)
+
+
+# ==============================================================================
+# KEYSET CURSORS
+# ==============================================================================
+
+
+def _token(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        created_at = datetime(2024, 5, 17, 12, 30, 45, 123456)
+        self.assertEqual(decode_cursor(encode_cursor(created_at, 42)), (created_at, 42))
+
+    def test_round_trip_largest_id(self):
+        created_at = datetime(2024, 1, 1)
+        self.assertEqual(decode_cursor(encode_cursor(created_at, MAX_ID)), (created_at, MAX_ID))
+
+    def test_token_is_url_safe_without_padding(self):
+        token = encode_cursor(datetime(2024, 1, 1), 7)
+        self.assertNotIn('=', token)
+        self.assertRegex(token, r'^[A-Za-z0-9_-]+$')
+
+    def test_empty_means_first_page(self):
+        self.assertIsNone(decode_cursor(''))
+        self.assertIsNone(decode_cursor(None))
+
+    def test_rejects_garbage(self):
+        for token in ('not-a-cursor', '!!!', _token('x'), _token([]), _token(['2024-01-01'])):
+            with self.subTest(token=token):
+                with self.assertRaises(InvalidCursor):
+                    decode_cursor(token)
+
+    def test_rejects_bad_date_and_id(self):
+        for value in (['yesterday', 1], ['2024-01-01', 'one'], ['2024-01-01', None]):
+            with self.subTest(value=value):
+                with self.assertRaises(InvalidCursor):
+                    decode_cursor(_token(value))
+
+    def test_rejects_ids_outside_bigint(self):
+        for id in (0, -1, MAX_ID + 1, int('1' * 30)):
+            with self.subTest(id=id):
+                with self.assertRaises(InvalidCursor):
+                    decode_cursor(_token(['2024-01-01T00:00:00', id]))
+
+
+class PageSizeTests(SimpleTestCase):
+    def test_below_one_reads_as_one(self):
+        for value in ('0', '-5'):
+            with self.subTest(value=value):
+                self.assertEqual(parse_page_size({'page_size': value}), 1)
+        self.assertEqual(parse_page_size({}), 9)
+        self.assertEqual(parse_page_size({'limit': '4'}, 'limit'), 4)
+
+    def test_cursor_page_with_no_rows_to_show(self):
+        row = (datetime(2024, 1, 1), 1)
+        rows, pagination = cursor_page([row], 0, lambda row: row)
+        self.assertEqual(rows, [row])
+        self.assertFalse(pagination['has_next'])
+        self.assertEqual(cursor_page([], 0, lambda row: row)[1]['next_cursor'], None)
+
+
+# ==============================================================================
+# RESPONSE CACHE
+# ==============================================================================
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def test_entries_expire_after_ttl(self):
+        cache = ResponseCache(ttl=30)
+        with mock.patch('massitfab.cache.time.monotonic', return_value=100.0):
+            cache.set('/a', b'a', 'application/json', ['feed'])
+        with mock.patch('massitfab.cache.time.monotonic', return_value=129.0):
+            self.assertEqual(cache.get('/a')['content'], b'a')
+        with mock.patch('massitfab.cache.time.monotonic', return_value=130.0):
+            self.assertIsNone(cache.get('/a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_per_entry_ttl(self):
+        cache = ResponseCache(ttl=30)
+        with mock.patch('massitfab.cache.time.monotonic', return_value=100.0):
+            cache.set('/a', b'a', 'application/json', ttl=5)
+        with mock.patch('massitfab.cache.time.monotonic', return_value=105.0):
+            self.assertIsNone(cache.get('/a'))
+
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set('/a', b'a', 'application/json')
+        cache.set('/b', b'b', 'application/json')
+        cache.get('/a')
+        cache.set('/c', b'c', 'application/json')
+        self.assertIsNotNone(cache.get('/a'))
+        self.assertIsNone(cache.get('/b'))
+        self.assertIsNotNone(cache.get('/c'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_purge_drops_every_entry_with_the_tag(self):
+        cache = ResponseCache()
+        cache.set('/feed', b'1', 'application/json', ['feed'])
+        cache.set('/product/1', b'2', 'application/json', ['product:1', 'seller:3'])
+        cache.set('/product/2', b'3', 'application/json', ['product:2', 'seller:3'])
+        cache.purge('seller:3')
+        self.assertIsNotNone(cache.get('/feed'))
+        self.assertIsNone(cache.get('/product/1'))
+        self.assertIsNone(cache.get('/product/2'))
+        self.assertEqual(cache.stats()['purged'], 2)
+        # Nothing left behind in the tag index
+        cache.purge('product:1', 'product:2')
+        self.assertEqual(cache.stats()['purged'], 2)
+
+    def test_replacing_an_entry_drops_its_old_tags(self):
+        cache = ResponseCache()
+        cache.set('/a', b'old', 'application/json', ['old'])
+        cache.set('/a', b'new', 'application/json', ['new'])
+        cache.purge('old')
+        self.assertEqual(cache.get('/a')['content'], b'new')
+
+    def test_hit_ratio(self):
+        cache = ResponseCache()
+        cache.set('/a', b'a', 'application/json')
+        cache.get('/a')
+        cache.get('/b')
+        self.assertEqual(cache.stats()['hit_ratio'], 0.5)
+
+
+class CachedResponseTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = ResponseCache()
+        self.calls = 0
+
+        @cached_response(self.cache)
+        def view(request):
+            self.calls += 1
+            return tag(HttpResponse(b'{}', content_type='application/json'), 'feed')
+        self.view = view
+
+    def test_second_anonymous_get_is_a_hit(self):
+        self.assertEqual(self.view(RequestFactory().get('/a', {'b': 2, 'a': 1}))['X-Cache'], 'MISS')
+        response = self.view(RequestFactory().get('/a', {'a': 1, 'b': 2}))
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.content, b'{}')
+        self.assertEqual(self.calls, 1)
+
+    def test_authorized_requests_reach_the_view(self):
+        self.view(RequestFactory().get('/a'))
+        self.view(RequestFactory().get('/a', HTTP_AUTHORIZATION='Bearer x'))
+        self.assertEqual(self.calls, 2)
+
+    def test_purge_makes_the_next_get_a_miss(self):
+        self.view(RequestFactory().get('/a'))
+        self.cache.purge('feed')
+        self.view(RequestFactory().get('/a'))
+        self.assertEqual(self.calls, 2)
+
+
+# ==============================================================================
+# VERIFIED TOKEN CACHE
+# ==============================================================================
+
+
+class TokenCacheTests(SimpleTestCase):
+    def test_kept_until_the_token_expires(self):
+        cache = TokenCache(max_ttl=300)
+        with mock.patch('massitfab.tokens.time.time', return_value=1000.0):
+            cache.set('token', {'user_id': 1}, exp=1060)
+        with mock.patch('massitfab.tokens.time.time', return_value=1059.0):
+            self.assertEqual(cache.get('token'), {'user_id': 1})
+        with mock.patch('massitfab.tokens.time.time', return_value=1060.0):
+            self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_never_longer_than_max_ttl(self):
+        cache = TokenCache(max_ttl=300)
+        with mock.patch('massitfab.tokens.time.time', return_value=1000.0):
+            cache.set('token', {'user_id': 1}, exp=10000)
+        with mock.patch('massitfab.tokens.time.time', return_value=1300.0):
+            self.assertIsNone(cache.get('token'))
+
+    def test_evicts_least_recently_used(self):
+        cache = TokenCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_disabled_stores_nothing(self):
+        cache = TokenCache(enabled=False)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+# ==============================================================================
+# WISHLIST AND CART MEMBERSHIP
+# ==============================================================================
+
+
+class ParseIdsTests(SimpleTestCase):
+    def test_parses_a_comma_separated_list(self):
+        self.assertEqual(parse_ids('3, 1,,2'), [3, 1, 2])
+        self.assertEqual(parse_ids(str(MAX_ID)), [MAX_ID])
+
+    def test_rejects_missing_and_malformed(self):
+        for value in (None, '', ' , ', '1,a', '1.5'):
+            with self.subTest(value=value):
+                with self.assertRaises(InvalidIds):
+                    parse_ids(value)
+
+    def test_rejects_too_many(self):
+        with self.assertRaises(InvalidIds):
+            parse_ids(','.join(['1'] * (MAX_IDS + 1)))
+
+    def test_rejects_ids_outside_bigint(self):
+        for value in ('0', '-5', '1,-1', str(MAX_ID + 1), '1' * 30):
+            with self.subTest(value=value):
+                with self.assertRaises(InvalidIds):
+                    parse_ids(value)
+
+
+# ==============================================================================
+# IMAGE VARIANTS
+# ==============================================================================
+
+
+class VariantStemTests(SimpleTestCase):
+    def test_same_name_different_extension(self):
+        self.assertNotEqual(variant_stem('public/img/a.png'), variant_stem('public/img/a.jpg'))
+
+    def test_same_name_different_directory(self):
+        self.assertNotEqual(variant_stem('public/img/x/a.png'), variant_stem('public/img/y/a.png'))
+
+    def test_stable_and_readable(self):
+        self.assertEqual(variant_stem('public/img/a.png'), variant_stem('public\\img\\a.png'))
+        self.assertTrue(variant_stem('public/img/a.png').startswith('a-'))
+
+
+class _FakePool:
+    def __init__(self):
+        self.saved = []
+
+    def getconn(self):
+        pool = self
+
+        class Cursor:
+            def execute(self, sql, params):
+                pool.saved.append(params[0])
+        return SimpleNamespace(cursor=Cursor, commit=lambda: None)
+
+    def putconn(self, conn):
+        pass
+
+
+class ImagePipelineTests(SimpleTestCase):
+    def setUp(self):
+        from PIL import Image
+
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.resource = os.path.join(self.dir, 'a.png')
+        Image.new('RGB', (40, 20)).save(self.resource)
+        self.pool = _FakePool()
+        self.pipeline = ImagePipeline(self.pool, os.path.join(self.dir, 'variants'), workers=1)
+        self.addCleanup(self.pipeline.shutdown)
+
+    def _submit(self):
+        saved = threading.Event()
+        future = self.pipeline.submit(self.resource, on_saved=saved.set)[0]
+        future.result(timeout=60)
+        self.assertTrue(saved.wait(10))
+
+    def test_records_then_calls_on_saved(self):
+        self._submit()
+        self.assertEqual(self.pool.saved, [self.resource])
+
+    def test_replaces_a_pool_broken_by_a_dead_worker(self):
+        executor = self.pipeline._get_executor()
+        with self.assertRaises(BrokenProcessPool):
+            executor.submit(os._exit, 1).result(timeout=60)
+        self._submit()
+        self.assertIsNot(self.pipeline._get_executor(), executor)
+
+
+# ==============================================================================
+# MEDIA STORE
+# ==============================================================================
+
+
+class _BlobCursor:
+    def __init__(self, digests):
+        self.digests = digests
+        self.rows = []
+
+    def execute(self, sql, params):
+        if 'ANY' in sql:
+            self.rows = [(digest,) for digest in params[0] if digest in self.digests]
+        elif 'FROM media_blob' in sql:
+            self.rows = [(1,)] if params[0] in self.digests else []
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+class ContentStoreSweepTests(SimpleTestCase):
+    def test_removes_only_unreferenced_blobs_and_stale_temp_files(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        store = ContentStore(root)
+        kept, orphan = 'a' * 64, 'b' * 64
+        for digest in (kept, orphan):
+            os.makedirs(os.path.dirname(store._path(digest, '.png')), exist_ok=True)
+            open(store._path(digest, '.png'), 'wb').close()
+        stale, fresh = os.path.join(root, 'tmpstale'), os.path.join(root, 'tmpfresh')
+        open(stale, 'wb').close()
+        open(fresh, 'wb').close()
+        os.utime(stale, (0, 0))
+
+        conn = mock.Mock()
+        conn.cursor.return_value = _BlobCursor({kept})
+        removed = store.sweep(conn, grace=60)
+
+        self.assertEqual(sorted(removed), sorted([store._path(orphan, '.png'), stale]))
+        self.assertTrue(os.path.exists(store._path(kept, '.png')))
+        self.assertTrue(os.path.exists(fresh))
+
+
+# ==============================================================================
+# USER CARD CACHE
+# ==============================================================================
+
+
+class UserCardCacheTests(SimpleTestCase):
+    def test_lookup_reports_missing_ids_once(self):
+        cache = UserCardCache()
+        found, missing, generation = cache.lookup([1, 2, 1])
+        self.assertEqual((found, missing), ({}, [1, 2]))
+        cache.fill({1: {'username': 'a'}, 2: {'username': 'b'}}, generation)
+        found, missing, _ = cache.lookup([2, 1, 3])
+        self.assertEqual(found, {1: {'username': 'a'}, 2: {'username': 'b'}})
+        self.assertEqual(missing, [3])
+
+    def test_evicts_least_recently_used(self):
+        cache = UserCardCache(max_entries=2)
+        _, _, generation = cache.lookup([])
+        cache.fill({1: 'a', 2: 'b'}, generation)
+        cache.lookup([1])
+        cache.fill({3: 'c'}, generation)
+        found, missing, _ = cache.lookup([1, 2, 3])
+        self.assertEqual(found, {1: 'a', 3: 'c'})
+        self.assertEqual(missing, [2])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_entries_expire_after_ttl(self):
+        cache = UserCardCache(ttl=300)
+        with mock.patch('massitfab.usercards.time.monotonic', return_value=100.0):
+            _, _, generation = cache.lookup([1])
+            cache.fill({1: 'a'}, generation)
+        with mock.patch('massitfab.usercards.time.monotonic', return_value=399.0):
+            self.assertEqual(cache.lookup([1])[0], {1: 'a'})
+        with mock.patch('massitfab.usercards.time.monotonic', return_value=400.0):
+            self.assertEqual(cache.lookup([1])[1], [1])
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_invalidate_drops_the_card(self):
+        cache = UserCardCache()
+        _, _, generation = cache.lookup([1, 2])
+        cache.fill({1: 'a', 2: 'b'}, generation)
+        cache.invalidate(1)
+        found, missing, _ = cache.lookup([1, 2])
+        self.assertEqual((found, missing), ({2: 'b'}, [1]))
+
+    def test_fill_read_before_invalidate_is_ignored(self):
+        cache = UserCardCache()
+        _, missing, generation = cache.lookup([1])
+        # The profile changes while the stale card is being read
+        cache.invalidate(1)
+        cache.fill({1: 'stale'}, generation)
+        self.assertEqual(cache.lookup([1])[1], [1])
+        _, _, generation = cache.lookup([1])
+        cache.fill({1: 'fresh'}, generation)
+        self.assertEqual(cache.lookup([1])[0], {1: 'fresh'})
+
+    def test_disabled_stores_nothing(self):
+        cache = UserCardCache(enabled=False)
+        _, _, generation = cache.lookup([1])
+        cache.fill({1: 'a'}, generation)
+        self.assertEqual(cache.lookup([1])[1], [1])
+
+
+# ==============================================================================
+# CHECKOUT
+# ==============================================================================
+
+
+class _Shop:
+    """In-memory stand-in for the rows checkout.run() touches.
+
+    Answers the checkout statements by their SQL, and keeps writes in a
+    transaction that commit() keeps and rollback() discards.
+    """
+
+    def __init__(self, balance, cart):
+        self.committed = {
+            'balance': balance,
+            # [product_id, price, in_cart, is_bought]
+            'cart': [[product_id, price, True, False] for product_id, price in cart],
+            'requests': {},
+        }
+        self.state = None
+
+    @property
+    def current(self):
+        return self.state if self.state is not None else self.committed
+
+    def cursor(self):
+        return _ShopCursor(self)
+
+    def commit(self):
+        if self.state is not None:
+            self.committed, self.state = self.state, None
+
+    def rollback(self):
+        self.state = None
+
+    def execute(self, sql, params):
+        if self.state is None:
+            self.state = copy.deepcopy(self.committed)
+        state = self.state
+        if sql == checkout.CHECKOUT_SQL:
+            moved = [row for row in state['cart'] if row[2]]
+            for row in moved:
+                row[2], row[3] = False, True
+            amount = sum(row[1] for row in moved)
+            debited = None
+            if state['balance'] >= amount:
+                state['balance'] -= amount
+                debited = state['balance']
+            return [(debited, amount, len(moved))]
+        user_id, key = params[-2:]
+        if sql == checkout.STATEMENTS.sql(checkout.CLAIM):
+            if (user_id, key) in state['requests']:
+                return [None]
+            state['requests'][(user_id, key)] = (None, None)
+            return [(1,)]
+        if sql == checkout.STATEMENTS.sql(checkout.REPLAY):
+            status, response = state['requests'][(user_id, key)]
+            return [(status, json.loads(response))]
+        if sql == checkout.STATEMENTS.sql(checkout.RECORD):
+            state['requests'][(user_id, key)] = (params[0], params[1])
+            return []
+        raise AssertionError('Unexpected statement: %s' % sql)
+
+
+class _ShopCursor:
+    def __init__(self, shop):
+        # No ``prepared`` set on it, so statements arrive as plain SQL
+        self.connection = shop
+        self.shop = shop
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        self.rows = self.shop.execute(sql, params)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+class CheckoutCartTests(SimpleTestCase):
+    USER_ID = 7
+
+    def setUp(self):
+        self.shop = _Shop(balance=100, cart=[(1, 30), (2, 50)])
+        self.connect = mock.patch('massitfab_api.views.connectDB', return_value=self.shop).start()
+        mock.patch('massitfab_api.views.disconnectDB').start()
+        mock.patch('massitfab_api.views.verifyToken',
+                   return_value={'status': 200, 'user_id': self.USER_ID}).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def post(self, key=None):
+        headers = {'HTTP_AUTHORIZATION': 'Bearer test'}
+        if key is not None:
+            headers['HTTP_IDEMPOTENCY_KEY'] = key
+        request = APIRequestFactory().post('/api/cart/checkout', **headers)
+        force_authenticate(request, user=SimpleNamespace(is_authenticated=True))
+        response = views.checkout_cart(request)
+        # Every outcome ends its transaction itself
+        self.assertIsNone(self.shop.state)
+        return response
+
+    def bought(self):
+        return [row[0] for row in self.shop.committed['cart'] if row[3]]
+
+    def in_cart(self):
+        return [row[0] for row in self.shop.committed['cart'] if row[2]]
+
+    def test_debits_and_buys_the_cart(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['data'], {'balance': 20, 'bought_items': 2})
+        self.assertEqual(self.shop.committed['balance'], 20)
+        self.assertEqual(self.bought(), [1, 2])
+        self.assertEqual(self.in_cart(), [])
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    def test_insufficient_balance_rolls_the_cart_back(self):
+        self.shop.committed['balance'] = 70
+        response = self.post()
+        self.assertEqual(response.status_code, 406)
+        self.assertEqual(self.shop.committed['balance'], 70)
+        self.assertEqual(self.in_cart(), [1, 2])
+        self.assertEqual(self.bought(), [])
+
+    def test_balance_never_goes_negative(self):
+        self.assertEqual(self.post().status_code, 202)
+        self.shop.committed['cart'].append([3, 25, True, False])
+        self.assertEqual(self.post().status_code, 406)
+        self.assertEqual(self.shop.committed['balance'], 20)
+        self.assertEqual(self.in_cart(), [3])
+
+    def test_retry_with_the_same_key_replays_the_stored_response(self):
+        first = self.post('order-1')
+        self.shop.committed['cart'].append([3, 10, True, False])
+        retry = self.post('order-1')
+        self.assertEqual(retry.status_code, 202)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data, first.data)
+        # Charged once; the item added since is still in the cart
+        self.assertEqual(self.shop.committed['balance'], 20)
+        self.assertEqual(self.in_cart(), [3])
+
+    def test_a_new_key_checks_out_again(self):
+        self.post('order-1')
+        self.shop.committed['cart'].append([3, 10, True, False])
+        response = self.post('order-2')
+        self.assertEqual(response.data['data'], {'balance': 10, 'bought_items': 1})
+        self.assertNotIn('Idempotent-Replayed', response)
+
+    def test_failed_checkout_is_not_recorded(self):
+        self.shop.committed['balance'] = 70
+        self.assertEqual(self.post('order-1').status_code, 406)
+        self.assertEqual(self.shop.committed['requests'], {})
+        # Once the balance covers the cart, the same key goes through
+        self.shop.committed['balance'] = 100
+        response = self.post('order-1')
+        self.assertEqual(response.status_code, 202)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(self.shop.committed['balance'], 20)
+
+    def test_rejects_over_long_key(self):
+        response = self.post('k' * (checkout.MAX_KEY_LENGTH + 1))
+        self.assertEqual(response.status_code, 400)
+        self.connect.assert_not_called()
+        self.assertEqual(self.post('k' * checkout.MAX_KEY_LENGTH).status_code, 202)
+
+    def test_rejects_empty_key(self):
+        self.assertEqual(self.post('').status_code, 400)
+        self.connect.assert_not_called()
+
+    def test_requires_a_valid_token(self):
+        with mock.patch('massitfab_api.views.verifyToken', return_value={'status': 401, 'error': 'Invalid'}):
+            self.assertEqual(self.post().status_code, 401)
+        self.connect.assert_not_called()
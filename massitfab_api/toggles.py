@@ -0,0 +1,77 @@
+from massitfab.settings import STATEMENTS
+
+from . import counts
+
+# ==============================================================================
+# WISHLIST AND CART TOGGLES
+# ==============================================================================
+
+# Each toggle is one statement: delete the row if it is there, otherwise insert
+# it. The unique indexes from 0008_toggle_unique.sql make a concurrent second
+# tap a no-op instead of a duplicate row.
+
+# Parameters: user, product, counts.WISHLIST. The wishlist total is bumped in
+# the same statement, exactly as counts.bump() would.
+WISHLIST_SQL = """
+    WITH target AS (
+        SELECT %s::bigint AS user_id, %s::bigint AS product_id
+    ), removed AS (
+        DELETE FROM wishlist w USING target t
+        WHERE w.fab_user_id = t.user_id AND w.product_id = t.product_id
+        RETURNING w.id
+    ), added AS (
+        INSERT INTO wishlist (fab_user_id, product_id)
+        SELECT t.user_id, p.id FROM target t JOIN product p ON p.id = t.product_id
+        WHERE NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT (fab_user_id, product_id) DO NOTHING
+        RETURNING id
+    ), delta AS (
+        SELECT (SELECT COUNT(*) FROM added) - (SELECT COUNT(*) FROM removed) AS n
+    ), bumped AS (
+        INSERT INTO listing_count (scope, owner_id, total)
+        SELECT %s::text, t.user_id, d.n FROM target t, delta d WHERE d.n <> 0
+        ON CONFLICT (scope, owner_id) DO UPDATE SET total = listing_count.total + EXCLUDED.total
+    )
+    SELECT EXISTS (SELECT 1 FROM product p JOIN target t ON p.id = t.product_id),
+        (SELECT id FROM removed), (SELECT id FROM added)"""
+WISHLIST = STATEMENTS.register('toggle_wishlist', WISHLIST_SQL)
+
+# Parameters: user, product. Purchased products cannot go back into the cart.
+CART_SQL = """
+    WITH target AS (
+        SELECT %s::bigint AS user_id, %s::bigint AS product_id
+    ), bought AS (
+        SELECT 1 FROM customer c JOIN target t ON c.fab_user_id = t.user_id AND c.product_id = t.product_id
+        WHERE c.is_bought = true
+        LIMIT 1
+    ), removed AS (
+        DELETE FROM customer c USING target t
+        WHERE c.fab_user_id = t.user_id AND c.product_id = t.product_id AND c.in_cart = true
+        RETURNING c.id
+    ), added AS (
+        INSERT INTO customer (fab_user_id, product_id)
+        SELECT t.user_id, p.id FROM target t JOIN product p ON p.id = t.product_id
+        WHERE NOT EXISTS (SELECT 1 FROM removed) AND NOT EXISTS (SELECT 1 FROM bought)
+        ON CONFLICT (fab_user_id, product_id) WHERE in_cart = true DO NOTHING
+        RETURNING id
+    )
+    SELECT EXISTS (SELECT 1 FROM product p JOIN target t ON p.id = t.product_id), EXISTS (SELECT 1 FROM bought),
+        (SELECT id FROM removed), (SELECT id FROM added)"""
+CART = STATEMENTS.register('toggle_cart', CART_SQL)
+
+
+def wishlist(cur, user_id, product_id):
+    """Toggle a wishlist row.
+
+    Returns (exists, removed_id, added_id). Both ids are None when the product
+    does not exist, or when a concurrent request added it first; either way
+    the product is in the wishlist afterwards if it exists.
+    """
+    STATEMENTS.execute(cur, WISHLIST, [user_id, product_id, counts.WISHLIST])
+    return cur.fetchone()
+
+
+def cart(cur, user_id, product_id):
+    # Returns (exists, bought, removed_id, added_id)
+    STATEMENTS.execute(cur, CART, [user_id, product_id])
+    return cur.fetchone()
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.urls import path, re_path
 from .views import *
+from . import async_views
 
 app_name = 'mfApi'
 
@@ -18,6 +19,7 @@ urlpatterns = [
     path('u/wishlist/toggle', add_n_remove_from_wishlist, name='toggle_wishlist'),
     path('u/wishlist/getAll', get_allWishlist, name='get_allWishlist'),
     path('u/wishlist/get', get_wishlist, name='get_wishlist'),
+    path('u/membership', get_membership, name='get_membership'),
 
     path('review/create/<int:product_id>', create_review, name='create_review'),
     path('review/get/<int:product_id>', get_reviews, name="get_reviews"),
@@ -28,4 +30,11 @@ urlpatterns = [
     path('cart/get', get_cart_details, name='get_cart_details'),
 
     path('category/get', get_categories, name='get_categories'),
+
+    # Async twins of the read endpoints above, for workers served over ASGI
+    path('async/content/get/<int:id>', async_views.get_product_details, name='aget_content_details'),
+    path('async/content/get', async_views.get_products, name='aget_contents'),
+    path('async/content/search', async_views.search_products, name='asearch_products'),
+    path('async/review/get/<int:product_id>', async_views.get_reviews, name='aget_reviews'),
+    path('async/category/get', async_views.get_categories, name='aget_categories'),
 ]
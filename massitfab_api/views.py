@@ -6,19 +6,43 @@ from rest_framework.permissions import AllowAny
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
-from django.core.files.storage import FileSystemStorage
+from django.http import HttpResponse
 import math
 import json
 
 # Local Imports
-from massitfab.settings import connectDB, disconnectDB, verifyToken, log_error
+from massitfab.settings import connectDB, disconnectDB, verifyToken, log_error, RESPONSES, POOL, STATEMENTS, USER_CARDS
+from massitfab.cache import cached_response, tag
+from .categories import CategoryTree
+from .pagination import InvalidCursor, wants_cursor, decode_cursor, seek_clause, cursor_page, offset_page, parse_page_size
+from . import attachments, cards, checkout, counts, images, media, membership, ratings, reads, search, streaming, toggles
 from .serializers import CreateProductSerializer, CreateReviewSerializer, UpdateProductSerializer, UpdateProfileSerializer, AddToWishlistSerializer
 
+# Encoded category tree, rebuilt after CATEGORY_CACHE_TTL or invalidate()
+CATEGORIES = CategoryTree(ttl=settings.CATEGORY_CACHE_TTL)
+
+# Uploads, stored once per distinct content under public/img/blobs
+STORE = media.ContentStore(os.path.join(settings.MEDIA_ROOT, 'public', 'img', 'blobs'))
+
+# Resized WebP variants of uploads, produced in worker processes
+IMAGES = images.install(images.ImagePipeline(
+    POOL, os.path.join(settings.MEDIA_ROOT, 'public', 'img', 'variants'),
+    workers=settings.IMAGE_WORKERS))
+
+
+def process_images(view, resources, on_saved):
+    # The rows are already committed, so a failed submit only loses the variants
+    try:
+        IMAGES.submit(*resources, on_saved=on_saved)
+    except Exception as error:
+        log_error(view, json.dumps({'resources': list(resources)}), str(error))
+
 # ==============================================================================
 # PROFILE
 # ==============================================================================
 
 
+@cached_response(RESPONSES)
 @api_view(['GET'])
 @authentication_classes([])
 @permission_classes([AllowAny])
@@ -30,8 +54,9 @@ def get_profile(request, username):
         cur = conn.cursor()
 
         # Check if user does not exists while also retrieving the information
-        cur.execute(
-            "SELECT id, username, email, summary, profile_picture, balance, created_at FROM fab_user WHERE username = %s",
+        STATEMENTS.run(cur, 'profile_user',
+            """SELECT id, username, email, summary, profile_picture, balance, created_at, mv.variants FROM fab_user
+                LEFT JOIN media_variant mv ON mv.resource = profile_picture WHERE username = %s""",
             [username]
         )
         result = cur.fetchone()
@@ -46,24 +71,39 @@ def get_profile(request, username):
 
         # Get the page number and page size from the query parameters
         page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 9))
+        page_size = parse_page_size(request.GET)
 
         # Calculate the offset based on the page number and page size
         offset = (page - 1) * page_size
 
-        # Query the related products with pagination
-        cur.execute(
-            """
-                SELECT p.id, title, description, MIN(resource) as banner, st_price, created_at FROM product p
-                INNER JOIN gallery g on p.id = g.product_id
-                WHERE fab_user_id = %s AND is_removed = false
-                GROUP BY p.id
+        query = """
+                SELECT p.id, title, description, banner, mv.variants, mv.placeholder, rs.review_count, rs.score_sum,
+                st_price, created_at FROM product p
+                LEFT JOIN media_variant mv ON mv.resource = p.banner
+                LEFT JOIN review_summary rs ON rs.product_id = p.id
+                WHERE fab_user_id = %s AND is_removed = false AND banner IS NOT NULL"""
+        if wants_cursor(request.GET):
+            # Keyset mode: seek past the cursor instead of skipping rows
+            seek, seek_params = seek_clause(decode_cursor(request.GET.get('cursor')))
+            STATEMENTS.run(cur, 'profile_listing',
+                query + seek + """
+                ORDER BY created_at DESC, p.id DESC
+                LIMIT %s
+            """,
+                [result[0]] + seek_params + [page_size + 1]
+            )
+            results, pagination = cursor_page(
+                cur.fetchall(), page_size, lambda row: (row[-1], row[0]))
+        else:
+            # Query the related products with pagination
+            STATEMENTS.run(cur, 'profile_listing',
+                query + """
                 ORDER BY created_at DESC
                 LIMIT %s OFFSET %s
             """,
-            [result[0], page_size, offset]
-        )
-        results = cur.fetchall()
+                [result[0], page_size + 1, offset]
+            )
+            results, pagination = offset_page(cur.fetchall(), page, page_size)
 
         # Convert the result rows to a list of dictionaries
         products = []
@@ -72,20 +112,21 @@ def get_profile(request, username):
                 'id': row[0],
                 'title': row[1],
                 'description': row[2],
-                'banner': row[3],
+                'banner': images.variant(row[4], 'card', row[3]),
+                'banner_variants': row[4],
+                'banner_placeholder': row[5],
+                'rating': ratings.summary(row[6], row[7]),
                 'st_price': float(row[-2]),
                 'created_at': row[-1].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
             })
 
-        # Get the total count of related products
-        cur.execute(
-            "SELECT COUNT(*) FROM product WHERE fab_user_id = %s AND is_removed = False",
-            [result[0]]
-        )
-        total_count = cur.fetchone()[0]
+        if not wants_cursor(request.GET) and counts.wants_total(request.GET):
+            # Get the maintained total count of related products
+            total_count = counts.read(cur, counts.SELLER, result[0])
 
-        # Calculate the number of pages based on the total count and page size
-        num_pages = math.ceil(total_count / page_size)
+            # Calculate the number of pages based on the total count and page size
+            pagination['num_pages'] = math.ceil(total_count / page_size)
+            pagination['total_count'] = total_count
 
         resp = {
             "data": {
@@ -93,22 +134,20 @@ def get_profile(request, username):
                 # 'email': result[2],
                 'summary': result[3],
                 'profile_picture': result[4],
+                'profile_picture_variants': result[7],
                 'balance': result[5],
                 'created_at': result[6].strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
                 'related_products': products,
-                'list': {
-                    'page': page,
-                    'page_size': page_size,
-                    'num_pages': num_pages,
-                    'total_count': total_count
-                }
+                'list': pagination
             },
             "message": "Амжилттай!"
         }
-        return Response(
+        return tag(Response(
             resp,
             status=status.HTTP_200_OK
-        )
+        ), 'seller:%s' % result[0])
+    except InvalidCursor as error:
+        return Response({'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as error:
         log_error('get_profile', json.dumps(
             {"username": username, 'data': request.data}), str(error))
@@ -158,31 +197,36 @@ def update_profile(request):
         # Get the old profile picture from the database
         cur.execute(
             "SELECT profile_picture FROM fab_user WHERE id=%s", [fab_id])
-        oldpro = str(cur.fetchone()[0])
+        oldpro = cur.fetchone()[0]
         pro = data.get('profile_picture')
         profile_picture = None
+        created = False
 
         # Check if the request is valid
         if pro:
-            file_path = os.path.join(settings.MEDIA_ROOT, 'public', 'img')
-            storage = FileSystemStorage(location=file_path)
-
-            # Remove the old profile picture from local storage
-            if oldpro != 'public/img/sandy.png':
-                full_path = os.path.join(settings.MEDIA_ROOT, oldpro)
-                if os.path.isfile(full_path):
-                    os.remove(full_path)
-            filename = storage.save(pro.name, pro)
-            profile_picture = os.path.join(
-                file_path, filename).replace('\\', '/')
+            profile_picture, created = STORE.save(cur, pro)
         result_dict['profile_picture'] = profile_picture
 
+        # Release the old profile picture even when the same bytes were saved
+        # again, since save() took a new reference; the default avatar is never removed
+        garbage = []
+        if oldpro:
+            garbage = STORE.release(cur, oldpro)
+
         # Add the local path into the database
         values = (data.get('username'), data.get('summary') if data.get('summary')
                   else None, profile_picture, fab_id)
         cur.execute(
             "UPDATE fab_user SET username=%s, summary=%s, profile_picture=%s WHERE id=%s", values)
         conn.commit()
+        USER_CARDS.invalidate(fab_id)
+        RESPONSES.purge('seller:%s' % fab_id, 'reviewer:%s' % fab_id)
+        STORE.collect(conn, garbage)
+        if created:
+            def on_saved():
+                USER_CARDS.invalidate(fab_id)
+                RESPONSES.purge('seller:%s' % fab_id, 'reviewer:%s' % fab_id)
+            process_images('update_profile', [profile_picture], on_saved)
 
         result_dict['username'] = data.get('username')
         result_dict['summary'] = data.get(
@@ -211,10 +255,18 @@ def update_profile(request):
 # ==============================================================================
 
 
+@cached_response(RESPONSES)
 @api_view(['GET'])
 @authentication_classes([])
 @permission_classes([AllowAny])
 def get_products(request):  # Recently uploaded products
+    # ?membership=true adds the caller's wishlist and cart bitmaps for the page
+    inline = membership.wants_inline(request.query_params)
+    if inline:
+        user_id, auth = membership.authorize(request)
+        if user_id is None:
+            return Response({'message': auth.get('error')}, status=status.HTTP_401_UNAUTHORIZED)
+
     conn = None
     try:
         # establish database connection
@@ -223,52 +275,48 @@ def get_products(request):  # Recently uploaded products
 
         # Get pagination parameters from query string
         page = int(request.query_params.get('page', 1))
-        page_size = int(request.query_params.get('page_size', 9))
+        page_size = parse_page_size(request.query_params)
         offset = (page - 1) * page_size
 
-        # Get total number of products
-        cur.execute("SELECT COUNT(*) FROM product WHERE is_removed = false")
-        total_count = cur.fetchone()[0]
-
-        # Get paginated products data
-        cur.execute("""
-            SELECT p.id, title, description, MIN(resource) as banner, subcategory_id, st_price, created_at
-            FROM product p INNER JOIN gallery g ON p.id = g.product_id
-            WHERE is_removed = FALSE
-            GROUP BY p.id
+        query = reads.LISTING_SQL
+        if wants_cursor(request.query_params):
+            # Keyset mode: seek past the cursor, no OFFSET and no total count
+            seek, seek_params = seek_clause(decode_cursor(request.query_params.get('cursor')))
+            STATEMENTS.run(cur, 'feed', query + seek + """
+            ORDER BY created_at DESC, p.id DESC
+            LIMIT %s
+        """, seek_params + [page_size + 1])
+            rows, pagination = cursor_page(cur.fetchall(), page_size, reads.row_key)
+        else:
+            # Get paginated products data
+            STATEMENTS.run(cur, 'feed', query + """
             ORDER BY created_at DESC
             LIMIT %s OFFSET %s
-        """, [page_size, offset])
-        rows = cur.fetchall()
+        """, [page_size + 1, offset])
+            rows, pagination = offset_page(cur.fetchall(), page, page_size)
+
+            # Get the maintained total number of products unless ?total=false
+            if counts.wants_total(request.query_params):
+                total_count = counts.read(cur, counts.FEED)
+                pagination['num_pages'] = math.ceil(total_count / page_size)
+                pagination['total_count'] = total_count
 
         # Serialize product data
-        products = []
-        for row in rows:
-            product = {
-                'id': row[0],
-                'title': row[1],
-                'description': row[2],
-                'banner': row[3],
-                'subcategory_id': row[-3],
-                'st_price': float(row[-2]),
-                'created_at': row[-1].strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-            }
-            products.append(product)
+        products = [reads.feed_product(row) for row in rows]
 
         # Build response dictionary with pagination information
         resp = {
             'data': {
                 "products": products,
-                'pagination': {
-                    'page': page,
-                    'page_size': page_size,
-                    'num_pages': math.ceil(total_count / page_size),
-                    'total_count': total_count,
-                }
+                'pagination': pagination
             },
             'message': 'Амжилттай!',
         }
-        return Response(resp, status=status.HTTP_200_OK)
+        if inline:
+            resp['data']['membership'] = membership.lookup(cur, user_id, [row[0] for row in rows])
+        return tag(Response(resp, status=status.HTTP_200_OK), 'feed')
+    except InvalidCursor as error:
+        return Response({'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as error:
         log_error('get_products', json.dumps(
             {'data': request.data}), str(error))
@@ -281,20 +329,18 @@ def get_products(request):  # Recently uploaded products
             disconnectDB(conn)
 
 
+@cached_response(RESPONSES)
 @api_view(['GET'])
 @authentication_classes([])
 @permission_classes([AllowAny])
 def get_product_details(request, id):
     conn = None
     try:
-        con = connectDB()
-        cur = con.cursor()
-        cur.execute(
-            """SELECT title, description, schedule, fab_user_id, start_date, end_date, subcategory_id, hashtags, st_price, 
-                created_at, updated_at, is_removed FROM product WHERE id=%s;""", [id])
-        result = cur.fetchone()
+        conn = connectDB()
+        cur = conn.cursor()
+        result = reads.fetch_product(cur, id)
 
-        if result is None or result[-1] != False:
+        if result is None or result[11] != False:
             log_error('get_product', json.dumps({'product_id': id}),
                       'This product is removed or does not exist')
             return Response(
@@ -302,37 +348,14 @@ def get_product_details(request, id):
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        cur.execute("SELECT resource FROM gallery WHERE product_id = %s", [id])
-        medias = cur.fetchall()
-        flat_gallery = [item for sublist in medias for item in sublist]
-
-        cur.execute("SELECT source FROM route WHERE product_id = %s", [id])
-        links = cur.fetchall()
-        flat_link = [item for sublist in links for item in sublist]
-
         resp = {
-            "data": {
-                "id": id,
-                "title": result[0],
-                "description": result[1],
-                "schedule": result[2],
-                "owner": result[3],
-                "start_date": result[4],
-                "end_date": result[5],
-                "categories": result[6],
-                "hashtags": result[7],
-                "price": result[8],
-                "published": result[9],
-                "edited": result[10],
-                "gallery": flat_gallery,
-                "link": flat_link
-            },
+            "data": reads.product_details(id, result),
             "message": "Амжилттай!",
         }
-        return Response(
+        return tag(Response(
             resp,
             status=status.HTTP_200_OK
-        )
+        ), 'product:%s' % id)
     except Exception as error:
         log_error('get_product', json.dumps(
             {'product_id': id, 'data': request.data}), str(error))
@@ -421,33 +444,33 @@ def create_product(request):
         if sources:
             sauces = sources.split("&")
             sources_list = sources_list + sauces
-            for source in sauces:
-                values = (source, content_id)
-                cur.execute(
-                    """INSERT INTO route(source, product_id) 
-                        VALUES (%s, %s)""",
-                    values
-                )
+            attachments.add_routes(cur, content_id, sauces)
 
-        # Set the upload folder to the public/img directory
-        file_path = os.path.join(settings.MEDIA_ROOT, 'public', 'img')
+        # Store the uploads in the content-addressed store under public/img
         gallery_data = data.get('resource')
         filenames = []
+        resources = []
         if gallery_data:
-            storage = FileSystemStorage(location=file_path)
-            for image_file in gallery_data:
-                filename = storage.save(image_file.name, image_file)
-                filenames.append(filename)
-                values = (os.path.join(file_path, filename).replace(
-                    '\\', '/'), content_id)
-                cur.execute(
-                    """INSERT INTO gallery (resource, product_id)
-                        VALUES (%s, %s)""",
-                    values
-                )
+            # Identical images share one stored blob
+            saved = STORE.save_many(cur, gallery_data)
+            filenames = [os.path.basename(resource) for resource, _ in saved]
+            resources = [resource for resource, created in saved if created]
+            attachments.add_gallery(cur, content_id, [resource for resource, _ in saved])
+            # Keep the listing card in sync with the gallery
+            cards.refresh_banner(cur, content_id)
+
+        # Keep the maintained listing totals in the same transaction; bumped
+        # last so the shared feed row stays locked only until the commit
+        counts.bump(cur, counts.FEED, 0, 1)
+        counts.bump(cur, counts.SELLER, user_id[0], 1)
 
         # Commit the changes to the database
         conn.commit()
+        RESPONSES.purge('feed', 'seller:%s' % user_id[0])
+
+        # Variants are generated off the request, once the rows are committed
+        process_images('create_product', resources, lambda: RESPONSES.purge(
+            'product:%s' % content_id, 'feed', 'seller:%s' % user_id[0]))
 
         resp = {
             'data': {
@@ -532,36 +555,23 @@ def update_product(request, id):
         cur.execute(query, values)
 
         deleted_files = []
-        # Delete deleted gallery files and rows from the database
+        garbage = []
+        # Delete deleted gallery rows and release their blobs
         resource_deleted = data.get('resource_deleted')
         if resource_deleted:
             res_list = resource_deleted.split('&')
             deleted_files = deleted_files + res_list
-            for deleted in res_list:
-                # Delete the file from the Django media directory
-                full_path = os.path.join(settings.MEDIA_ROOT, deleted)
-                if os.path.isfile(full_path):
-                    os.remove(full_path)
-                values = (deleted, id)
-                cur.execute(
-                    "DELETE FROM gallery WHERE resource = %s AND product_id = %s", values
-                )
+            removed = attachments.remove_gallery(cur, id, res_list)
+            # Only references this product actually held are released
+            garbage = STORE.release_many(cur, removed)
 
         deleted_sources = []
-        # Delete deleted source files and rows from the database
+        # Delete deleted source rows from the database
         source_deleted = data.get('source_deleted')
         if source_deleted:
             src_list = source_deleted.split('&')
             deleted_sources = deleted_sources + src_list
-            for deleted in src_list:
-                # Delete the file from the Django media directory
-                full_path = os.path.join(settings.MEDIA_ROOT, deleted)
-                if os.path.isfile(full_path):
-                    os.remove(full_path)
-                values = (deleted, id)
-                cur.execute(
-                    "DELETE FROM route WHERE source = %s AND product_id = %s", values
-                )
+            attachments.remove_routes(cur, id, src_list)
 
         sources_list = []
         # Insert new source files into the database
@@ -569,32 +579,33 @@ def update_product(request, id):
         if sources:
             srcs = sources.split('&')
             sources_list = sources_list + srcs
-            for source in srcs:
-                values = (source, content_id)
-                cur.execute(
-                    "INSERT INTO route(source, product_id) VALUES (%s, %s)",
-                    values
-                )
+            attachments.add_routes(cur, content_id, srcs)
 
-        # Insert new gallery files into the database
-        file_path = os.path.join(settings.MEDIA_ROOT, 'public', 'img')
+        # Store new gallery files and insert them into the database
         gallery_data = data.get('resource')
         filenames = []
+        resources = []
         if gallery_data:
-            storage = FileSystemStorage(location=file_path)
-            for image_file in gallery_data:
-                filename = storage.save(image_file.name, image_file)
-                filenames.append(filename)
-                values = (os.path.join(file_path, filename).replace(
-                    '\\', '/'), content_id)
-                cur.execute(
-                    """INSERT INTO gallery (resource, product_id)
-                        VALUES (%s, %s)""",
-                    values
-                )
+            # Identical images share one stored blob
+            saved = STORE.save_many(cur, gallery_data)
+            filenames = [os.path.basename(resource) for resource, _ in saved]
+            resources = [resource for resource, created in saved if created]
+            attachments.add_gallery(cur, content_id, [resource for resource, _ in saved])
+
+        # Keep the listing card in sync with the gallery
+        if resource_deleted or gallery_data:
+            cards.refresh_banner(cur, content_id)
 
         # Commit the changes to the database
         conn.commit()
+        RESPONSES.purge('product:%s' % id, 'feed', 'seller:%s' % user_id)
+
+        # Blobs nothing references any more go once the change is committed
+        STORE.collect(conn, garbage)
+
+        # Variants are generated off the request, once the rows are committed
+        process_images('update_product', resources, lambda: RESPONSES.purge(
+            'product:%s' % id, 'feed', 'seller:%s' % user_id))
 
         resp = {
             'data': {
@@ -659,10 +670,17 @@ def delete_product(request, id):
                 result_dict[colnames[i]] = value
 
         cur.execute(
-            'UPDATE product SET is_removed = True WHERE id = %s AND fab_user_id = %s', values)
+            'UPDATE product SET is_removed = True WHERE id = %s AND fab_user_id = %s AND is_removed = False', values)
+
+        # Only a product that was still listed leaves the totals; nothing else
+        # runs between the bump and the commit
+        if cur.rowcount:
+            counts.bump(cur, counts.FEED, 0, -1)
+            counts.bump(cur, counts.SELLER, auth.get('user_id'), -1)
 
         # Commit the changes to the database
         conn.commit()
+        RESPONSES.purge('product:%s' % id, 'feed', 'seller:%s' % auth.get('user_id'))
 
         resp = {
             'data': result_dict,
@@ -691,56 +709,84 @@ def delete_product(request, id):
 def search_products(request):
     keyword = str(request.GET.get('keyword', ''))
     page = int(request.GET.get('page', 1))
-    limit = int(request.GET.get('limit', 9))
+    limit = parse_page_size(request.GET, 'limit')
+    inline = membership.wants_inline(request.GET)
+    if inline:
+        user_id, auth = membership.authorize(request)
+        if user_id is None:
+            return Response({'message': auth.get('error')}, status=status.HTTP_401_UNAUTHORIZED)
 
     conn = None
     try:
         conn = connectDB()
         cur = conn.cursor()
 
-        # get the total number of matching products
-        cur.execute(
-            "SELECT COUNT(*) FROM product WHERE title ILIKE %s AND is_removed = false", ['%'+keyword+'%'])
-        total_count = cur.fetchone()[0]
-
-        # get a list of products matching the keyword, paginated
-        cur.execute(
-            """SELECT p.id, title, description, MIN(resource) as banner, subcategory_id, st_price, created_at 
-                FROM product p INNER JOIN gallery g ON p.id = g.product_id
-                WHERE is_removed = false AND title ILIKE %s
-                GROUP BY p.id 
-                ORDER BY created_at DESC 
+        # ?match= pins the mode an earlier page reported; otherwise start with
+        # ranked full-text matching and fall back to fuzzy title matching
+        mode = request.GET.get('match')
+        pinned = mode in search.MODES
+        if not pinned:
+            mode = search.initial_mode(keyword)
+        keyset = wants_cursor(request.GET)
+        after = decode_cursor(request.GET.get('cursor')) if keyset else None
+
+        query = reads.LISTING_SQL
+        while True:
+            match, match_params = search.match_clause(mode, keyword)
+            if keyset:
+                # Keyset mode: seek past the cursor, newest matches first
+                seek, seek_params = seek_clause(after)
+                STATEMENTS.run(cur, 'search',
+                    query + match + seek + """
+                ORDER BY created_at DESC, p.id DESC 
+                LIMIT %s""",
+                    match_params + seek_params + [limit + 1]
+                )
+                rows, pagination = cursor_page(cur.fetchall(), limit, reads.row_key)
+            else:
+                # get a list of products matching the keyword, best matches first
+                rank, rank_params = search.rank_clause(mode, keyword)
+                STATEMENTS.run(cur, 'search',
+                    query + match + """
+                ORDER BY """ + rank + """created_at DESC 
                 LIMIT %s OFFSET %s""",
-            ['%'+keyword+'%', limit, (page-1)*limit]
-        )
-        rows = cur.fetchall()
+                    match_params + rank_params + [limit + 1, (page-1)*limit]
+                )
+                rows, pagination = offset_page(cur.fetchall(), page, limit)
+
+            first_page = after is None if keyset else page == 1
+            if rows or pinned or mode != search.FULLTEXT or not first_page:
+                break
+            mode = search.FUZZY
+
+        # get the number of matching products, counting no further than the cap
+        if not keyset and counts.wants_total(request.GET):
+            total_count, capped = counts.capped_count(
+                cur,
+                "SELECT 1 FROM product WHERE is_removed = false" + match,
+                match_params,
+                settings.SEARCH_COUNT_CAP
+            )
+            pagination['num_pages'] = math.ceil(total_count / limit)
+            pagination['total_count'] = total_count
+            pagination['total_capped'] = capped
 
-        products = []
-        for row in rows:
-            products.append({
-                'id': row[0],
-                'title': row[1],
-                'description': row[2],
-                'banner': row[3],
-                'subcategory_id': row[-3],
-                'price': row[-2],
-                'created_at': row[-1].strftime('%Y-%m-%dT%H:%M:%S')
-            })
+        products = [reads.search_product(row) for row in rows]
 
         resp = {
             'data': {
                 'products': products,
-                'pagination': {
-                    'page': page,
-                    'page_size': limit,
-                    'num_pages': math.ceil(total_count / limit),
-                    'total_count': total_count,
-                }
+                'match': mode,
+                'pagination': pagination
             },
             'message': 'Амжилттай!'
         }
+        if inline:
+            resp['data']['membership'] = membership.lookup(cur, user_id, [row[0] for row in rows])
 
         return Response(resp, status=status.HTTP_200_OK)
+    except InvalidCursor as error:
+        return Response({'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as error:
         log_error('search_product', json.dumps(
             {"keyword": keyword, "page": page, "limit": limit, 'data': request.data}), str(error))
@@ -778,41 +824,31 @@ def add_n_remove_from_wishlist(request):
         conn = connectDB()
         cur = conn.cursor()
 
-        # Check if product exists
-        cur.execute(
-            "SELECT id FROM product WHERE id = %s",
-            [product_id]
-        )
-        result = cur.fetchone()
-        if result is None:
+        # Delete-else-insert in one statement, with the wishlist total
+        exists, removed_id, wishlist_id = toggles.wishlist(cur, user_id, product_id)
+        conn.commit()
+        if not exists:
             log_error('add_to_wishlist', json.dumps(
                 {"message": 'Энэхүү бүтээгдэхүүн нь систэмд бүртгэлгүй байна.', "data": data}), 'error. result is none')
             return Response({'message': 'Энэхүү бүтээгдэхүүн нь систэмд бүртгэлгүй байна.'}, status=status.HTTP_404_NOT_FOUND)
 
-        # Check if product is already in wishlist
-        cur.execute(
-            "SELECT id FROM wishlist WHERE fab_user_id = %s AND product_id = %s",
-            [user_id, product_id]
-        )
-        result = cur.fetchone()
-        if result is not None:
-            cur.execute("DELETE FROM wishlist WHERE id=%s", [result])
-            conn.commit()
-            return Response({'message': 'Хүслийн жагсаалтнаас амжилттай хасагдлаа!'}, status=status.HTTP_200_OK)
-
-        # Add product to wishlist
-        cur.execute(
-            "INSERT INTO wishlist (fab_user_id, product_id) VALUES (%s, %s) RETURNING id",
-            [user_id, product_id]
-        )
-        wishlist_id = cur.fetchone()[0]
-        conn.commit()
+        if removed_id is not None:
+            resp = {
+                'data': {
+                    'product_id': product_id,
+                    'in_wishlist': False,
+                },
+                'message': 'Хүслийн жагсаалтнаас амжилттай хасагдлаа!',
+            }
+            return Response(resp, status=status.HTTP_200_OK)
 
+        # wishlist_id is None when a concurrent request added it first
         resp = {
             'data': {
                 'product_id': product_id,
                 'wishlist_id': wishlist_id,
                 'user_id': user_id,
+                'in_wishlist': True,
             },
             'message': 'Хүслийн жагсаалтад амжилттай бүртгэгдлээ!',
         }
@@ -844,12 +880,10 @@ def get_wishlist(request):
         conn = connectDB()
         cur = conn.cursor()
 
-        # Get count of total wishlist items
-        cur.execute(
-            "SELECT COUNT(*) FROM wishlist WHERE fab_user_id = %s",
-            [user_id]
-        )
-        total_items = cur.fetchone()[0]
+        # Get the maintained count of total wishlist items unless ?total=false
+        total_items = None
+        if counts.wants_total(request.query_params):
+            total_items = counts.read(cur, counts.WISHLIST, user_id)
 
         # Calculate offset and limit for pagination
         offset = (page_number - 1) * page_size
@@ -900,45 +934,64 @@ def get_allWishlist(request):
         )
     user_id = auth.get('user_id')
 
-    conn = None
     try:
-        conn = connectDB()
-        cur = conn.cursor()
-
-        # Get count of total wishlist items
-        cur.execute(
-            "SELECT COUNT(*) FROM wishlist WHERE fab_user_id = %s",
+        # Streamed from a server-side cursor, so memory does not grow with the wishlist
+        rows = streaming.Rows(
+            "SELECT product.id, product.title, product.st_price FROM product JOIN wishlist ON wishlist.product_id = product.id WHERE wishlist.fab_user_id = %s ORDER BY wishlist.created_at DESC",
             [user_id]
         )
-        total_items = cur.fetchone()[0]
+    except Exception as e:
+        log_error('get_allWishlist', json.dumps(
+            {"user_id": user_id, "data": request.data}), str(e))
+        return Response({'message': 'Хүслийн жагсаалт руу хандаж чадсангүй!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Get wishlist items for the requested page
-        cur.execute(
-            "SELECT product.id, product.title, product.st_price FROM product JOIN wishlist ON wishlist.product_id = product.id WHERE wishlist.fab_user_id = %s ORDER BY wishlist.created_at DESC",
-            [user_id]
+    return streaming.response(
+        request,
+        rows,
+        lambda row: {
+            'id': row[0],
+            'title': row[1],
+            'st_price': row[2],
+        },
+        'wishlist_items',
+        'total_items',
+        'get_allWishlist',
+        {"user_id": user_id}
+    )
+
+
+@api_view(['GET'])
+def get_membership(request):  # Wishlist and cart icons of a product grid
+    auth_header = request.headers.get('Authorization')
+    auth = verifyToken(auth_header)
+    if(auth.get('status') != 200):
+        return Response(
+            {'message': auth.get('error')},
+            status=status.HTTP_401_UNAUTHORIZED
         )
-        wishlist_items = []
-        for row in cur.fetchall():
-            wishlist_items.append({
-                'id': row[0],
-                'title': row[1],
-                'st_price': row[2],
-            })
+    user_id = auth.get('user_id')
+    try:
+        ids = membership.parse_ids(request.GET.get('ids'))
+    except membership.InvalidIds as error:
+        return Response({'message': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+    conn = None
+    try:
+        conn = connectDB()
+        cur = conn.cursor()
 
-        # Build response
         resp = {
-            'data': {
-                'wishlist_items': wishlist_items,
-                'total_items': total_items,
-            },
+            'data': membership.lookup(cur, user_id, ids),
             'message': 'Амжилттай!',
         }
-
         return Response(resp, status=status.HTTP_200_OK)
-    except Exception as e:
-        log_error('get_allWishlist', json.dumps(
-            {"user_id": user_id, "data": request.data}), str(e))
-        return Response({'message': 'Хүслийн жагсаалт руу хандаж чадсангүй!'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except Exception as error:
+        log_error('get_membership', json.dumps(
+            {"user_id": user_id, "ids": ids}), str(error))
+        return Response(
+            {'message': 'Уучлаарай, үйлдлийг гүйцэтгэхэд алдаа гарлаа.'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
     finally:
         if conn is not None:
             disconnectDB(conn)
@@ -967,9 +1020,9 @@ def create_review(request, product_id):
         conn = connectDB()
         cur = conn.cursor()
 
-        # check if the product exists
+        # check if the product exists; its owner's listings show the rating too
         cur.execute(
-            "SELECT id FROM product WHERE id = %s", [product_id]
+            "SELECT id, fab_user_id FROM product WHERE id = %s", [product_id]
         )
         result = cur.fetchone()
 
@@ -984,11 +1037,14 @@ def create_review(request, product_id):
         # insert review into the database
         cur.execute(
             "INSERT INTO review (score, comment, fab_user_id, product_id) VALUES (%s, %s, %s, %s) RETURNING id",
-            [int(data.get('score')), data.get('comment', None),
+            [data.get('score'), data.get('comment', None),
              user_id, product_id]
         )
         review_id = cur.fetchone()[0]
+        ratings.record(cur, product_id, data.get('score'), 1)
         conn.commit()
+        RESPONSES.purge('reviews:%s' % product_id, 'product:%s' % product_id,
+                        'feed', 'seller:%s' % result[1])
 
         resp = {
             "data": {
@@ -1017,6 +1073,7 @@ def create_review(request, product_id):
             disconnectDB(conn)
 
 
+@cached_response(RESPONSES)
 @api_view(['GET'])
 @authentication_classes([])
 @permission_classes([AllowAny])
@@ -1032,37 +1089,19 @@ def get_reviews(request, product_id):
         cursor = int(request.GET.get('cursor', 0))
 
         # retrieve reviews using cursor-based pagination
-        cur.execute(
-            """SELECT id, score, comment, fab_user_id, created_at FROM review WHERE product_id=%s AND id > %s ORDER BY id LIMIT %s""",
-            [product_id, cursor, limit]
-        )
+        STATEMENTS.execute(cur, reads.REVIEWS, [product_id, cursor, limit])
         rows = cur.fetchall()
 
-        # construct response data
-        reviews = []
-        for row in rows:
-            review = {
-                'id': row[0],
-                'score': row[1],
-                'comment': row[2],
-                'user_id': row[3],
-                'created_at': row[4].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-            }
-            reviews.append(review)
+        # reviewer username and avatar, from the card cache or one batched query
+        cards = reads.reviewers(cur, rows)
 
         # construct response with pagination information
         resp = {
-            "data": {
-                'reviews': reviews,
-                "pagination": {
-                    "has_next": bool(rows),
-                    "cursor": rows[-1][0] if rows else None
-                },
-            },
+            "data": reads.reviews_page(rows, cards),
             "message": "Амжилттай!"
         }
 
-        return Response(resp, status=status.HTTP_200_OK)
+        return tag(Response(resp, status=status.HTTP_200_OK), 'reviews:%s' % product_id, *reads.reviewer_tags(rows))
     except Exception as error:
         log_error('get_reviews', json.dumps(
             {"product_id": product_id, 'data': request.data}), str(error))
@@ -1115,11 +1154,20 @@ def delete_review(request, review_id):
                 status=status.HTTP_401_UNAUTHORIZED
             )
 
-        # Delete the review
+        # Delete the review; a concurrent delete leaves nothing to subtract
         cur.execute(
-            "DELETE FROM review WHERE id = %s", [review_id]
+            """DELETE FROM review r USING product p WHERE r.id = %s AND p.id = r.product_id
+                RETURNING r.score, r.product_id, p.fab_user_id""", [review_id]
         )
+        deleted = cur.fetchone()
+        if deleted is not None:
+            ratings.record(cur, deleted[1], deleted[0], -1)
         conn.commit()
+        if deleted is not None:
+            # Listing cards carry the rating, so the feed and seller pages go
+            # too; a concurrent delete already purged them otherwise
+            RESPONSES.purge('reviews:%s' % deleted[1], 'product:%s' % deleted[1],
+                            'feed', 'seller:%s' % deleted[2])
 
         resp = {
             'data': result_dict,
@@ -1164,9 +1212,9 @@ def get_cart_details(request):
         cur = conn.cursor()
 
         cur.execute(
-            """SELECT p.id, title, MIN(resource), st_price FROM customer c 
-                INNER JOIN product p ON p.id=c.product_id INNER JOIN gallery g ON p.id=g.product_id
-                WHERE in_cart = TRUE AND is_bought = FALSE AND c.fab_user_id = %s
+            """SELECT p.id, title, banner AS min, st_price FROM customer c 
+                INNER JOIN product p ON p.id=c.product_id
+                WHERE in_cart = TRUE AND is_bought = FALSE AND c.fab_user_id = %s AND banner IS NOT NULL
                 GROUP BY p.id, title, st_price""",
             [user_id]
         )
@@ -1218,49 +1266,44 @@ def add_n_remove_from_cart(request, product_id):
         conn = connectDB()
         cur = conn.cursor()
 
-        # Check if it's already in the cart
-        cur.execute(
-            "SELECT * FROM customer WHERE product_id = %s AND in_cart = true AND fab_user_id = %s",
-            [product_id, user_id]
-        )
-        result = cur.fetchone()
-        print(result)
-
-        if result is not None:
-            # Check if user is authorized to modify
-            user_id = auth.get('user_id')
-            if user_id != result[1]:
-                log_error('add_n_remove_from_cart', json.dumps(
-                    request.data), 'Unauthorized')
-                return Response(
-                    {'message': 'Unauthorized'},
-                    status=status.HTTP_401_UNAUTHORIZED
-                )
-
-            if result[-1] == True:
-                log_error('add_n_remove_from_cart', json.dumps(request.data),
-                          'Product is already purchased')
-                return Response(
-                    {'message': 'Product is already purchased'},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-
-            cur.execute("DELETE FROM customer WHERE id = %s", [result[0]])
-            conn.commit()
-            return Response({'message': 'Сагснаас амжилттай хасагдлаа!'}, status=status.HTTP_200_OK)
+        # Delete-else-insert in one statement
+        exists, bought, removed_id, cart_id = toggles.cart(cur, user_id, product_id)
+        conn.commit()
+        if not exists:
+            log_error('add_n_remove_from_cart', json.dumps(
+                {"product_id": product_id}), 'Product does not exist')
+            return Response(
+                {'message': 'Product does not exist'},
+                status=status.HTTP_404_NOT_FOUND
+            )
 
-        # Add product to cart
-        cur.execute("INSERT INTO customer (fab_user_id, product_id) VALUES (%s, %s) RETURNING id", [
-                    user_id, product_id])
+        if bought:
+            log_error('add_n_remove_from_cart', json.dumps(request.data),
+                      'Product is already purchased')
+            return Response(
+                {'message': 'Product is already purchased'},
+                status=status.HTTP_404_NOT_FOUND
+            )
 
-        cart_id = cur.fetchone()[0]
-        conn.commit()
+        if removed_id is not None:
+            return Response(
+                {
+                    'data': {
+                        "product_id": product_id,
+                        "in_cart": False,
+                    },
+                    'message': 'Сагснаас амжилттай хасагдлаа!'
+                },
+                status=status.HTTP_200_OK
+            )
 
+        # cart_id is None when a concurrent request added it first
         resp = {
             'data': {
                 "cart_id": cart_id,
                 "user_id": user_id,
                 "product_id": product_id,
+                "in_cart": True,
             },
             "message": "Сагсанд амжилттай нэмэгдлээ!",
         }
@@ -1291,47 +1334,40 @@ def checkout_cart(request):
             status=status.HTTP_401_UNAUTHORIZED
         )
     user_id = auth.get('user_id')
+    # Retries carrying the same Idempotency-Key replay the first checkout
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= checkout.MAX_KEY_LENGTH:
+        return Response(
+            {'message': 'Idempotency-Key must be 1 to %s characters' % checkout.MAX_KEY_LENGTH},
+            status=status.HTTP_400_BAD_REQUEST
+        )
 
     conn = None
     try:
         conn = connectDB()
         cur = conn.cursor()
 
-        # Calculate total price
-        cur.execute("""SELECT SUM(st_price) as total_price FROM customer c LEFT JOIN product p on c.product_id=p.id
-                        WHERE c.fab_user_id = %s AND c.in_cart = true""", [user_id])
-        total_amount = cur.fetchone()[0] or (0)
-
-        # Get the user's current balance
-        cur.execute("SELECT balance FROM fab_user WHERE id = %s", [user_id])
-        user_balance = cur.fetchone()[0]
-
-        # Check if the user can purchase the items in the cart
-        equals = user_balance - total_amount
-        if equals < 0:
+        # Balance check, debit and cart -> bought in one guarded statement
+        try:
+            status_code, data, replayed = checkout.run(cur, user_id, key)
+        except checkout.InsufficientBalance:
+            conn.rollback()
             return Response({'message': 'Уучлаарай, үлдэгдэл хүрэлцэхгүй байна.'},
                             status=status.HTTP_406_NOT_ACCEPTABLE
                             )
-
-        # Finalize the request
-        cur.execute(
-            "UPDATE customer SET in_cart = false, is_bought = true WHERE fab_user_id = %s AND in_cart = true", [user_id])
-        affected_rows = cur.rowcount
-        cur.execute("UPDATE fab_user SET balance = %s WHERE id = %s", [
-                    equals, user_id])
         conn.commit()
 
         resp = {
-            'data': {
-                'balance': equals,
-                'bought_items': affected_rows,
-            },
+            'data': data,
             "message": "Амжилттай!",
         }
-        return Response(
+        response = Response(
             resp,
-            status=status.HTTP_202_ACCEPTED
+            status=status_code
         )
+        if replayed:
+            response['Idempotent-Replayed'] = 'true'
+        return response
     except Exception as error:
         log_error('checkout_cart', json.dumps(
             {"user_id": user_id, 'data': request.data}), str(error))
@@ -1359,41 +1395,20 @@ def remove_all_from_cart(request):
 def get_categories(request):
     conn = None
     try:
-        # establish database connection
-        conn = connectDB()
-        cur = conn.cursor()
-
-        # Get all categories from the "category" table
-        cur.execute("SELECT * from category")
-        categories = cur.fetchall()
-
-        # Loop through each category and get its related subcategories
-        resp = []
-        for category in categories:
-            flattened_dict = {}
-            cur.execute(
-                "SELECT id, name FROM subcategory WHERE category_id = %s", (category[0],))
-            subcategories = cur.fetchall()
-            for item in subcategories:
-                flattened_dict.update({item[0]: item[1]})
-
-            # Assign the subcategories to the category key in a dictionary
-            category_dict = {
-                "id": category[0],
-                "category": category[1],
-                "subcategories": flattened_dict,
-            }
-            resp.append(category_dict)
-
-        # construct response with information
-        resp = {
-            "data": {
-                "categories": resp,
-            },
-            "message": "Амжилттай!"
-        }
-
-        return Response(resp, status=status.HTTP_200_OK)
+        # Serve the pre-encoded tree without touching the database
+        cached = CATEGORIES.cached()
+        if cached is None:
+            # establish database connection
+            conn = connectDB()
+            cached = CATEGORIES.rebuild(conn)
+        body, etag = cached
+
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        return response
     except Exception as error:
         log_error('get_categories', json.dumps(
             {'data': request.data}), str(error))
@@ -1,42 +1,70 @@
 import json
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import BaseBackend
-from django.db import connections
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from massitfab.settings import log_error
+from massitfab.settings import connectDB, disconnectDB, log_error, TOKENS, STATEMENTS
+
+# fab_user columns in table order, as UserModel(*row) expects them
+USER_COLUMNS = "id, username, email, password, summary, profile_picture, refresh_token, balance, is_active, created_at"
+USER_BY_USERNAME = STATEMENTS.register(
+    'user_by_username', "SELECT " + USER_COLUMNS + " FROM fab_user WHERE username = %s")
+USER_BY_ID = STATEMENTS.register(
+    'user_by_id', "SELECT " + USER_COLUMNS + " FROM fab_user WHERE id = %s")
 
 
 class Sandy(BaseBackend):   # CustomBackend
     def authenticate(self, request, username=None, password=None, **kwargs):
         UserModel = get_user_model()
+        conn = None
         try:
-            with connections['outlaw'].cursor() as cursor:
-                cursor.execute("SELECT * FROM fab_user WHERE username=%s", [username])
-                row = cursor.fetchone()
-                if row:
-                    user = UserModel(*row)
-                    if user.check_password(password): # type: ignore
-                        return user
+            # Uses the same pooled connection as the view serving the request
+            conn = connectDB()
+            cursor = conn.cursor()
+            STATEMENTS.execute(cursor, USER_BY_USERNAME, [username])
+            row = cursor.fetchone()
+            if row:
+                user = UserModel(*row)
+                if user.check_password(password): # type: ignore
+                    return user
         except Exception as e:
             log_error('Sandy - authenticate', json.dumps(request.data), str(e))
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
         return None
 
     def get_user(self, user_id):
         UserModel = get_user_model()
+        conn = None
         try:
-            with connections['outlaw'].cursor() as cursor:
-                cursor.execute("SELECT * FROM fab_user WHERE id=%s", [user_id])
-                row = cursor.fetchone()
-                if row:
-                    return UserModel(*row)
+            conn = connectDB()
+            cursor = conn.cursor()
+            STATEMENTS.execute(cursor, USER_BY_ID, [user_id])
+            row = cursor.fetchone()
+            if row:
+                return UserModel(*row)
         except Exception as e:
             log_error('Sandy - get_user', json.dumps({"user_id": user_id}), str(e))
+        finally:
+            if conn is not None:
+                disconnectDB(conn)
         return None
 
 
 class Hideout(JWTAuthentication):   # JWTAuthenticationWithCustomUser
+    def get_validated_token(self, raw_token):
+        # Checked once per token; later requests reuse it until it expires
+        key = ('access', raw_token)
+        validated_token = TOKENS.get(key)
+        if validated_token is None:
+            validated_token = super().get_validated_token(raw_token)
+            TOKENS.set(key, validated_token, validated_token.get('exp'))
+        return validated_token
+
     def get_user(self, payload):
-        user_id = payload.get('user_id')
-        if user_id:
-            return Sandy().get_user(user_id)
+        # No query here: fab_user is only read if a view asks for profile fields
+        if payload.get('user_id'):
+            # classess imports simplejwt's views, which load this module
+            from .classess import Claims_user
+            return Claims_user(payload)
         return None
@@ -23,6 +23,41 @@ class Fab_user:
         return str(self.id)
 
 
+class Claims_user(Fab_user):
+    """Request user built from a verified access token alone.
+
+    id and username come from the token's claims. Any other fab_user field is
+    read from the database on first access and kept for the rest of the
+    request, so views that only need the id never query fab_user.
+    """
+    def __init__(self, claims):
+        super().__init__(claims.get('user_id'))
+        self.username = claims.get('username')
+        self._profile = None
+        self._loaded = False
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def profile(self):
+        if not self._loaded:
+            from .auth_backend import Sandy
+            self._profile = Sandy().get_user(self.id)
+            self._loaded = True
+        return self._profile
+
+    def __getattr__(self, name):
+        # Only reached for attributes the claims did not provide
+        if name.startswith('_'):
+            raise AttributeError(name)
+        profile = self.profile
+        if profile is None:
+            raise AttributeError(name)
+        return getattr(profile, name)
+
+
 # class User:
 #     def __init__(self, username, password):
 #         self.username = username
@@ -7,10 +7,15 @@ from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 
 # Local Imports
-from massitfab.settings import connectDB, disconnectDB, ps, hashPassword, verifyPassword, log_error, SECRET_KEY as sandy
+from massitfab.settings import connectDB, disconnectDB, ps, hashPassword, verifyPassword, log_error, SECRET_KEY as sandy, STATEMENTS
 from .serializers import RegisterUserSerializer, LoginUserSerializer, FabUserSerializer
 from .classess import Fab_user
 
+LOGIN_USER = STATEMENTS.register(
+    'login_user',
+    "SELECT id, username, email, password, summary, profile_picture, balance, refresh_token, created_at FROM fab_user WHERE email = %s"
+)
+
 class RegisterUserApi(APIView):
     authentication_classes = ()
     permission_classes = ()
@@ -89,10 +94,7 @@ class LoginUserApi(APIView):
             cur = conn.cursor()
 
             # Check if email exists
-            cur.execute(
-                "SELECT id, username, email, password, summary, profile_picture, balance, refresh_token, created_at FROM fab_user WHERE email = %s",
-                (data.get('email'),)    
-            )
+            STATEMENTS.execute(cur, LOGIN_USER, (data.get('email'),))
             result = cur.fetchone()
 
             if result is None: